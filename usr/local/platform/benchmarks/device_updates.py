@@ -0,0 +1,71 @@
+"""
+Microbenchmark for the per-update cost of DeviceManager as the number of devices grows.
+
+Compares the indexed lookups against the linear uuid scan they replaced, for both set-state
+(update_device_state) and the listener path that fires on every device change.
+
+Run from /usr/local/platform with the agent's venv:
+    venv/bin/python -m benchmarks.device_updates
+"""
+import timeit
+from uuid import uuid4
+
+from utils.DeviceManager import DeviceManager
+
+
+class FakeDevice:
+    def __init__(self):
+        self.uuid = uuid4()
+        self.state = {"position": 0, "velocity": 0.0, "torque_enabled": True, "limits": {"min": -90, "max": 90}}
+        self.listeners = []
+
+    def get_state(self):
+        return dict(self.state)
+
+    def set_state(self, state):
+        self.state.update(state)
+        for listener in self.listeners:
+            listener(self)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+
+class FakeRobot:
+    def __init__(self, device_count):
+        self.devices = [FakeDevice() for _ in range(device_count)]
+
+
+def linear_update(robot, device_data):
+    # The lookup DeviceManager used before the uuid index
+    for device in robot.devices:
+        if str(device.uuid) == str(device_data["uuid"]):
+            device.set_state(device_data["state"])
+            return
+
+
+def main(iterations: int = 2000):
+    print(f"{'devices':>8} {'linear us/update':>18} {'indexed us/update':>18}")
+    for device_count in (8, 32, 128, 512):
+        manager = DeviceManager(device_updated=lambda uuid, patch, version: None)
+        robot = FakeRobot(device_count)
+        manager.attach_robot(robot)
+        # Worst case for the linear scan: the last device
+        target = {"uuid": str(robot.devices[-1].uuid), "state": {"position": 0}}
+        counter = iter(range(10 ** 9))
+
+        def indexed():
+            target["state"]["position"] = next(counter)
+            manager.update_device_state(target)
+
+        def linear():
+            target["state"]["position"] = next(counter)
+            linear_update(robot, target)
+
+        linear_us = timeit.timeit(linear, number=iterations) / iterations * 1e6
+        indexed_us = timeit.timeit(indexed, number=iterations) / iterations * 1e6
+        print(f"{device_count:>8} {linear_us:>18.2f} {indexed_us:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
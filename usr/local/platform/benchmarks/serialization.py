@@ -0,0 +1,73 @@
+"""
+Microbenchmark for the JSON backends Serialization can use, on the payloads the agent actually sends:
+a single device's state, a batched device_update for a whole robot and a log frame.
+
+Measures encode (straight to bytes, as the BLE and WebSocket paths need it) and decode for the standard
+library and, if installed, orjson. MessagePack (the binary BLE protocol) is included for size comparison.
+
+Run from /usr/local/platform with the agent's venv:
+    venv/bin/python -m benchmarks.serialization
+"""
+import json
+import timeit
+from uuid import uuid4
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def device_state(index: int) -> dict:
+    return {
+        "position": 1024 + index,
+        "goal_position": 2048,
+        "velocity": 12.5,
+        "current": 0.31,
+        "temperature": 41,
+        "voltage": 11.9,
+        "torque_enabled": True,
+        "moving": False,
+        "limits": {"min": -150.0, "max": 150.0},
+        "pid": {"p": 32, "i": 0, "d": 4}
+    }
+
+
+def payloads() -> dict:
+    robot = {str(uuid4()): device_state(i) for i in range(24)}
+    return {
+        "device state": {str(uuid4()): device_state(0)},
+        "device_update (24 devices)": {"type": "device_update", "state": robot, "versions": {uuid: 7 for uuid in robot}},
+        "log frame": {"type": "log", "log_type": "stdout", "message": "step 1234: pos=0.512 vel=-0.03\n" * 8, "seq": 99, "lines": 8}
+    }
+
+
+def backends() -> dict:
+    encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+    result = {
+        "json": (lambda value: encoder.encode(value).encode("utf-8"), json.loads)
+    }
+    if orjson is not None:
+        result["orjson"] = (lambda value: orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS), orjson.loads)
+    if msgpack is not None:
+        result["msgpack"] = (msgpack.packb, msgpack.unpackb)
+    return result
+
+
+def main(iterations: int = 5000):
+    print(f"{'payload':>28} {'backend':>8} {'bytes':>7} {'encode us':>10} {'decode us':>10}")
+    for name, payload in payloads().items():
+        for backend, (dumps, loads) in backends().items():
+            encoded = dumps(payload)
+            encode_us = timeit.timeit(lambda: dumps(payload), number=iterations) / iterations * 1e6
+            decode_us = timeit.timeit(lambda: loads(encoded), number=iterations) / iterations * 1e6
+            print(f"{name:>28} {backend:>8} {len(encoded):>7} {encode_us:>10.2f} {decode_us:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 from server import Server
 from server.BLEServer import BLEServer
 from server.TCPServer import TCPServer
+from utils.Runtime import Runtime
 import threading
 
 def main():
-    ble: Server = BLEServer()
-    tcp: Server = TCPServer()
+    # Both transports are frontends onto the same execution/device/command state
+    runtime = Runtime()
+    ble: Server = BLEServer(runtime)
+    tcp: Server = TCPServer(runtime)
 
     ble_thread = threading.Thread(target=ble.start, daemon=True)
     tcp_thread = threading.Thread(target=tcp.start, daemon=True)
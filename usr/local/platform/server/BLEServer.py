@@ -1,5 +1,3 @@
-import asyncio
-import json
 import threading
 
 from bless import (
@@ -9,70 +7,168 @@ from bless import (
 
 # from ..BluetoothUUIDs import BluetoothUUIDs
 from BluetoothUUIDs import BluetoothUUIDs
-from utils.BluetoothConnection import BluetoothConnection, BluetoothService, BluetoothCharacteristic
-from utils.CommandCenter import CommandCenter
-from utils.ExecutionManager import ExecutionManager
-from utils.DeviceManager import DeviceManager
+from utils.BluetoothConnection import BluetoothConnection, BluetoothService, BluetoothCharacteristic, NotificationPriority
+from utils.DeviceUpdateCoalescer import DeviceChange, DeviceUpdateCoalescer
+from utils.LogPipeline import LogBatch
+from utils.ManifestStore import ManifestStore
+from utils.Runtime import Runtime
+from utils import Serialization, WireProtocol
+from utils.Commands import StructuredResponse
+from utils.WireProtocol import MessageType, Status
 
 from .Server import Server
-from concurrent.futures import ThreadPoolExecutor
 
 class BLEServer(Server):
+    # Device updates per second; every notification competes with logs and replies for the same link
+    DEFAULT_DEVICE_UPDATE_RATE = 10
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, runtime: Runtime):
+        super().__init__(runtime)
         self.heart_count = -1
-        self.execution_manager = ExecutionManager(self.__send_execution_stdout, self.__send_execution_stderr)
-        self.device_manager = DeviceManager(device_updated=self.__device_updated)
-        self.command_center = CommandCenter(execution_manager=self.execution_manager, device_manager=self.device_manager)
-        self.executor = ThreadPoolExecutor(max_workers=1)
+        # 'full' sends a device's whole state on every change, 'patch' only the changed keys
+        self.device_mode = 'full'
+        # WireProtocol.TEXT or WireProtocol.BINARY, negotiated by the client with set-protocol
+        self.protocol = WireProtocol.TEXT
+        self.execution_manager = runtime.execution_manager
+        self.device_manager = runtime.device_manager
+        self.command_center = runtime.command_center
+        self.scheduler = runtime.scheduler
+        runtime.events.subscribe("stdout", self.__send_execution_stdout)
+        runtime.events.subscribe("stderr", self.__send_execution_stderr)
+        rate = self.device_update_rate("ble", self.DEFAULT_DEVICE_UPDATE_RATE)
+        self.device_updates = DeviceUpdateCoalescer(self.__send_device_updates, rate)
+        runtime.events.subscribe("device_updated", self.device_updates.submit)
+        runtime.events.subscribe("job", self.__send_job_event)
 
         interactive_service = self.__get_interactive_service()
-        self.connection = BluetoothConnection(self.__get_name(), services=[interactive_service])
+        self.connection = BluetoothConnection(
+            self.__get_name(),
+            services=[interactive_service],
+            mtu=runtime.manifest.get("ble_mtu"),
+            connection_interval=runtime.manifest.get("ble_connection_interval", 0.03),
+            notifications_per_interval=runtime.manifest.get("ble_notifications_per_interval", 4)
+        )
         self.connection.onDeviceConnected = lambda: print("Connected!")
-        self.connection.onDeviceDisconnected = lambda: print("Disconnected!")
+        self.connection.onDeviceDisconnected = self.__device_disconnected
 
     def start(self):
         self.connection.start()
 
     @staticmethod
     def __get_name():
-        config = json.load(open("manifest.json"))
-        return config.get("name", "robot")
+        return ManifestStore.shared().get("name", "robot")
 
-    def __device_updated(self, device):
+    def __send_device_updates(self, changes: dict[str, DeviceChange]):
         uuid = BluetoothUUIDs.DEVICE_CHARACTERISTIC_UUID.value
-        state = {str(device): self.device_manager.state_for_device(device)}
-        state_bytes = bytearray(json.dumps(state), "utf-8")
-        self.connection.update_and_notify(uuid, state_bytes)
-
-    def __send_execution_stdout(self, data: str):
-        data = f"0,{data}"
-        self.connection.update_and_notify(BluetoothUUIDs.LOGGING_CHARACTERISTIC_UUID.value, bytearray(data, "utf-8"))
-
-    def __send_execution_stderr(self, data: str):
-        data = f"1,{data}"
-        self.connection.update_and_notify(BluetoothUUIDs.LOGGING_CHARACTERISTIC_UUID.value, bytearray(data, "utf-8"))
-
-    async def __execute_shell_command(self, command: str) -> (bytearray, bool):
-        success, response = await asyncio.get_event_loop().run_in_executor(
-            self.executor, self.command_center.execute_shell_command, (command,)
-        )
-        msg = f"0,{response}" if success else f"1,{response}"
-        return bytearray(msg, "utf-8"), True
-
-
-    async def __run_command(self, command: str) -> (bytearray, bool):
-        success, response = await asyncio.get_event_loop().run_in_executor(
-            self.executor, self.command_center.execute_command, command
-        )
-        msg = f"0,{response}" if success else f"1,{response}"
-        return bytearray(msg, "utf-8"), True  # Notify subscribers
-
-
-    async def __receive_heartbeat(self, heartbeat: str) -> (bytearray, bool):
-        self.execution_manager.beat()
-        return bytearray("0,", "utf-8"), True
+        snapshots = self.device_snapshots(changes)
+        if not snapshots:
+            return
+        if self.device_mode == 'patch':
+            devices = {}
+            for device, change in changes.items():
+                if device not in snapshots:
+                    continue
+                if change.patch is None:
+                    devices[device] = snapshots[device]
+                else:
+                    devices[device] = {'base_version': change.base_version, 'version': change.version, 'patch': change.patch}
+            message_type, message = MessageType.DEVICE_PATCH, {'devices': devices}
+        else:
+            message_type = MessageType.DEVICE_STATE
+            message = {device: snapshot['state'] for device, snapshot in snapshots.items()}
+        if self.protocol == WireProtocol.BINARY:
+            state_bytes = WireProtocol.encode(message_type, message)
+        else:
+            state_bytes = Serialization.dumps(message)
+        self.connection.update_and_notify(uuid, state_bytes, NotificationPriority.STATE)
+
+    def __device_disconnected(self):
+        print("Disconnected!")
+        # The next client starts out speaking text and receiving full device states
+        self.protocol = WireProtocol.TEXT
+        self.device_mode = 'full'
+
+    def __send_execution_stdout(self, batch: LogBatch):
+        if self.protocol == WireProtocol.BINARY:
+            data = WireProtocol.encode(MessageType.STDOUT, [batch.seq, batch.text])
+        else:
+            data = bytearray(f"0,{batch.text}", "utf-8")
+        self.connection.update_and_notify(BluetoothUUIDs.LOGGING_CHARACTERISTIC_UUID.value, data)
+
+    def __send_execution_stderr(self, batch: LogBatch):
+        if self.protocol == WireProtocol.BINARY:
+            data = WireProtocol.encode(MessageType.STDERR, [batch.seq, batch.text])
+        else:
+            data = bytearray(f"1,{batch.text}", "utf-8")
+        self.connection.update_and_notify(BluetoothUUIDs.LOGGING_CHARACTERISTIC_UUID.value, data)
+
+    def __send_job_event(self, event: dict):
+        if self.protocol == WireProtocol.BINARY:
+            data = WireProtocol.encode(MessageType.JOB, event)
+        else:
+            data = b"2," + Serialization.dumps(event)
+        self.connection.update_and_notify(BluetoothUUIDs.LOGGING_CHARACTERISTIC_UUID.value, data)
+
+    def __on_write(self, handler, on_receive=None):
+        """
+        Wraps a (success, response) command handler so it speaks whichever protocol the client negotiated.
+
+        :param on_receive: Called for every write before it is decoded, whether or not it decodes.
+        """
+        async def on_write(value: bytes) -> (bytearray, bool):
+            if on_receive is not None:
+                on_receive()
+            if self.protocol == WireProtocol.TEXT:
+                success, response = await handler(value.decode("utf-8"))
+                return bytearray(f"0,{response}" if success else f"1,{response}", "utf-8"), True
+
+            try:
+                frame = WireProtocol.decode(value)
+            except Exception as e:
+                return WireProtocol.encode(MessageType.RESPONSE, f"Malformed frame: {e}", Status.ERROR), True
+            # A set-protocol reply still goes out in the protocol its request arrived in
+            success, response = await handler(str(frame.payload))
+            if isinstance(response, StructuredResponse):
+                # Encoded as MessagePack data rather than as a string holding JSON
+                response = response.value
+            elif isinstance(response, (bytes, bytearray)):
+                response = response.decode("utf-8")
+            status = Status.OK if success else Status.ERROR
+            return WireProtocol.encode(MessageType.RESPONSE, response, status, frame.seq), True
+        return on_write
+
+    async def __execute_shell_command(self, command: str) -> (bool, str):
+        return await self.command_center.execute_shell_command_async(command)
+
+    async def __run_command(self, command: str) -> (bool, str):
+        if command.startswith("set-device-mode"):
+            return self.__set_device_mode(command)
+        if command.startswith("set-protocol"):
+            return self.__set_protocol(command)
+        if command == "get-ble-stats":
+            return True, StructuredResponse(self.connection.stats())
+        return await self.scheduler.submit(command)
+
+    def __set_device_mode(self, command: str) -> (bool, str):
+        components = command.split(" ")
+        if len(components) < 2 or components[1] not in ('full', 'patch'):
+            return False, "Invalid usage. Usage: set-device-mode <full|patch>"
+        self.device_mode = components[1]
+        return True, self.device_mode
+
+    def __set_protocol(self, command: str) -> (bool, str):
+        components = command.split(" ")
+        if len(components) < 2 or components[1] not in (WireProtocol.TEXT, WireProtocol.BINARY):
+            return False, "Invalid usage. Usage: set-protocol <text|binary>"
+        if components[1] == WireProtocol.BINARY and not WireProtocol.available():
+            return False, "Binary protocol unavailable: msgpack is not installed"
+        self.protocol = components[1]
+        self.connection.framed = self.protocol == WireProtocol.BINARY
+        return True, self.protocol
+
+    async def __receive_heartbeat(self, heartbeat: str) -> (bool, str):
+        # The beat itself was recorded when the write arrived (see __on_write), so a malformed frame still counts
+        return True, ""
 
     def __get_interactive_service(self):
         interactive_service = BluetoothService(BluetoothUUIDs.INTERACTIVE_SERVICE_UUID.value)
@@ -88,7 +184,7 @@ class BLEServer(Server):
             permissions=(GATTAttributePermissions.readable | GATTAttributePermissions.writeable),
             properties=(GATTCharacteristicProperties.read | GATTCharacteristicProperties.write | GATTCharacteristicProperties.notify),
             on_read=lambda value: value,
-            on_write=self.__execute_shell_command
+            on_write=self.__on_write(self.__execute_shell_command)
         )
         interactive_service.add_characteristic(exec_characteristic)
         comm_characteristic = BluetoothCharacteristic(
@@ -96,7 +192,7 @@ class BLEServer(Server):
             permissions=GATTAttributePermissions.readable | GATTAttributePermissions.writeable,
             properties=GATTCharacteristicProperties.read | GATTCharacteristicProperties.write | GATTCharacteristicProperties.notify,
             on_read=lambda value: value,
-            on_write=self.__run_command
+            on_write=self.__on_write(self.__run_command)
         )
         interactive_service.add_characteristic(comm_characteristic)
 
@@ -113,12 +209,12 @@ class BLEServer(Server):
             permissions=GATTAttributePermissions.readable | GATTAttributePermissions.writeable,
             properties=GATTCharacteristicProperties.read | GATTCharacteristicProperties.write | GATTCharacteristicProperties.notify,
             on_read=lambda value: bytearray("", "utf-8"),
-            on_write=self.__receive_heartbeat
+            on_write=self.__on_write(self.__receive_heartbeat, on_receive=self.execution_manager.beat)
         )
         interactive_service.add_characteristic(heartbeat_characteristic)
         return interactive_service
 
 
 if __name__ == '__main__':
-    server = BLEServer()
+    server = BLEServer(Runtime())
     server.start()
@@ -1,9 +1,34 @@
 from abc import ABC, abstractmethod
 
+from utils.Runtime import Runtime
+
 class Server(ABC):
-    def __init__(self):
-        pass
+    def __init__(self, runtime: Runtime):
+        self.runtime = runtime
 
     @abstractmethod
     def start(self):
-        pass
\ No newline at end of file
+        pass
+
+    def device_update_rate(self, transport: str, default: float) -> float:
+        """
+        The manifest's device_update_rate for transport, or default if it's missing or not a positive number.
+        """
+        rate = self.runtime.manifest.get("device_update_rate", {}).get(transport, default)
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0:
+            print(f"Ignoring invalid device_update_rate for {transport}: {rate!r}")
+            return default
+        return rate
+
+    def device_snapshots(self, devices) -> dict:
+        """
+        Snapshots of the given devices, leaving out any that no longer exist because the robot was swapped
+        after their changes were queued.
+        """
+        snapshots = {}
+        for device in devices:
+            try:
+                snapshots[device] = self.runtime.device_manager.snapshot(device)
+            except ValueError:
+                continue
+        return snapshots
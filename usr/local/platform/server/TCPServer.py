@@ -1,59 +1,41 @@
 import asyncio
-import json
-from concurrent.futures import ThreadPoolExecutor
-from typing import Dict
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
 
 from server.Server import Server
-from utils.CommandCenter import CommandCenter
-from utils.ExecutionManager import ExecutionManager
-from utils.DeviceManager import DeviceManager
-
-
-class WebSocketConnection:
-    def __init__(self, websocket: WebSocket):
-        self.websocket = websocket
-        self.last_heartbeat = None
-
-
-class WebSocketManager:
-    def __init__(self):
-        self.active_connections: Dict[WebSocket, WebSocketConnection] = {}
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections[websocket] = WebSocketConnection(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            del self.active_connections[websocket]
-
-    async def send_message(self, websocket: WebSocket, message: dict):
-        if websocket in self.active_connections:
-            await websocket.send_json(message)
-
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await self.send_message(connection, message)
+from server.WebSocketManager import WebSocketConnection, WebSocketManager
+from utils import Commands, Metrics, Serialization, StatePatch
+from utils.Commands import Command, CommandError
+from utils.DeviceUpdateCoalescer import DeviceChange, DeviceUpdateCoalescer
+from utils.LogPipeline import LogBatch
+from utils.ManifestStore import ManifestStore
+from utils.Runtime import Runtime
 
 
 class TCPServer(Server):
-    def __init__(self):
-        super().__init__()
+    # Device updates per second
+    DEFAULT_DEVICE_UPDATE_RATE = 50
+    # First characters of anything json.loads accepts
+    JSON_START = set('{["-0123456789tfnNI')
+    # Requests whose work stops when they are cancelled. Everything else runs on a scheduler thread (or as a
+    # job), which can't be interrupted once started
+    CANCELLABLE_ENDPOINTS = {'execute-command'}
+    def __init__(self, runtime: Runtime):
+        super().__init__(runtime)
         self.app = FastAPI()
-        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.scheduler = runtime.scheduler
         self.websocket_manager = WebSocketManager()
 
-        self.execution_manager = ExecutionManager(
-            stdout=self.__send_execution_stdout,
-            stderr=self.__send_execution_stderr
-        )
-        self.device_manager = DeviceManager(device_updated=self.__device_updated)
-        self.command_center = CommandCenter(
-            execution_manager=self.execution_manager,
-            device_manager=self.device_manager
-        )
+        self.execution_manager = runtime.execution_manager
+        self.device_manager = runtime.device_manager
+        self.command_center = runtime.command_center
+        runtime.events.subscribe("stdout", self.__send_execution_stdout)
+        runtime.events.subscribe("stderr", self.__send_execution_stderr)
+        rate = self.device_update_rate("websocket", self.DEFAULT_DEVICE_UPDATE_RATE)
+        self.device_updates = DeviceUpdateCoalescer(self.__send_device_updates, rate)
+        runtime.events.subscribe("device_updated", self.device_updates.submit)
+        runtime.events.subscribe("job", self.__send_job_event)
 
         self.setup_routes()
 
@@ -61,17 +43,55 @@ class TCPServer(Server):
         @self.app.websocket("/ws")
         async def websocket_endpoint(websocket: WebSocket):
             await self.websocket_manager.connect(websocket)
+            connection = self.websocket_manager.connection(websocket)
             try:
                 while True:
-                    data = await websocket.receive_json()
-                    await self.__handle_websocket_message(websocket, data)
+                    try:
+                        data = Serialization.loads(await websocket.receive_text())
+                    except Serialization.DecodeError as e:
+                        await self.websocket_manager.send_message(websocket, {
+                            'id': None,
+                            'success': False,
+                            'response': f"Invalid JSON: {e}"
+                        })
+                        continue
+                    await self.__dispatch(connection, data)
             except WebSocketDisconnect:
                 self.websocket_manager.disconnect(websocket)
 
-    async def __handle_websocket_message(self, websocket: WebSocket, data: dict):
+        @self.app.get("/connections")
+        async def connections():
+            # Per-client outgoing queue depth and drop counters
+            return self.websocket_manager.stats()
+
+        @self.app.get("/metrics")
+        async def metrics():
+            # Prometheus text exposition format
+            return PlainTextResponse(Metrics.render(), media_type="text/plain; version=0.0.4")
+
+    async def __dispatch(self, connection: WebSocketConnection, data: dict):
+        """
+        Handles control messages inline and starts everything else as its own task, so the receive loop is
+        never blocked by a slow command and heartbeats are never queued behind one.
+        """
+        websocket = connection.websocket
+        if not isinstance(data, dict):
+            await self.websocket_manager.send_message(websocket, {
+                'id': None,
+                'success': False,
+                'response': "Requests must be JSON objects"
+            })
+            return
         request_id = data.get('id')
         endpoint = data.get('endpoint')
         payload = data.get('data', {})
+        if not self.__hashable(request_id) or not isinstance(payload, dict):
+            await self.websocket_manager.send_message(websocket, {
+                'id': request_id,
+                'success': False,
+                'response': "Request ids must be strings or numbers" if not self.__hashable(request_id) else "data must be an object"
+            })
+            return
 
         if endpoint == 'heartbeat':
             self.execution_manager.beat()
@@ -82,6 +102,37 @@ class TCPServer(Server):
             })
             return
 
+        if endpoint == 'cancel':
+            target = payload.get('id')
+            task = connection.requests.get(target) if self.__hashable(target) else None
+            if task is None:
+                success, response = False, "No such request in flight"
+            elif target not in connection.cancellable:
+                # Cancelling the task would only stop us waiting; the command itself would keep running
+                success, response = False, "Not cancellable; the request will run to completion"
+            else:
+                task.cancel()
+                success, response = True, "Cancelled"
+            await self.websocket_manager.send_message(websocket, {
+                'id': request_id,
+                'type': 'cancel',
+                'success': success,
+                'response': response
+            })
+            return
+
+        if endpoint == 'set-device-mode':
+            mode = payload.get('mode', 'full')
+            if mode in ('full', 'patch'):
+                connection.device_mode = mode
+            await self.websocket_manager.send_message(websocket, {
+                'id': request_id,
+                'type': 'set-device-mode',
+                'success': mode in ('full', 'patch'),
+                'response': mode
+            })
+            return
+
         if endpoint == 'name':
             await self.websocket_manager.send_message(websocket, {
                 'id': request_id,
@@ -91,22 +142,41 @@ class TCPServer(Server):
             })
             return
 
-        # Handle shell command execution
-        if endpoint == 'execute-command':
-            command = payload.get('command', '')
-            success, response = await asyncio.get_event_loop().run_in_executor(
-                self.executor,
-                self.command_center.execute_shell_command,
-                (command,)
-            )
-        else:
-            # Handle all other commands through command center
-            command_str = self.__build_command_string(endpoint, payload)
-            success, response = await asyncio.get_event_loop().run_in_executor(
-                self.executor,
-                self.command_center.execute_command,
-                command_str
-            )
+        error = None
+        if len(connection.requests) >= connection.max_in_flight:
+            error = f"Too many requests in flight (max {connection.max_in_flight})"
+        elif request_id is not None and request_id in connection.requests:
+            error = f"Request {request_id} is already in flight"
+        if error is not None:
+            await self.websocket_manager.send_message(websocket, {
+                'id': request_id,
+                'success': False,
+                'response': error
+            })
+            return
+
+        # Requests without an id can't be cancelled but still count towards the limit
+        key = request_id if request_id is not None else object()
+        task = asyncio.create_task(self.__handle_request(websocket, request_id, endpoint, payload))
+        connection.requests[key] = task
+        if endpoint in self.CANCELLABLE_ENDPOINTS:
+            connection.cancellable.add(key)
+
+        def done(finished: asyncio.Task):
+            connection.requests.pop(key, None)
+            connection.cancellable.discard(key)
+            if finished.cancelled():
+                # Cancelled before it started, so __handle_request never got to reply
+                connection.enqueue({'id': request_id, 'success': False, 'response': "Cancelled"}, droppable=False)
+        task.add_done_callback(done)
+
+    async def __handle_request(self, websocket: WebSocket, request_id, endpoint: str, payload: dict):
+        try:
+            success, response = await self.__run_request(endpoint, payload)
+        except asyncio.CancelledError:
+            success, response = False, "Cancelled"
+        except Exception as e:
+            success, response = False, str(e)
 
         await self.websocket_manager.send_message(websocket, {
             'id': request_id,
@@ -114,37 +184,48 @@ class TCPServer(Server):
             'response': response.decode('utf-8') if isinstance(response, bytearray) else str(response)
         })
 
-    @staticmethod
-    def __get_name():
-        config = json.load(open("manifest.json"))
-        return config.get("name", "robot")
-
-    def __build_command_string(self, endpoint: str, payload: dict) -> str:
-        if endpoint == 'install-project':
-            project_id = payload.get('project_id', '')
-            url = payload.get('url', '')
-            token = payload.get('token')
-            return f"install-project {project_id} {url} {token}" if token else f"install-project {project_id} {url}"
-
-        elif endpoint in ['switch-project', 'switch-branch', 'change-target']:
-            value = payload.get('project_id') or payload.get('branch_name') or payload.get('target_name', '')
-            return f"{endpoint} {value}"
+    async def __run_request(self, endpoint: str, payload: dict) -> (bool, str):
+        # Handle shell command execution
+        if endpoint == 'execute-command':
+            command = payload.get('command', '')
+            return await self.command_center.execute_shell_command_async(command)
+        # Handle all other commands through command center
+        try:
+            command = self.__build_command(endpoint, payload)
+        except CommandError as e:
+            return False, str(e)
+        return await self.scheduler.submit(command)
 
-        elif endpoint == 'set-state':
-            str_state = json.dumps(self.__convert_json(payload))
-            return f"set-state {str_state}"
+    @staticmethod
+    def __hashable(value) -> bool:
+        try:
+            hash(value)
+            return True
+        except TypeError:
+            return False
 
-        elif endpoint == 'get-state':
-            return f"get-state {payload.get('device_id', '')}"
+    @staticmethod
+    def __get_name():
+        return ManifestStore.shared().get("name", "robot")
 
-        return endpoint  # For commands without parameters
+    def __build_command(self, endpoint: str, payload: dict) -> Command:
+        if endpoint == 'set-state':
+            # The whole payload is the state update; nested JSON strings from older clients are unpacked
+            return Command(endpoint, {'state': self.__convert_json(payload)})
+        if endpoint == 'set-states':
+            # {'updates': [{'uuid', 'state'}, ...], 'atomic': bool}
+            return Command(endpoint, {'updates': self.__convert_json(payload)})
+        return Commands.from_request(endpoint, payload)
 
     def __convert_json(self, data: str):
         if isinstance(data, str):
+            # Only strings that could be JSON are worth a parse attempt; plain values are the common case
+            if data.lstrip()[:1] not in self.JSON_START:
+                return data
             try:
-                parsed = json.loads(data)
+                parsed = Serialization.loads(data)
                 return self.__convert_json(parsed)
-            except json.JSONDecodeError:
+            except Serialization.DecodeError:
                 return data
         if isinstance(data, dict):
             return {
@@ -155,26 +236,89 @@ class TCPServer(Server):
             return [self.__convert_json(item) for item in data]
         return data
 
-    def __device_updated(self, device):
-        state = {str(device): self.device_manager.state_for_device(device)}
-        asyncio.run(self.websocket_manager.broadcast({
+    def __send_device_updates(self, changes: dict[str, DeviceChange]):
+        if not self.websocket_manager.active_connections:
+            return
+        snapshots = self.device_snapshots(changes)
+        if not snapshots:
+            return
+        # One message per tick carrying every device that changed. A batch still queued for a slow client is
+        # merged with the next one, so the client gets each device's latest state once
+        self.websocket_manager.broadcast_threadsafe({
             'type': 'device_update',
-            'state': state
-        }))
+            'state': {device: snapshot['state'] for device, snapshot in snapshots.items()},
+            'versions': {device: snapshot['version'] for device, snapshot in snapshots.items()}
+        }, coalesce_key='device_update', only=lambda connection: connection.device_mode == 'full',
+            merge=self.__merge_device_updates)
+
+        # Patches are idempotent, so a client holding any version from base_version to version can apply
+        # the patch; one holding an older version resyncs with get-snapshot
+        devices = {}
+        for device, change in changes.items():
+            if device not in snapshots:
+                continue
+            if change.patch is None:
+                devices[device] = snapshots[device]
+            else:
+                devices[device] = {'base_version': change.base_version, 'version': change.version, 'patch': change.patch}
+        self.websocket_manager.broadcast_threadsafe({
+            'type': 'device_patch',
+            'devices': devices
+        }, coalesce_key='device_patch', only=lambda connection: connection.device_mode == 'patch',
+            merge=self.__merge_device_patches)
 
-    def __send_execution_stdout(self, data: str):
-        asyncio.run(self.websocket_manager.broadcast({
+    @staticmethod
+    def __merge_device_updates(first: dict, second: dict) -> dict:
+        return {
+            'type': 'device_update',
+            'state': {**first['state'], **second['state']},
+            'versions': {**first['versions'], **second['versions']}
+        }
+
+    @staticmethod
+    def __merge_device_patches(first: dict, second: dict) -> dict:
+        devices = dict(first['devices'])
+        for device, update in second['devices'].items():
+            queued = devices.get(device)
+            if queued is None or 'patch' not in update:
+                devices[device] = update
+            elif 'patch' in queued:
+                if update['base_version'] <= queued['version']:
+                    patch = StatePatch.compose(queued['patch'], update['patch'])
+                    devices[device] = {'base_version': queued['base_version'], 'version': update['version'], 'patch': patch}
+                else:
+                    # A gap the client has to resync over anyway
+                    devices[device] = update
+            elif isinstance(queued['state'], dict) and update['base_version'] <= queued['version'] < update['version']:
+                # A queued snapshot the patch applies to
+                devices[device] = {'state': StatePatch.apply_patch(queued['state'], update['patch']), 'version': update['version']}
+            elif queued['version'] < update['base_version']:
+                devices[device] = update
+        return {'type': 'device_patch', 'devices': devices}
+
+    def __send_execution_stdout(self, batch: LogBatch):
+        self.websocket_manager.broadcast_threadsafe({
             'type': 'log',
             'log_type': 'stdout',
-            'message': data
-        }))
+            'message': batch.text,
+            'seq': batch.seq,
+            'lines': batch.lines
+        })
 
-    def __send_execution_stderr(self, data: str):
-        asyncio.run(self.websocket_manager.broadcast({
+    def __send_execution_stderr(self, batch: LogBatch):
+        self.websocket_manager.broadcast_threadsafe({
             'type': 'log',
             'log_type': 'stderr',
-            'message': data
-        }))
+            'message': batch.text,
+            'seq': batch.seq,
+            'lines': batch.lines
+        })
+
+    def __send_job_event(self, event: dict):
+        self.websocket_manager.broadcast_threadsafe({
+            'type': 'job',
+            **event
+        })
 
     def start(self, host: str = "0.0.0.0", port: int = 5467):
         import uvicorn
@@ -182,5 +326,5 @@ class TCPServer(Server):
 
 
 if __name__ == "__main__":
-    server = TCPServer()
+    server = TCPServer(Runtime())
     server.start()
@@ -0,0 +1,189 @@
+import asyncio
+import time
+from collections import deque
+from typing import Callable, Dict, Hashable, Optional, Set, Union
+
+from fastapi import WebSocket
+
+from utils import Metrics, Serialization
+
+WEBSOCKET_SEND = Metrics.histogram("platform_websocket_send_seconds", "Time to write one message to a client", ("client",))
+WEBSOCKET_DROPPED = Metrics.counter("platform_websocket_dropped_total", "Messages dropped from a client's full queue")
+
+
+class WebSocketConnection:
+    """
+    One connected client with its own bounded outgoing queue, drained by a dedicated writer task on the
+    server loop. A slow client only ever backs up its own queue.
+
+    When the queue is full the oldest droppable message (logs, device updates) is discarded. Messages that
+    carry a coalesce key are folded into any still-queued message with the same key instead of queueing behind
+    it, so a lagging client gets one combined device update rather than every intermediate one. Replies to the
+    client's own requests are never dropped.
+    """
+
+    def __init__(self, websocket: WebSocket, max_queue: int = 256, max_in_flight: int = 16):
+        self.websocket = websocket
+        self.last_heartbeat = None
+        # 'full' clients get a device's whole state on every change, 'patch' clients only the changed keys
+        self.device_mode = 'full'
+        self.max_queue = max_queue
+        # Entries are [coalesce_key, message, droppable, source] so coalescing can swap the message in place;
+        # source is the dict a pre-serialized message was made from, kept for merging
+        self.queue = deque()
+        self.coalescing: Dict[Hashable, list] = {}
+        self.ready = asyncio.Event()
+        self.writer: Optional[asyncio.Task] = None
+        # Request id -> task handling it, so requests run concurrently and can be cancelled by id
+        self.requests: Dict[Hashable, asyncio.Task] = {}
+        # Ids of the requests in self.requests whose work really stops when their task is cancelled
+        self.cancellable: Set[Hashable] = set()
+        self.max_in_flight = max_in_flight
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def enqueue(self, message: Union[dict, str], coalesce_key: Hashable = None, droppable: bool = True,
+                merge: Callable[[dict, dict], dict] = None, source: dict = None):
+        """
+        Queues a message for the writer task. Must be called on the server loop.
+
+        :param message: A dict, or the already serialized text when the same message goes to many clients.
+        :param merge: Combines a still-queued message with the same coalesce key (first) and this one (second).
+            Without it the queued message is replaced.
+        :param source: The dict message was serialized from, if it is text and merge is given.
+        """
+        source = source if source is not None else message
+        if coalesce_key is not None and coalesce_key in self.coalescing:
+            entry = self.coalescing[coalesce_key]
+            if merge is not None:
+                # The merged message is this client's own, so the writer serializes it
+                source = merge(entry[3], source)
+                message = source
+            entry[1], entry[3] = message, source
+            self.coalesced += 1
+            return
+
+        if len(self.queue) >= self.max_queue:
+            self.__drop_oldest()
+
+        entry = [coalesce_key, message, droppable, source]
+        self.queue.append(entry)
+        if coalesce_key is not None:
+            self.coalescing[coalesce_key] = entry
+        self.ready.set()
+
+    async def run_writer(self):
+        while True:
+            while not self.queue:
+                self.ready.clear()
+                await self.ready.wait()
+            coalesce_key, message, _, _ = self.queue.popleft()
+            if coalesce_key is not None:
+                self.coalescing.pop(coalesce_key, None)
+            if not isinstance(message, str):
+                message = Serialization.dumps_str(message)
+            started = time.monotonic()
+            await self.websocket.send_text(message)
+            WEBSOCKET_SEND.observe(time.monotonic() - started, client=self.name)
+            self.sent += 1
+
+    @property
+    def name(self) -> str:
+        client = self.websocket.client
+        return f"{client.host}:{client.port}" if client else "unknown"
+
+    def stats(self) -> dict:
+        return {
+            'client': self.name,
+            'queue_depth': len(self.queue),
+            'in_flight': len(self.requests),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced
+        }
+
+    def __drop_oldest(self):
+        for entry in self.queue:
+            if entry[2]:
+                self.queue.remove(entry)
+                if entry[0] is not None:
+                    self.coalescing.pop(entry[0], None)
+                self.dropped += 1
+                WEBSOCKET_DROPPED.inc()
+                return
+        # Only replies are queued; let the queue grow rather than lose a response
+
+
+class WebSocketManager:
+    def __init__(self, max_queue: int = 256):
+        self.active_connections: Dict[WebSocket, WebSocketConnection] = {}
+        self.max_queue = max_queue
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def connect(self, websocket: WebSocket):
+        await websocket.accept()
+        self.loop = asyncio.get_running_loop()
+        connection = WebSocketConnection(websocket, self.max_queue)
+        connection.writer = asyncio.create_task(self.__write(connection))
+        self.active_connections[websocket] = connection
+
+    def disconnect(self, websocket: WebSocket):
+        connection = self.active_connections.pop(websocket, None)
+        if connection is None:
+            return
+        WEBSOCKET_SEND.remove(client=connection.name)
+        for task in list(connection.requests.values()):
+            task.cancel()
+        if connection.writer is not None:
+            connection.writer.cancel()
+
+    async def send_message(self, websocket: WebSocket, message: dict):
+        connection = self.active_connections.get(websocket)
+        if connection is not None:
+            connection.enqueue(message, droppable=False)
+
+    def connection(self, websocket: WebSocket) -> Optional[WebSocketConnection]:
+        return self.active_connections.get(websocket)
+
+    async def broadcast(self, message: dict, coalesce_key: Hashable = None,
+                        only: Callable[[WebSocketConnection], bool] = None,
+                        merge: Callable[[dict, dict], dict] = None):
+        self.broadcast_nowait(message, coalesce_key, only, merge)
+
+    def broadcast_nowait(self, message: dict, coalesce_key: Hashable = None,
+                         only: Callable[[WebSocketConnection], bool] = None,
+                         merge: Callable[[dict, dict], dict] = None):
+        # Serialized once here rather than once per client by the writers
+        text = None
+        for connection in list(self.active_connections.values()):
+            if only is None or only(connection):
+                if text is None:
+                    text = Serialization.dumps_str(message)
+                connection.enqueue(text, coalesce_key, merge=merge, source=message)
+
+    def broadcast_threadsafe(self, message: dict, coalesce_key: Hashable = None,
+                             only: Callable[[WebSocketConnection], bool] = None,
+                             merge: Callable[[dict, dict], dict] = None):
+        """
+        Broadcasts from a thread other than the server loop (e.g. ExecutionManager reader threads).
+        Only schedules the enqueue; never waits on a client.
+
+        :param only: If given, only connections it returns True for receive the message.
+        :param merge: See WebSocketConnection.enqueue.
+        """
+        if self.loop is None or self.loop.is_closed() or not self.active_connections:
+            return
+        self.loop.call_soon_threadsafe(self.broadcast_nowait, message, coalesce_key, only, merge)
+
+    def stats(self) -> list[dict]:
+        return [connection.stats() for connection in self.active_connections.values()]
+
+    async def __write(self, connection: WebSocketConnection):
+        try:
+            await connection.run_writer()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"WebSocket writer stopped: {e}")
+            self.disconnect(connection.websocket)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules import each other as utils.X / server.X, relative to the platform directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
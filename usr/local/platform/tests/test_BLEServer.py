@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("bless")
+pytest.importorskip("msgpack")
+pytest.importorskip("cyberonics_py")
+
+from server.BLEServer import BLEServer
+from utils import WireProtocol
+from utils.Commands import StructuredResponse
+from utils.WireProtocol import MessageType, Status
+
+
+def binary_server() -> BLEServer:
+    server = object.__new__(BLEServer)
+    server.protocol = WireProtocol.BINARY
+    return server
+
+
+def test_binary_responses_encode_structured_data_natively():
+    async def handler(command: str):
+        assert command == "get-states"
+        return True, StructuredResponse({'device': {'position': 1.5}}, prefix="0,")
+
+    on_write = binary_server()._BLEServer__on_write(handler)
+    request = WireProtocol.encode(MessageType.COMMAND, "get-states", seq=9)
+    value, notify = asyncio.run(on_write(bytes(request)))
+    frame = WireProtocol.decode(value)
+    assert (frame.status, frame.seq, frame.payload) == (Status.OK, 9, {'device': {'position': 1.5}})
+
+
+def test_text_responses_keep_their_json_form():
+    async def handler(command: str):
+        return True, StructuredResponse({'a': 1}, prefix="0,")
+
+    server = binary_server()
+    server.protocol = WireProtocol.TEXT
+    value, _ = asyncio.run(server._BLEServer__on_write(handler)(b"get-states"))
+    assert value == bytearray(b'0,0,{"a":1}')
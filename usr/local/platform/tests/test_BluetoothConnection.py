@@ -0,0 +1,157 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("bless")
+pytest.importorskip("msgpack")
+
+from utils import WireProtocol
+from utils.BluetoothConnection import (
+    BluetoothConnection, BluetoothService, MessageAssembler, NotificationPriority, NotificationScheduler
+)
+from utils.WireProtocol import MessageType
+
+
+class FakeServer:
+    def __init__(self, states: list):
+        self.states = states
+
+    async def is_connected(self) -> bool:
+        return self.states.pop(0) if len(self.states) > 1 else self.states[0]
+
+
+def test_disconnect_resets_framing():
+    events = []
+    connection = BluetoothConnection()
+    connection.CONNECTION_POLL_INTERVAL = 0
+    connection.server = FakeServer([False, True, True, False])
+    connection.onDeviceConnected = lambda: events.append(("connected", connection.framed))
+    connection.onDeviceDisconnected = lambda: events.append(("disconnected", connection.framed))
+
+    async def run():
+        watcher = asyncio.create_task(connection._BluetoothConnection__watch_connection())
+        while len(events) < 1:
+            await asyncio.sleep(0)
+        # The client negotiates binary frames while connected
+        connection.framed = True
+        while len(events) < 2:
+            await asyncio.sleep(0)
+        watcher.cancel()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert events == [("connected", False), ("disconnected", False)]
+    assert not connection.connected
+
+
+@pytest.fixture
+def assembler():
+    loop = asyncio.new_event_loop()
+    yield MessageAssembler(loop, max_message_size=1024)
+    loop.close()
+
+
+def test_reassembles_frames_split_at_any_size(assembler):
+    frames = [WireProtocol.encode(MessageType.COMMAND, f"command {i}", seq=i) for i in range(3)]
+    data = b"".join(frames)
+    for size in (1, 3, 8, 13, len(data)):
+        received = []
+        for start in range(0, len(data), size):
+            received += assembler.feed(data[start:start + size])
+        assert [bytes(frame) for frame in received] == [bytes(frame) for frame in frames]
+
+
+def test_drops_oversized_frames(assembler):
+    frame = WireProtocol.encode(MessageType.COMMAND, "x" * 2000)
+    assert assembler.feed(frame[:WireProtocol.HEADER.size]) == []
+    assert assembler.buffer is None
+
+
+def test_legacy_message_ends_with_a_short_write(assembler):
+    size = MessageAssembler.LEGACY_CHUNK_SIZE
+    assert assembler.feed_legacy(b"a" * size) == []
+    assert assembler.feed_legacy(b"b") == [bytearray(b"a" * size + b"b")]
+
+
+def test_frames_are_cut_to_the_mtu():
+    connection = BluetoothConnection(mtu=23)
+    chunks = list(connection._BluetoothConnection__chunks(bytearray(range(45)), True))
+    assert [len(chunk) for chunk in chunks] == [20, 20, 5]
+    assert b"".join(chunks) == bytes(range(45))
+
+
+def test_text_keeps_legacy_chunks_and_terminator():
+    connection = BluetoothConnection(mtu=23)
+    chunks = list(connection._BluetoothConnection__chunks(bytearray(b"x" * 500), False))
+    assert [len(chunk) for chunk in chunks] == [250, 250, 0]
+
+
+class RecordingServer:
+    def __init__(self):
+        self.notified = []
+        self.characteristics = {}
+
+    def get_characteristic(self, characteristic_uuid: str):
+        return self.characteristics.setdefault(characteristic_uuid, type("Characteristic", (), {'value': None})())
+
+    def update_value(self, service_uuid: str, characteristic_uuid: str):
+        self.notified.append((characteristic_uuid, bytes(self.characteristics[characteristic_uuid].value)))
+
+
+def chunk_by_10(value: bytearray, framed: bool):
+    return [value[i:i + 10] for i in range(0, len(value), 10)]
+
+
+def test_responses_go_ahead_of_queued_logs_on_other_characteristics():
+    scheduler = NotificationScheduler()
+    for i in range(20):
+        scheduler.put("log", bytearray(f"log {i}", "utf-8"), True, NotificationPriority.LOG)
+    scheduler.put("device", bytearray(b"state"), True, NotificationPriority.STATE)
+    scheduler.put("comm", bytearray(b"reply"), True, NotificationPriority.RESPONSE)
+    assert [scheduler.next_chunk(chunk_by_10)[0] for _ in range(3)] == ["comm", "device", "log"]
+
+
+def test_a_response_cuts_in_between_chunks_but_messages_never_interleave():
+    scheduler = NotificationScheduler()
+    scheduler.put("log", bytearray(b"a" * 30), True, NotificationPriority.LOG)
+    scheduler.put("log", bytearray(b"b" * 10), True, NotificationPriority.LOG)
+    assert scheduler.next_chunk(chunk_by_10) == ("log", bytearray(b"a" * 10))
+    scheduler.put("comm", bytearray(b"reply"), True, NotificationPriority.RESPONSE)
+    assert scheduler.next_chunk(chunk_by_10) == ("comm", bytearray(b"reply"))
+    rest = [scheduler.next_chunk(chunk_by_10) for _ in range(3)]
+    assert rest == [("log", bytearray(b"a" * 10))] * 2 + [("log", bytearray(b"b" * 10))]
+    assert scheduler.next_chunk(chunk_by_10) == (None, None)
+
+
+def test_full_scheduler_drops_logs_before_state_and_never_responses():
+    scheduler = NotificationScheduler(max_messages=3)
+    scheduler.put("comm", bytearray(b"reply"), True, NotificationPriority.RESPONSE)
+    scheduler.put("device", bytearray(b"state"), True, NotificationPriority.STATE)
+    scheduler.put("log", bytearray(b"log"), True, NotificationPriority.LOG)
+    scheduler.put("comm", bytearray(b"reply 2"), True, NotificationPriority.RESPONSE)
+    scheduler.put("comm", bytearray(b"reply 3"), True, NotificationPriority.RESPONSE)
+    stats = scheduler.stats()
+    assert (stats["log"]["dropped"], stats["device"]["dropped"], stats["comm"]["dropped"]) == (1, 1, 0)
+    assert stats["comm"]["depth"] == 3
+
+
+def test_reply_enqueued_after_a_log_flood_is_notified_first():
+    service = BluetoothService("service")
+    for characteristic_uuid in ("comm", "log"):
+        service.add_characteristic(SimpleNamespace(uuid=characteristic_uuid))
+    connection = BluetoothConnection(services=[service], connection_interval=0.001, notifications_per_interval=1)
+    connection.server = RecordingServer()
+
+    async def run():
+        connection.outbound = NotificationScheduler()
+        for i in range(50):
+            connection._BluetoothConnection__enqueue("log", bytearray(f"log {i}", "utf-8"), True, NotificationPriority.LOG)
+        connection._BluetoothConnection__enqueue("comm", bytearray(b"reply"), True, NotificationPriority.RESPONSE)
+        sender = asyncio.create_task(connection._BluetoothConnection__send())
+        while len(connection.server.notified) < 51:
+            await asyncio.sleep(0.001)
+        sender.cancel()
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert connection.server.notified[0] == ("comm", b"reply")
+    assert [uuid for uuid, _ in connection.server.notified[1:]] == ["log"] * 50
@@ -0,0 +1,70 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("cyberonics_py")
+
+from utils import Commands
+from utils.CommandCenter import command_project
+from utils.CommandScheduler import CommandClass, CommandScheduler
+from utils.Commands import Command
+from utils.EventBus import EventBus
+
+
+class FakeManifest:
+    def __init__(self, selected_project: str):
+        self.selected_project = selected_project
+
+
+class FakeCommandCenter:
+    def __init__(self):
+        self.manifest = FakeManifest("a")
+        self.selection_lock = threading.RLock()
+        self.job_started = threading.Event()
+        self.release_job = threading.Event()
+        self.ran = []
+
+    def execute(self, command: Command) -> (bool, str):
+        self.ran.append((command.name, command_project.get(), self.selection_lock._is_owned()))
+        if command.name == "pull-changes":
+            self.job_started.set()
+            assert self.release_job.wait(5)
+        return True, ""
+
+
+def test_every_classified_command_exists():
+    assert set(CommandScheduler.CLASSES) <= set(Commands.COMMANDS)
+
+
+def test_classes():
+    assert CommandScheduler.classify(Command("get-ip")) == CommandClass.READ
+    # Stopping a robot must never queue behind a project write
+    assert CommandScheduler.classify(Command("stop-execution")) == CommandClass.READ
+    assert CommandScheduler.classify(Command("set-state")) == CommandClass.READ
+    assert CommandScheduler.classify(Command("switch-project")) == CommandClass.WRITE
+    assert CommandScheduler.classify(Command("remove-project")) == CommandClass.WRITE
+    assert CommandScheduler.classify(Command("pull-changes")) == CommandClass.JOB
+    assert CommandScheduler.classify(Command("install-project")) == CommandClass.JOB
+
+
+def test_jobs_keep_their_project_and_dont_block_other_writes():
+    command_center = FakeCommandCenter()
+    scheduler = CommandScheduler(command_center, EventBus())
+
+    async def run():
+        success, job_id = await scheduler.submit(Command("pull-changes"))
+        assert success
+        assert await asyncio.to_thread(command_center.job_started.wait, 5)
+        # Another project is selected while the job runs; its writes don't wait for the job
+        command_center.manifest.selected_project = "b"
+        assert await asyncio.wait_for(scheduler.submit(Command("change-target", {'target_name': "x"})), 5) == (True, "")
+        command_center.release_job.set()
+        for _ in range(500):
+            if scheduler.jobs[job_id].finished is not None:
+                break
+            await asyncio.sleep(0.01)
+        assert scheduler.jobs[job_id].status == "succeeded"
+
+    asyncio.run(run())
+    assert command_center.ran == [("pull-changes", "a", False), ("change-target", "b", True)]
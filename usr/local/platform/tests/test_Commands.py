@@ -0,0 +1,80 @@
+import pytest
+
+from utils import Commands
+from utils.Commands import Command, CommandError
+
+
+def test_parse_converts_arguments():
+    command = Commands.parse("get-targets src 2 5")
+    assert (command.name, command.args) == ("get-targets", {'prefix': "src", 'offset': 2, 'limit': 5})
+
+
+def test_parse_fills_defaults():
+    assert Commands.parse("get-targets").args == {'prefix': "", 'offset': 0, 'limit': None}
+
+
+def test_rest_argument_keeps_spaces():
+    command = Commands.parse('set-state {"uuid": "a", "value": 1}')
+    assert command.args['state'] == {'uuid': "a", 'value': 1}
+
+
+def test_secret_arguments_are_masked():
+    command = Commands.parse("install-project demo https://example.com/demo.git my token")
+    assert command.args['token'] == "my token"
+    assert str(command) == "install-project demo https://example.com/demo.git ***"
+
+
+def test_errors():
+    with pytest.raises(CommandError, match="not recognized"):
+        Commands.parse("no-such-command")
+    with pytest.raises(CommandError, match="Usage: get-state <device_id>"):
+        Commands.parse("get-state")
+    with pytest.raises(CommandError):
+        Commands.parse("get-targets src many")
+
+
+def test_from_request_accepts_aliases():
+    command = Commands.from_request("switch-branch", {'project_id': "main"})
+    assert command.args == {'branch_name': "main"}
+
+
+def test_from_request_keeps_typed_values():
+    assert Commands.from_request("get-logs", {'after': 3}).args == {'after': 3, 'limit': None}
+    assert Commands.from_request("get-logs", {'after': "3"}).args['after'] == 3
+
+
+def test_flag():
+    assert Commands.parse("install-requirements yes").args == {'force': True}
+    assert Commands.parse("install-requirements 0").args == {'force': False}
+    with pytest.raises(CommandError):
+        Commands.parse("install-requirements maybe")
+
+
+def test_str_serializes_structured_arguments():
+    assert str(Command("get-states", {'device_ids': ["a", "b"]})) == 'get-states ["a","b"]'
+
+
+def test_last_argument_keeps_spaces():
+    assert Commands.parse("change-target ./my dir/main.py").args == {'target_name': "./my dir/main.py"}
+    assert Commands.parse("switch-project my project").args == {'project_id': "my project"}
+
+
+def test_extra_words_are_rejected():
+    with pytest.raises(CommandError, match="Usage: get-state <device_id>"):
+        Commands.parse("get-state a b")
+    with pytest.raises(CommandError):
+        Commands.parse("get-logs 1 2 3")
+
+
+def test_from_request_validates_typed_values():
+    with pytest.raises(CommandError, match="Invalid limit: must be an integer"):
+        Commands.from_request("get-logs", {'limit': [1]})
+    with pytest.raises(CommandError):
+        Commands.from_request("get-logs", {'after': True})
+    with pytest.raises(CommandError, match="Invalid device_ids: must be a list of strings"):
+        Commands.from_request("get-states", {'device_ids': [1]})
+    with pytest.raises(CommandError):
+        Commands.from_request("change-target", {'target_name': {'path': "x"}})
+    assert Commands.from_request("get-job", {'job_id': 3}).args == {'job_id': "3"}
+    assert Commands.from_request("install-requirements", {'force': True}).args == {'force': True}
+    assert Commands.from_request("set-state", {'state': {'uuid': "a"}}).args == {'state': {'uuid': "a"}}
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from utils.DependencyManager import DependencyManager, Requirements
+from utils.ShellEngine import ShellResult
+
+
+class FakeShell:
+    def __init__(self, returncode: int = 0):
+        self.returncode = returncode
+        self.commands = []
+
+    def run(self, command: str, cwd=None) -> ShellResult:
+        self.commands.append((command, cwd))
+        return ShellResult(self.returncode, "", "error" if self.returncode else "")
+
+
+def write(path, text: str) -> str:
+    with open(path, "w") as f:
+        f.write(text)
+    return str(path)
+
+
+def test_requirements_pins_options_and_includes(tmp_path):
+    write(tmp_path / "base.txt", "numpy==1.26.4  # comment\n")
+    path = write(tmp_path / "requirements.txt", (
+        "-r base.txt\n"
+        "Foo_Bar.baz>=1 ; python_version > '3'\n"
+        "\n"
+        "# only a comment\n"
+        "--index-url https://example.com/simple\n"
+        "./libs/local\n"
+        "requests \\\n"
+        "  ==2.32.3\n"
+    ))
+    requirements = Requirements(path)
+    assert requirements.pins == {
+        'numpy': "numpy==1.26.4",
+        'foo-bar-baz': "Foo_Bar.baz>=1 ; python_version > '3'",
+        './libs/local': "./libs/local",
+        'requests': "requests   ==2.32.3",
+    }
+    assert requirements.options == ["--index-url https://example.com/simple"]
+
+
+def test_requirements_include_cycles_are_read_once(tmp_path):
+    write(tmp_path / "a.txt", "-r b.txt\nflask\n")
+    write(tmp_path / "b.txt", "-r a.txt\nclick\n")
+    assert sorted(Requirements(str(tmp_path / "a.txt")).pins) == ["click", "flask"]
+
+
+@pytest.fixture
+def environment(tmp_path):
+    path = tmp_path / "venv"
+    path.mkdir()
+    return str(path)
+
+
+def test_installs_only_what_changed(tmp_path, environment):
+    shell = FakeShell()
+    manager = DependencyManager(shell, str(tmp_path / "cache"))
+    path = write(tmp_path / "requirements.txt", "flask==3.0.0\nclick==8.1.7\n")
+
+    assert manager.install(environment, path) == (True, "Installed requirements")
+    assert "-r" in shell.commands[-1][0] and shell.commands[-1][1] == str(tmp_path)
+
+    assert manager.install(environment, path) == (True, "Requirements unchanged")
+    assert len(shell.commands) == 1
+
+    write(tmp_path / "requirements.txt", "flask==3.0.3\n")
+    assert manager.install(environment, path) == (True, "Installed 1 changed requirement(s)")
+    assert shell.commands[-1][0].endswith("flask==3.0.3")
+
+    write(tmp_path / "requirements.txt", "flask==3.0.3\n\n")
+    assert manager.install(environment, path) == (True, "Requirements unchanged")
+    assert len(shell.commands) == 2
+
+
+def test_failed_install_is_retried(tmp_path, environment):
+    shell = FakeShell(returncode=1)
+    manager = DependencyManager(shell, str(tmp_path / "cache"))
+    path = write(tmp_path / "requirements.txt", "flask==3.0.0\n")
+    assert manager.install(environment, path) == (False, "error")
+
+    shell.returncode = 0
+    assert manager.install(environment, path)[0]
+    assert len(shell.commands) == 2
+    assert not os.path.exists(os.path.join(environment, DependencyManager.STATE_FILE + ".tmp"))
+
+
+def test_no_requirements(tmp_path, environment):
+    shell = FakeShell()
+    assert DependencyManager(shell, str(tmp_path)).install(environment, None) == (True, "No requirements.txt")
+    assert shell.commands == []
@@ -0,0 +1,33 @@
+import threading
+
+import pytest
+
+from utils.DeviceUpdateCoalescer import DeviceUpdateCoalescer
+from utils.StatePatch import apply_patch, diff
+
+
+def test_rejects_non_positive_rate():
+    for rate in (0, -1):
+        with pytest.raises(ValueError):
+            DeviceUpdateCoalescer(lambda batch: None, rate)
+
+
+def test_merges_updates_between_flushes():
+    batches = []
+    flushed = threading.Event()
+
+    def publish(batch):
+        batches.append(batch)
+        flushed.set()
+
+    states = [{'a': 1, 'b': 1}, {'a': 2, 'b': 1}, {'a': 2}, {'a': 3, 'c': None}]
+    coalescer = DeviceUpdateCoalescer(publish, 100)
+    # Holding the condition keeps the flush thread out until every update is in its slot
+    with coalescer._condition:
+        for version, (old, new) in enumerate(zip(states, states[1:]), start=1):
+            coalescer.submit("device", diff(old, new), version)
+    assert flushed.wait(5)
+
+    change = batches[0]["device"]
+    assert (change.base_version, change.version) == (0, 3)
+    assert apply_patch(states[0], change.patch) == states[-1]
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+
+from utils.EnvironmentManager import EnvironmentManager
+from utils.InterpreterPool import InterpreterPool
+
+
+def site_packages(environment) -> str:
+    path = environment / "lib" / "python3.11" / "site-packages"
+    path.mkdir(parents=True)
+    return str(path)
+
+
+def test_pth_adds_the_layer_as_a_site_directory(tmp_path):
+    layer_site = site_packages(tmp_path / "layer")
+    (tmp_path / "src").mkdir()
+    with open(os.path.join(layer_site, "editable.pth"), "w") as f:
+        f.write(str(tmp_path / "src") + "\n")
+    project_site = site_packages(tmp_path / "project")
+    with open(os.path.join(project_site, EnvironmentManager.PTH_FILE), "w") as f:
+        f.write(f"import site; site.addsitedir({layer_site!r})\n")
+
+    assert EnvironmentManager.layer_site_packages(str(tmp_path / "project")) == layer_site
+    path = subprocess.run(
+        [sys.executable, "-c", f"import site, sys; site.addsitedir({project_site!r}); print(sys.path)"],
+        capture_output=True, text=True, check=True
+    ).stdout
+    # The layer's own .pth files are processed too
+    assert layer_site in path and str(tmp_path / "src") in path
+
+
+def test_reads_the_bare_path_older_venvs_hold(tmp_path):
+    project_site = site_packages(tmp_path / "project")
+    with open(os.path.join(project_site, EnvironmentManager.PTH_FILE), "w") as f:
+        f.write("/layers/abc/lib/python3.11/site-packages\n")
+    assert EnvironmentManager.layer_site_packages(str(tmp_path / "project")) == "/layers/abc/lib/python3.11/site-packages"
+    assert EnvironmentManager.layer_site_packages(str(tmp_path / "missing")) is None
+
+
+def test_interpreter_signature_changes_with_the_layer(tmp_path):
+    layer_site = site_packages(tmp_path / "layer")
+    project_site = site_packages(tmp_path / "project")
+    with open(os.path.join(project_site, EnvironmentManager.PTH_FILE), "w") as f:
+        f.write(f"import site; site.addsitedir({layer_site!r})\n")
+    signature = InterpreterPool._InterpreterPool__signature(str(tmp_path / "project"))
+    assert layer_site in [path for path, _ in signature]
+
+    os.utime(layer_site, ns=(0, 0))
+    assert InterpreterPool._InterpreterPool__signature(str(tmp_path / "project")) != signature
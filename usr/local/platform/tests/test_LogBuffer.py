@@ -0,0 +1,20 @@
+from utils.LogBuffer import LogRingBuffer
+
+
+def test_since_pages_through_records():
+    buffer = LogRingBuffer()
+    for i in range(10):
+        buffer.record("stdout", f"line {i}\n", 1)
+    page = buffer.since(3, limit=4)
+    assert [record['seq'] for record in page['records']] == [4, 5, 6, 7]
+    assert (page['first_seq'], page['last_seq']) == (1, 10)
+    assert buffer.since(10)['records'] == []
+
+
+def test_since_reports_evicted_output():
+    buffer = LogRingBuffer(max_records=3)
+    for i in range(5):
+        buffer.record("stderr", "x", 1)
+    page = buffer.since(0)
+    assert page['first_seq'] == 3
+    assert [record['seq'] for record in page['records']] == [3, 4, 5]
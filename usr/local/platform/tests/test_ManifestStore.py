@@ -0,0 +1,82 @@
+import atexit
+import json
+import os
+
+from utils.ManifestStore import ManifestStore
+
+
+def read(path) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def count_writes(monkeypatch, path) -> list:
+    writes = []
+    replace = os.replace
+
+    def counting_replace(source, destination):
+        if os.path.abspath(destination) == os.path.abspath(path):
+            writes.append(source)
+        replace(source, destination)
+    monkeypatch.setattr(os, "replace", counting_replace)
+    return writes
+
+
+def test_changes_are_coalesced_into_one_write(tmp_path, monkeypatch):
+    path = str(tmp_path / "manifest.json")
+    store = ManifestStore(path, write_delay=60)
+    writes = count_writes(monkeypatch, path)
+    store.add_project({'id': "a", 'target': ""})
+    store.add_project({'id': "b", 'target': ""})
+    store.set_selected_project("b")
+    store.set_project_field("a", "target", "./main.py")
+    # Served from memory before anything is written
+    assert store.selected_project == "b"
+    assert writes == []
+
+    store.flush()
+    assert len(writes) == 1
+    assert read(path) == {
+        'projects': [{'id': "a", 'target': "./main.py"}, {'id': "b", 'target': ""}],
+        'selected_project': "b"
+    }
+    store.flush()
+    assert len(writes) == 1
+
+
+def test_write_behind_fires_after_the_delay(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    store = ManifestStore(path, write_delay=0.01)
+    store.set_selected_project("a")
+    store._write_timer.join(5)
+    assert read(path) == {'selected_project': "a"}
+
+
+def test_external_edits_are_picked_up(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    with open(path, "w") as f:
+        json.dump({'name': "robot"}, f)
+    store = ManifestStore(path)
+    assert store.get("name") == "robot"
+
+    with open(path, "w") as f:
+        json.dump({'name': "renamed", 'projects': [{'id': "a", 'target': ""}]}, f)
+    stat = os.stat(path)
+    # Make sure the change is visible even on filesystems with coarse mtimes
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert store.get("name") == "renamed"
+    assert store.project_ids() == ["a"]
+
+
+def test_pending_changes_are_flushed_at_exit(tmp_path, monkeypatch):
+    registered = []
+    monkeypatch.setattr(atexit, "register", registered.append)
+    path = str(tmp_path / "manifest.json")
+    store = ManifestStore(path, write_delay=60)
+    assert registered == [store.flush]
+
+    store.set_selected_project("a")
+    assert not os.path.exists(path)
+    for callback in registered:
+        callback()
+    assert read(path) == {'selected_project': "a"}
@@ -0,0 +1,103 @@
+import os
+import weakref
+
+import pytest
+
+pytest.importorskip("cyberonics_py")
+
+from utils.DeviceManager import DeviceManager
+from utils.RobotLoader import RobotLoader
+
+ROBOT = """
+from cyberonics_py import Robot
+
+
+class TestRobot(Robot):
+    label = {label!r}
+    devices = []
+"""
+
+
+def write_robot(directory, label: str = "a") -> str:
+    directory.mkdir(exist_ok=True)
+    path = directory / "robot.py"
+    path.write_text(ROBOT.format(label=label))
+    return str(path)
+
+
+class FakeDevice:
+    def __init__(self, uuid: str):
+        self.uuid = uuid
+        self.listeners = []
+
+    def get_state(self) -> dict:
+        return {'on': False}
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+
+class FakeRobot:
+    def __init__(self):
+        self.devices = [FakeDevice("1")]
+
+
+def test_loaded_robot_is_kept_until_its_source_changes(tmp_path):
+    loader = RobotLoader()
+    path = write_robot(tmp_path / "a")
+    robot = loader.load(path)
+    assert loader.current(path) is robot
+
+    write_robot(tmp_path / "a", "edited")
+    os.utime(path, ns=(0, 0))
+    assert loader.current(path) is None
+    assert loader.load(path).label == "edited"
+
+
+def test_released_robot_is_freed(tmp_path):
+    loader = RobotLoader()
+    first = weakref.ref(loader.load(write_robot(tmp_path / "a")))
+    second = weakref.ref(loader.load(write_robot(tmp_path / "b")))
+    assert first() is None
+    loader.release()
+    assert second() is None
+
+
+def test_switching_back_builds_a_new_robot_from_cached_code(tmp_path):
+    manager = DeviceManager(lambda uuid, patch, version: None)
+    a, b = write_robot(tmp_path / "a"), write_robot(tmp_path / "b")
+    manager.listen_to_robot(a)
+    robot = manager.robot
+    manager.listen_to_robot(a)
+    assert manager.robot is robot
+
+    manager.listen_to_robot(b)
+    manager.listen_to_robot(a)
+    assert manager.robot is not robot
+    assert list(manager.loader._code) == [os.path.abspath(b), os.path.abspath(a)]
+
+
+def test_reattaching_does_not_add_a_second_listener():
+    manager = DeviceManager(lambda uuid, patch, version: None)
+    robot = FakeRobot()
+    manager.attach_robot(robot)
+    manager.attach_robot(robot)
+    assert len(robot.devices[0].listeners) == 1
+
+
+def test_deloaded_robot_devices_are_freed_before_the_next_load(tmp_path):
+    devices = []
+    freed = []
+
+    class RecordingLoader(RobotLoader):
+        def release(self):
+            super().release()
+            freed.extend(device() is None for device in devices)
+
+    manager = DeviceManager(lambda uuid, patch, version: None, loader=RecordingLoader())
+    manager.listen_to_robot(write_robot(tmp_path / "a"))
+    manager.robot.devices = [FakeDevice("1")]
+    manager.attach_robot(manager.robot, manager.robot_path)
+    devices.append(weakref.ref(manager.robot.devices[0]))
+    manager.deload_robot()
+    assert freed == [True]
@@ -0,0 +1,77 @@
+import random
+
+from utils.StatePatch import apply_patch, compose, diff
+
+
+def random_value(rng: random.Random, depth: int = 0):
+    if depth < 2 and rng.random() < 0.3:
+        return {rng.choice("abcd"): random_value(rng, depth + 1) for _ in range(rng.randint(0, 3))}
+    return rng.choice([None, 0, 1, "x", [1, 2]])
+
+
+def random_state(rng: random.Random) -> dict:
+    return {rng.choice("abcde"): random_value(rng) for _ in range(rng.randint(0, 4))}
+
+
+def test_diff_holds_only_changes():
+    patch = diff({'a': 1, 'b': {'c': 2, 'd': 3}}, {'a': 1, 'b': {'c': 2, 'd': 4}})
+    assert patch == {'set': {'b': {'d': 4}}, 'delete': []}
+
+
+def test_none_is_a_value_not_a_deletion():
+    old = {'a': 1, 'b': 2}
+    new = {'a': None}
+    patch = diff(old, new)
+    assert patch == {'set': {'a': None}, 'delete': [['b']]}
+    assert apply_patch(old, patch) == new
+
+
+def test_apply_replaces_a_scalar_with_a_dict():
+    assert apply_patch({'a': 1}, {'set': {'a': {'b': None}}, 'delete': []}) == {'a': {'b': None}}
+
+
+def test_apply_inverts_diff():
+    rng = random.Random(1)
+    for _ in range(2000):
+        old, new = random_state(rng), random_state(rng)
+        assert apply_patch(old, diff(old, new)) == new
+
+
+def test_compose_readds_a_deleted_key_as_a_replacement():
+    state = {'a': {'old': 1}}
+    first = diff(state, {})
+    second = diff({}, {'a': {'new': 2}})
+    assert apply_patch(state, compose(first, second)) == {'a': {'new': 2}}
+
+
+def test_compose_deletes_inside_a_replacement():
+    state = {'a': 1}
+    middle = {'a': {'b': 1, 'c': 2}}
+    first = diff(state, middle)
+    second = diff(middle, {'a': {'b': 1}})
+    assert apply_patch(state, compose(first, second)) == {'a': {'b': 1}}
+
+
+def test_compose_replaces_a_dict_set_over_a_scalar():
+    state = {'a': {'old': 1}}
+    first = diff(state, {'a': 5})
+    second = diff({'a': 5}, {'a': {'new': 2}})
+    assert apply_patch(state, compose(first, second)) == {'a': {'new': 2}}
+
+
+def test_compose_matches_sequential_application():
+    rng = random.Random(2)
+    for _ in range(5000):
+        states = [random_state(rng) for _ in range(4)]
+        patches = [diff(old, new) for old, new in zip(states, states[1:])]
+        composed = compose(compose(patches[0], patches[1]), patches[2])
+        sequential = apply_patch(apply_patch(apply_patch(states[0], patches[0]), patches[1]), patches[2])
+        assert apply_patch(states[0], composed) == sequential == states[3]
+
+
+def test_composed_patch_is_idempotent():
+    rng = random.Random(3)
+    for _ in range(2000):
+        s, t, u = random_state(rng), random_state(rng), random_state(rng)
+        composed = compose(diff(s, t), diff(t, u))
+        assert apply_patch(apply_patch(s, composed), composed) == u
@@ -0,0 +1,90 @@
+import random
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("cyberonics_py")
+
+from server.TCPServer import TCPServer
+from utils.DeviceUpdateCoalescer import DeviceUpdateCoalescer
+from utils.StatePatch import apply_patch, diff
+
+merge_device_patches = TCPServer._TCPServer__merge_device_patches
+merge_device_updates = TCPServer._TCPServer__merge_device_updates
+
+
+def patch_message(device: str, base_version: int, version: int, patch: dict) -> dict:
+    return {'type': 'device_patch', 'devices': {device: {'base_version': base_version, 'version': version, 'patch': patch}}}
+
+
+def test_merged_patches_apply_like_the_originals():
+    rng = random.Random(3)
+    states = [{key: rng.randint(0, 3) for key in rng.sample("abcdef", 3)} for _ in range(6)]
+    message = patch_message("d", 0, 1, diff(states[0], states[1]))
+    for version in range(2, len(states)):
+        message = merge_device_patches(message, patch_message("d", version - 1, version, diff(states[version - 1], states[version])))
+    update = message['devices']['d']
+    assert (update['base_version'], update['version']) == (0, len(states) - 1)
+    assert apply_patch(states[0], update['patch']) == states[-1]
+
+
+def test_patch_onto_a_queued_snapshot():
+    first = {'type': 'device_patch', 'devices': {'d': {'state': {'a': 1}, 'version': 4}, 'e': {'state': {'x': 1}, 'version': 2}}}
+    merged = merge_device_patches(first, patch_message("d", 4, 5, diff({'a': 1}, {'a': 2})))
+    assert merged['devices'] == {'d': {'state': {'a': 2}, 'version': 5}, 'e': {'state': {'x': 1}, 'version': 2}}
+
+
+def test_patch_after_a_gap_replaces_the_queued_one():
+    merged = merge_device_patches(patch_message("d", 0, 1, {'set': {'a': 1}, 'delete': []}),
+                                  patch_message("d", 3, 4, {'set': {'a': 4}, 'delete': []}))
+    assert merged['devices']['d']['base_version'] == 3
+
+
+def test_full_updates_keep_every_device():
+    first = {'type': 'device_update', 'state': {'d': 1, 'e': 1}, 'versions': {'d': 1, 'e': 1}}
+    second = {'type': 'device_update', 'state': {'d': 2}, 'versions': {'d': 2}}
+    assert merge_device_updates(first, second) == {'type': 'device_update', 'state': {'d': 2, 'e': 1}, 'versions': {'d': 2, 'e': 1}}
+
+
+class FakeDeviceManager:
+    def __init__(self, devices: dict):
+        self.devices = devices
+
+    def snapshot(self, device: str) -> dict:
+        if device not in self.devices:
+            raise ValueError(f"No device with UUID {device}")
+        return {'state': self.devices[device], 'version': 1}
+
+
+class FakeWebSocketManager:
+    def __init__(self):
+        self.active_connections = {'client': None}
+        self.messages = []
+        self.sent = threading.Event()
+
+    def broadcast_threadsafe(self, message: dict, coalesce_key=None, only=None, merge=None):
+        self.messages.append(message)
+        if message['type'] == 'device_patch':
+            self.sent.set()
+
+
+def test_devices_gone_after_a_robot_swap_are_skipped():
+    device_manager = FakeDeviceManager({'a': {'x': 1}, 'b': {'y': 1}})
+    server = object.__new__(TCPServer)
+    server.runtime = SimpleNamespace(device_manager=device_manager)
+    server.device_manager = device_manager
+    server.websocket_manager = FakeWebSocketManager()
+
+    coalescer = DeviceUpdateCoalescer(server._TCPServer__send_device_updates, 100)
+    with coalescer._condition:
+        coalescer.submit('a', None, 1)
+        coalescer.submit('b', {'set': {'y': 1}, 'delete': []}, 1)
+        # The robot is swapped before the flush; 'a' no longer exists
+        device_manager.devices = {'b': {'y': 1}}
+    assert server.websocket_manager.sent.wait(5)
+
+    full, patch = server.websocket_manager.messages
+    assert full['state'] == {'b': {'y': 1}}
+    assert list(patch['devices']) == ['b']
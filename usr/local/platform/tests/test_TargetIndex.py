@@ -0,0 +1,79 @@
+import os
+import shutil
+
+import pytest
+
+from utils.TargetIndex import TargetIndex
+
+
+def write(root, path: str, text: str = ""):
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def touch_directory(root, directory: str = ""):
+    # Some filesystems have coarse mtimes; make sure a rescan sees the change
+    path = os.path.join(root, directory)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_gitignore_rules(tmp_path):
+    write(tmp_path, ".gitignore", "*.c\n!keep.c\nbuild/\n/top.py\n")
+    write(tmp_path, "main.py")
+    write(tmp_path, "drop.c")
+    write(tmp_path, "keep.c")
+    write(tmp_path, "top.py")
+    write(tmp_path, "sub/top.py")
+    write(tmp_path, "build/out.py")
+    write(tmp_path, "lib/build")
+    write(tmp_path, "lib/.gitignore", "*.cpp\n")
+    write(tmp_path, "lib/a.cpp")
+    write(tmp_path, "b.cpp")
+    write(tmp_path, ".git/hooks/x.py")
+    assert TargetIndex(str(tmp_path)).query() == ["./b.cpp", "./keep.c", "./main.py", "./sub/top.py"]
+
+
+def test_refresh_sees_added_and_removed_files(tmp_path):
+    write(tmp_path, "a.py")
+    index = TargetIndex(str(tmp_path), revalidate_interval=0)
+    assert index.query() == ["./a.py"]
+
+    write(tmp_path, "pkg/b.py")
+    touch_directory(tmp_path)
+    assert index.query() == ["./a.py", "./pkg/b.py"]
+
+    shutil.rmtree(os.path.join(tmp_path, "pkg"))
+    os.remove(os.path.join(tmp_path, "a.py"))
+    write(tmp_path, "c.py")
+    touch_directory(tmp_path)
+    assert index.query() == ["./c.py"]
+
+
+def test_rescans_a_project_that_comes_back(tmp_path):
+    root = os.path.join(tmp_path, "project")
+    write(root, "a.py")
+    index = TargetIndex(root, revalidate_interval=0)
+    assert index.query() == ["./a.py"]
+    shutil.rmtree(root)
+    assert index.query() == []
+    write(root, "b.py")
+    assert index.query() == ["./b.py"]
+
+
+def test_query_prefix_and_pages(tmp_path):
+    for name in ("a.py", "b/c.py", "b/d.py", "e.py"):
+        write(tmp_path, name)
+    index = TargetIndex(str(tmp_path))
+    assert index.query("b/") == ["./b/c.py", "./b/d.py"]
+    assert index.query(offset=1, limit=2) == ["./b/c.py", "./b/d.py"]
+    with pytest.raises(ValueError):
+        index.query(offset=-1)
+
+
+def test_find_returns_the_shallowest_first(tmp_path):
+    write(tmp_path, "sub/requirements.txt")
+    write(tmp_path, "requirements.txt")
+    assert TargetIndex(str(tmp_path)).find("requirements.txt") == ["./requirements.txt", "./sub/requirements.txt"]
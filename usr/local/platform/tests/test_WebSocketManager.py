@@ -0,0 +1,39 @@
+import pytest
+
+pytest.importorskip("fastapi")
+
+from server.WebSocketManager import WebSocketConnection
+from utils import Serialization
+
+
+class FakeWebSocket:
+    client = None
+
+
+def merge(first: dict, second: dict) -> dict:
+    return {'values': first['values'] + second['values']}
+
+
+def test_queued_messages_with_a_key_are_merged():
+    connection = WebSocketConnection(FakeWebSocket())
+    for value in range(3):
+        message = {'values': [value]}
+        connection.enqueue(Serialization.dumps_str(message), 'key', merge=merge, source=message)
+    connection.enqueue({'log': 1})
+    assert [entry[1] for entry in connection.queue] == [{'values': [0, 1, 2]}, {'log': 1}]
+    assert connection.coalesced == 2
+
+
+def test_queued_message_is_replaced_without_merge():
+    connection = WebSocketConnection(FakeWebSocket())
+    connection.enqueue("first", 'key')
+    connection.enqueue("second", 'key')
+    assert [entry[1] for entry in connection.queue] == ["second"]
+
+
+def test_replies_are_kept_when_the_queue_is_full():
+    connection = WebSocketConnection(FakeWebSocket(), max_queue=2)
+    connection.enqueue({'reply': 1}, droppable=False)
+    connection.enqueue({'log': 1})
+    connection.enqueue({'log': 2})
+    assert [entry[1] for entry in connection.queue] == [{'reply': 1}, {'log': 2}]
@@ -0,0 +1,35 @@
+import pytest
+
+from utils import WireProtocol
+from utils.Commands import StructuredResponse
+from utils.WireProtocol import MessageType, Status
+
+pytest.importorskip("msgpack")
+
+
+def test_round_trip():
+    frame = WireProtocol.decode(WireProtocol.encode(MessageType.RESPONSE, {'a': [1, "x"]}, Status.ERROR, seq=7))
+    assert (frame.type, frame.status, frame.seq, frame.payload) == (MessageType.RESPONSE, Status.ERROR, 7, {'a': [1, "x"]})
+
+
+def test_seq_wraps_to_16_bits():
+    assert WireProtocol.decode(WireProtocol.encode(MessageType.COMMAND, "get-ip", seq=0x10001)).seq == 1
+
+
+def test_frame_length_reads_the_header():
+    data = WireProtocol.encode(MessageType.STDOUT, [1, "hello"])
+    assert WireProtocol.frame_length(data[:WireProtocol.HEADER.size]) == len(data)
+
+
+def test_decode_rejects_short_and_mismatched_frames():
+    data = WireProtocol.encode(MessageType.COMMAND, "get-ip")
+    for bad in (data[:4], data[:-1], data + b"\x00"):
+        with pytest.raises(ValueError):
+            WireProtocol.decode(bad)
+
+
+def test_structured_responses_are_encoded_as_data():
+    response = StructuredResponse({'a': {'b': 1}}, prefix="0,")
+    assert str(response) == '0,{"a":{"b":1}}'
+    frame = WireProtocol.decode(WireProtocol.encode(MessageType.RESPONSE, response.value))
+    assert frame.payload == {'a': {'b': 1}}
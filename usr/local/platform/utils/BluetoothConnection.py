@@ -1,8 +1,11 @@
 import sys
+import time
 import logging
 import asyncio
+import functools
 import threading
-from typing import Any, Union, Optional, List
+from collections import deque
+from typing import Any, Callable, Iterable, Union, Optional, List
 from bless import (
     BlessServer,
     BlessGATTCharacteristic,
@@ -10,6 +13,13 @@ from bless import (
     GATTAttributePermissions,
 )
 
+from utils import Metrics, WireProtocol
+
+BLE_MESSAGES = Metrics.counter("platform_ble_messages_total", "Messages sent as notifications", ("characteristic",))
+BLE_CHUNKS = Metrics.counter("platform_ble_chunks_total", "Notifications (chunks) sent", ("characteristic",))
+BLE_DROPPED = Metrics.counter("platform_ble_dropped_total", "Messages dropped from a full outbound queue", ("characteristic",))
+BLE_QUEUE_DEPTH = Metrics.gauge("platform_ble_queue_depth", "Messages waiting to be notified", ("characteristic",))
+
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(name=__name__)
 
@@ -46,10 +56,284 @@ class BluetoothService:
         self.characteristics.append(characteristic)
 
 
+class MessageAssembler:
+    """
+    Reassembles the writes to one characteristic into whole messages.
+
+    Framed (binary protocol) writes are driven by the length in each frame header: the first chunk allocates
+    a buffer of exactly the frame's size and later chunks are copied into it through a memoryview, so
+    chunk sizes don't matter and several frames may share one write. Unframed (text) writes keep the legacy
+    rule that a write shorter than LEGACY_CHUNK_SIZE ends the message. Either way, a partial message that
+    sees no new data for `timeout` seconds is dropped and its buffer freed.
+    """
+
+    LEGACY_CHUNK_SIZE = 250
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, timeout: float = 5.0, max_message_size: int = 1 << 20):
+        self.loop = loop
+        self.timeout = timeout
+        self.max_message_size = max_message_size
+        self.header = bytearray()
+        self.buffer: Optional[bytearray] = None
+        self.filled = 0
+        self.expired = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def feed(self, data: bytes) -> List[bytearray]:
+        """
+        Consumes one framed write and returns the frames it completed.
+        """
+        messages = []
+        view = memoryview(data)
+        while view:
+            if self.buffer is None:
+                needed = WireProtocol.HEADER.size - len(self.header)
+                self.header += view[:needed]
+                view = view[needed:]
+                if len(self.header) < WireProtocol.HEADER.size:
+                    break
+                length = WireProtocol.frame_length(self.header)
+                if length > self.max_message_size:
+                    logger.warning(f"Dropping {length} byte frame, larger than {self.max_message_size}")
+                    self.reset()
+                    return messages
+                self.buffer = bytearray(length)
+                self.buffer[:len(self.header)] = self.header
+                self.filled = len(self.header)
+                self.header = bytearray()
+
+            count = min(len(view), len(self.buffer) - self.filled)
+            self.buffer[self.filled:self.filled + count] = view[:count]
+            self.filled += count
+            view = view[count:]
+            if self.filled == len(self.buffer):
+                messages.append(self.buffer)
+                self.buffer = None
+                self.filled = 0
+        self.__schedule_expiry()
+        return messages
+
+    def feed_legacy(self, data: bytes) -> List[bytearray]:
+        """
+        Consumes one unframed write and returns the message it completed, if any.
+        """
+        if self.buffer is None:
+            self.buffer = bytearray()
+        if len(self.buffer) + len(data) > self.max_message_size:
+            logger.warning(f"Dropping message larger than {self.max_message_size} bytes")
+            self.reset()
+            return []
+        self.buffer += data
+        if len(data) == self.LEGACY_CHUNK_SIZE:
+            self.__schedule_expiry()
+            return []
+        message = self.buffer
+        self.reset()
+        return [message]
+
+    def reset(self):
+        self.header = bytearray()
+        self.buffer = None
+        self.filled = 0
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def __schedule_expiry(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.buffer is not None or self.header:
+            self._timer = self.loop.call_later(self.timeout, self.__expire)
+
+    def __expire(self):
+        self._timer = None
+        self.expired += 1
+        logger.warning("Dropping partial message after timeout")
+        self.reset()
+
+
+class NotificationPriority:
+    # Replies to the client's own commands; never dropped
+    RESPONSE = 0
+    # Device state
+    STATE = 1
+    # Program output and job events
+    LOG = 2
+
+
+class NotificationPacer:
+    """
+    Token bucket shared by every characteristic on the link: at most `burst` notifications per connection
+    interval. Sending faster than the controller can drain only overflows its buffers and loses packets.
+    Used only from the BLE event loop.
+    """
+
+    def __init__(self, connection_interval: float, burst: int):
+        self.connection_interval = connection_interval
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.burst / self.connection_interval)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.connection_interval / self.burst)
+
+
+class NotificationStats:
+    def __init__(self):
+        # Messages waiting, kept as a count so metrics can read it from another thread
+        self.depth = 0
+        self.sent = 0
+        self.notifications = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+
+class NotificationScheduler:
+    """
+    Every outbound message on the link, owned by the BLE event loop.
+
+    The link has one notification budget (see NotificationPacer), so priorities are decided across
+    characteristics: each time a notification may be sent, it goes to the highest priority message waiting
+    on any characteristic, oldest first within a priority. A message's chunks are never interleaved with
+    another message on the same characteristic, but a response can go out between two chunks of a long log
+    message on another one. When more than max_messages are waiting, the oldest message of the lowest
+    priority present is dropped; responses are never dropped.
+    """
+
+    def __init__(self, max_messages: int = 256):
+        self.max_messages = max_messages
+        # Entries are (seq, characteristic_uuid, value, framed)
+        self.queues = {
+            NotificationPriority.RESPONSE: deque(),
+            NotificationPriority.STATE: deque(),
+            NotificationPriority.LOG: deque(),
+        }
+        # characteristic_uuid -> [priority, seq, chunks, next chunk index] of its partly sent message
+        self.sending: dict[str, list] = {}
+        self.characteristics: dict[str, NotificationStats] = {}
+        self.ready = asyncio.Event()
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def depth(self, characteristic_uuid: str) -> int:
+        stats = self.characteristics.get(characteristic_uuid)
+        return stats.depth if stats is not None else 0
+
+    def put(self, characteristic_uuid: str, value: bytearray, framed: bool, priority: int):
+        if len(self) >= self.max_messages:
+            self.__drop_oldest()
+        self._seq += 1
+        self.queues[priority].append((self._seq, characteristic_uuid, value, framed))
+        stats = self.__stats(characteristic_uuid)
+        stats.depth += 1
+        stats.max_depth = max(stats.max_depth, stats.depth)
+        self.ready.set()
+
+    async def wait(self):
+        """
+        Returns once there is something to send.
+        """
+        while not self.sending and not len(self):
+            self.ready.clear()
+            await self.ready.wait()
+
+    def next_chunk(self, chunker: Callable[[bytearray, bool], Iterable[bytearray]]) -> (Optional[str], Optional[bytearray]):
+        """
+        Takes the next chunk to notify and the characteristic it goes to, or (None, None) if nothing is waiting.
+
+        :param chunker: Splits a message (value, framed) into notifications.
+        """
+        best = None
+        for characteristic_uuid, (priority, seq, _, _) in self.sending.items():
+            if best is None or (priority, seq) < best[:2]:
+                best = (priority, seq, characteristic_uuid, None)
+        for priority in sorted(self.queues):
+            if best is not None and best[0] < priority:
+                break
+            for entry in self.queues[priority]:
+                if entry[1] not in self.sending:
+                    if best is None or (priority, entry[0]) < best[:2]:
+                        best = (priority, entry[0], entry[1], entry)
+                    break
+        if best is None:
+            return None, None
+
+        priority, seq, characteristic_uuid, entry = best
+        stats = self.__stats(characteristic_uuid)
+        if entry is not None:
+            self.queues[priority].remove(entry)
+            stats.depth -= 1
+            self.sending[characteristic_uuid] = [priority, seq, list(chunker(entry[2], entry[3])), 0]
+        message = self.sending[characteristic_uuid]
+        chunk = message[2][message[3]]
+        message[3] += 1
+        stats.notifications += 1
+        if message[3] == len(message[2]):
+            del self.sending[characteristic_uuid]
+            stats.sent += 1
+            BLE_MESSAGES.inc(characteristic=characteristic_uuid)
+        return characteristic_uuid, chunk
+
+    def abort(self, characteristic_uuid: str):
+        """
+        Gives up on the rest of the message partly sent on the characteristic, e.g. after a failed notify.
+        """
+        self.sending.pop(characteristic_uuid, None)
+
+    def stats(self) -> dict:
+        return {
+            characteristic_uuid: {
+                'depth': stats.depth,
+                'max_depth': stats.max_depth,
+                'sent': stats.sent,
+                'notifications': stats.notifications,
+                'dropped': stats.dropped
+            }
+            for characteristic_uuid, stats in self.characteristics.items()
+        }
+
+    def __stats(self, characteristic_uuid: str) -> NotificationStats:
+        stats = self.characteristics.get(characteristic_uuid)
+        if stats is None:
+            stats = self.characteristics[characteristic_uuid] = NotificationStats()
+        return stats
+
+    def __drop_oldest(self):
+        for priority in sorted(self.queues, reverse=True):
+            if priority != NotificationPriority.RESPONSE and self.queues[priority]:
+                _, characteristic_uuid, _, _ = self.queues[priority].popleft()
+                stats = self.__stats(characteristic_uuid)
+                stats.depth -= 1
+                stats.dropped += 1
+                BLE_DROPPED.inc(characteristic=characteristic_uuid)
+                return
+        # Only responses are queued; let the queue grow rather than lose a reply
+
+
 class BluetoothConnection:
+    # Payload size used when the MTU is unknown; also what existing clients chunk their writes at
+    DEFAULT_CHUNK_SIZE = 250
+    # ATT header bytes taken from every notification/write
+    ATT_OVERHEAD = 3
+    # Seconds between checks of whether a client is connected; bless has no connect/disconnect callbacks
+    CONNECTION_POLL_INTERVAL = 1.0
+
     def __init__(self,
                  device_name: str = "robot",
-                 services: list[BluetoothService] = None):
+                 services: list[BluetoothService] = None,
+                 mtu: Optional[int] = None,
+                 connection_interval: float = 0.03,
+                 notifications_per_interval: int = 4):
 
         if services is None:
             services = list()
@@ -59,9 +343,21 @@ class BluetoothConnection:
         self.server: Optional[BlessServer] = None
         self.loop = None
 
+        # Negotiated ATT MTU. BlueZ passes it in the options of each read/write on newer backends; until one
+        # arrives the constructor value (or the legacy 250 byte chunking) is used
+        self.mtu = mtu
+        # True once the client switched to length-prefixed frames (WireProtocol.BINARY). Reset on disconnect
+        self.framed = False
+        self.connected = False
+        # Called on the BLE loop when a client connects or disconnects
+        self.onDeviceConnected: Optional[Callable[[], None]] = None
+        self.onDeviceDisconnected: Optional[Callable[[], None]] = None
+
         self.characteristics = dict()
-        self.buffers = dict()
-        self.buffer_timestamps = dict()
+        self.assemblers = dict()
+        # Created on the BLE loop in _run_server; every notification goes through it
+        self.outbound: Optional[NotificationScheduler] = None
+        self.pacer = NotificationPacer(connection_interval, notifications_per_interval)
         self.service_for_characteristic = dict()
 
         for service in services:
@@ -81,20 +377,85 @@ class BluetoothConnection:
             logger.info("Server interrupted, stopping...")
             self.stop()
 
-    def update_and_notify(self, characteristic_uuid: str, value: bytearray):
-        characteristic = self.characteristics[characteristic_uuid]
-        chunk_size = 250
-        for i in range(0, len(value), chunk_size):
-            chunk = value[i:i + chunk_size]
-            self.server.get_characteristic(characteristic.uuid).value = chunk
-            self.server.update_value(self.service_for_characteristic[characteristic_uuid].uuid, characteristic_uuid)
-        # If the last chunk is exactly 250 characters, send an empty message
-        if len(value) % chunk_size == 0:
-            self.server.get_characteristic(characteristic.uuid).value = bytearray('', 'utf-8')
-            self.server.update_value(
-                self.service_for_characteristic[characteristic.uuid].uuid,
-                characteristic.uuid
-            )
+    @property
+    def chunk_size(self) -> int:
+        if self.mtu is None:
+            return self.DEFAULT_CHUNK_SIZE
+        return max(self.mtu - self.ATT_OVERHEAD, 20)
+
+    def update_and_notify(self, characteristic_uuid: str, value: bytearray,
+                          priority: int = NotificationPriority.LOG):
+        """
+        Queues value to be sent as notifications. Safe to call from any thread; the BLE loop does the sending.
+        """
+        if self.loop is None or self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.__enqueue, characteristic_uuid, value, self.framed, priority)
+
+    def stats(self) -> dict:
+        return self.outbound.stats() if self.outbound is not None else {}
+
+    def __enqueue(self, characteristic_uuid: str, value: bytearray, framed: bool, priority: int):
+        if self.outbound is not None and characteristic_uuid in self.characteristics:
+            self.outbound.put(characteristic_uuid, value, framed, priority)
+
+    async def __send(self):
+        while True:
+            await self.outbound.wait()
+            # Chosen only once a notification may go out, so a reply queued meanwhile isn't stuck behind logs
+            await self.pacer.acquire()
+            characteristic_uuid, chunk = self.outbound.next_chunk(self.__chunks)
+            if characteristic_uuid is None:
+                continue
+            try:
+                self.server.get_characteristic(characteristic_uuid).value = chunk
+                self.server.update_value(self.service_for_characteristic[characteristic_uuid].uuid, characteristic_uuid)
+                BLE_CHUNKS.inc(characteristic=characteristic_uuid)
+            except Exception as e:
+                logger.error(f"Failed to notify {characteristic_uuid}: {e}")
+                self.outbound.abort(characteristic_uuid)
+
+    async def __watch_connection(self):
+        while True:
+            try:
+                connected = await self.server.is_connected()
+            except Exception as e:
+                logger.error(f"Failed to check the connection: {e}")
+                connected = self.connected
+            if connected != self.connected:
+                self.__connection_changed(connected)
+            await asyncio.sleep(self.CONNECTION_POLL_INTERVAL)
+
+    def __connection_changed(self, connected: bool):
+        self.connected = connected
+        if connected:
+            callback = self.onDeviceConnected
+        else:
+            # The next client starts out unframed, and nothing it sends continues the last client's messages
+            self.framed = False
+            for assembler in self.assemblers.values():
+                assembler.reset()
+            callback = self.onDeviceDisconnected
+        if callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Connection callback failed: {e}")
+
+    def __chunks(self, value: bytearray, framed: bool):
+        """
+        Frames are cut to the MTU since their header carries the length; text keeps 250 byte chunks and the
+        empty terminator that existing clients look for.
+        """
+        chunk_size = self.chunk_size if framed else self.DEFAULT_CHUNK_SIZE
+        view = memoryview(value)
+        for i in range(0, len(view), chunk_size):
+            # bless hands the value to D-Bus as-is, so each chunk gets its own buffer; slicing the view
+            # copies each byte once instead of slicing the message and then copying again
+            yield bytearray(view[i:i + chunk_size])
+        # If the last chunk is exactly full, send an empty message
+        if not framed and len(value) % chunk_size == 0:
+            yield bytearray()
 
     def stop(self):
         logger.debug("Stopping Bluetooth server...")
@@ -116,36 +477,25 @@ class BluetoothConnection:
         characteristic = self.characteristics[characteristic.uuid]
         if characteristic.on_write is None:
             raise NotImplementedError(f"Write request for characteristic {characteristic.uuid} not implemented")
-        asyncio.create_task(self._async_write(characteristic, value))
-
-    async def _async_write(self, characteristic: BluetoothCharacteristic, value: Any):
-        v = value.decode()
-        if len(value) == 250:
-            if characteristic.uuid not in self.buffer_timestamps or asyncio.get_event_loop().time() - self.buffer_timestamps[characteristic.uuid] > 5:
-                self.buffers[characteristic.uuid] = ""
-            self.buffers[characteristic.uuid] = (self.buffers.get(characteristic.uuid) or "") + v
-            self.buffer_timestamps[characteristic.uuid] = asyncio.get_event_loop().time()
-            return
-
-        self.buffer_timestamps[characteristic.uuid] = asyncio.get_event_loop().time()
-        self.buffers[characteristic.uuid] = (self.buffers.get(characteristic.uuid) or "") + v
-        write_response = await characteristic.on_write(self.buffers[characteristic.uuid])
-        val, should_notify = write_response
-        self.buffers[characteristic.uuid] = ""
+        mtu = (kwargs.get("options") or {}).get("mtu")
+        if mtu:
+            self.mtu = int(mtu)
+
+        # Reassemble synchronously so chunks are consumed in the order they arrived
+        framed = self.framed
+        assembler = self.assemblers.get(characteristic.uuid)
+        if assembler is None:
+            assembler = MessageAssembler(asyncio.get_event_loop())
+            self.assemblers[characteristic.uuid] = assembler
+        messages = assembler.feed(value) if framed else assembler.feed_legacy(value)
+        for message in messages:
+            asyncio.create_task(self._async_write(characteristic, message, framed))
+
+    async def _async_write(self, characteristic: BluetoothCharacteristic, message: bytearray, framed: bool):
+        # The reply uses the framing the request arrived in, even if the request switched protocols
+        val, should_notify = await characteristic.on_write(message)
         if should_notify:
-            message = val
-            chunk_size = 250
-            for i in range(0, len(message), chunk_size):
-                chunk = message[i:i + chunk_size]
-                self.server.get_characteristic(characteristic.uuid).value = chunk
-                self.server.update_value(self.service_for_characteristic[characteristic.uuid].uuid, characteristic.uuid)
-            # If the last chunk is exactly 250 characters, send an empty message
-            if len(message) % chunk_size == 0:
-                self.server.get_characteristic(characteristic.uuid).value = bytearray('', 'utf-8')
-                self.server.update_value(
-                    self.service_for_characteristic[characteristic.uuid].uuid,
-                    characteristic.uuid
-                )
+            self.__enqueue(characteristic.uuid, val, framed, NotificationPriority.RESPONSE)
         else:
             self.server.get_characteristic(characteristic.uuid).value = val
 
@@ -177,6 +527,12 @@ class BluetoothConnection:
         logger.debug("Services: " + str([service.uuid for service in self.services]))
         await self.server.start()
 
+        self.outbound = NotificationScheduler()
+        for characteristic_uuid in self.characteristics:
+            BLE_QUEUE_DEPTH.set_function(functools.partial(self.outbound.depth, characteristic_uuid), characteristic=characteristic_uuid)
+        self.loop.create_task(self.__send())
+        self.loop.create_task(self.__watch_connection())
+
         logger.debug("Advertising Bluetooth service...")
         logger.info(f"BLE service '{self.device_name}' is now advertising")
 
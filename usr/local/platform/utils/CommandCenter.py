@@ -1,98 +1,136 @@
-import json
 import os.path
-import subprocess
+import shutil
 import socket
+import threading
+from contextvars import ContextVar
+from typing import Callable, Optional
 
+from utils import Commands, Metrics, Serialization
+from utils.Commands import Command, CommandError, StructuredResponse
 from utils.ExecutionManager import ExecutionManager
+from utils.DependencyManager import DependencyManager
 from utils.DeviceManager import DeviceManager
+from utils.EnvironmentManager import EnvironmentManager
+from utils.GitRepository import GitRepository
+from utils.ManifestStore import ManifestStore
+from utils.ShellEngine import ShellEngine, ShellResult
+from utils.TargetIndex import TargetIndex
+
+# The project a scheduled write or job was submitted for. Handlers work on it rather than on whatever is selected
+# when they run, so a job keeps its project even if install-project selects another one meanwhile.
+command_project: ContextVar[Optional[str]] = ContextVar("command_project", default=None)
 
 class CommandCenter:
 
-    def __init__(self, execution_manager: ExecutionManager, device_manager: DeviceManager):
+    def __init__(self, execution_manager: ExecutionManager, device_manager: DeviceManager, manifest: ManifestStore = None, shell: ShellEngine = None):
         self.execution_manager = execution_manager
         self.device_manager = device_manager
+        self.manifest = manifest or ManifestStore.shared()
+        self.shell = shell or ShellEngine()
+        self.repositories = {}
+        # Held by anything that changes the selected project or acts on the robot and program that go with it.
+        # CommandScheduler takes it around writes, which are short; install-project, which runs on its own
+        # executor, takes it only for its switch step. Jobs don't take it (see command_project)
+        self.selection_lock = threading.RLock()
+        self.target_indexes = {}
+        # One pip cache for every project's venv and the base layers they share
+        pip_cache = os.path.join(os.getcwd(), "pyenvs", ".pip-cache")
+        self.dependencies = DependencyManager(self.shell, pip_cache)
+        self.environments = EnvironmentManager(self.shell, os.path.join(os.getcwd(), "pyenvs"), pip_cache)
+        # Handlers receive the command's parsed arguments (see Commands.COMMANDS) as keywords
+        self.handlers = {
+            "get-ip": self.__get_ip,
+            "switch-project": self.__switch_project,
+            "list-projects": self.__list_projects,
+            "get-project": self.__get_project,
+            "get-branch": self.__get_branch,
+            "get-branches": self.__get_branches,
+            "get-commit-hash": self.__get_commit_hash,
+            "get-target": self.__get_target,
+            "get-targets": self.__get_targets,
+            "get-project-directory": self.__get_project_directory,
+            "switch-branch": self.__switch_branch,
+            "change-target": self.__change_target,
+            "pull-changes": self.__pull_changes,
+            "install-project": self.__install_project,
+            "remove-project": self.__remove_project,
+            "install-requirements": self.__install_requirements_command,
+            "execute-target": self.__execute_target,
+            "tinker": self.__tinker,
+            "stop-execution": self.__stop_execution,
+            "list-devices": self.__list_devices,
+            "set-state": self.__set_state,
+            "get-state": self.__get_state,
+            "get-snapshot": self.__get_snapshot,
+            "get-logs": self.__get_logs,
+            "get-log-stats": self.__get_log_stats,
+            "get-states": self.__get_states,
+            "set-states": self.__set_states,
+            "get-metrics": self.__get_metrics,
+            "get-run-stats": self.__get_run_stats,
+            "get-environments": self.__get_environments,
+        }
 
     def execute_command(self, command: str) -> (bool, bytearray):
-        components = command.split(" ")
-        args = "".join(components[1:])
-        match components[0]:
-            case "get-ip":
-                return self.__get_ip()
-            case "switch-project":
-                if len(components) < 2:
-                    return False, "Invalid usage. Usage: switch-project <project_id>"
-                return self.__switch_project(components[1])
-            case "list-projects":
-                return self.__list_projects()
-            case "get-project":
-                return self.__get_project()
-            case "get-branch":
-                return self.__get_branch()
-            case "get-branches":
-                return self.__get_branches()
-            case "get-commit-hash":
-                return self.__get_commit_hash()
-            case "get-target":
-                return self.__get_target()
-            case "get-targets":
-                return self.__get_targets()
-            case "get-project-directory":
-                return self.__get_project_directory()
-            case "switch-branch":
-                if len(components) < 2:
-                    return False, "Invalid usage. Usage: switch-branch <branch_name>"
-                return self.__switch_branch(components[1])
-            case "change-target":
-                if len(components) < 2:
-                    return False, "Invalid usage. Usage: switch-target <target_name>"
-                return self.__change_target(components[1])
-            case "pull-changes":
-                return self.__pull_changes()
-            case "install-project":
-                if len(components) < 3:
-                    return False, "Invalid usage. Usage: install-project <project_id> <url> [token]"
-                return self.__install_project(components[1], components[2], components[3] if len(components) > 3 else None)
-            case "execute-target":
-                return self.__execute_target()
-            case "tinker":
-                return self.__tinker()
-            case "stop-execution":
-                return self.__stop_execution()
-            case "list-devices":
-                return self.__list_devices()
-            case "set-state":
-                return self.__set_state(args)
-            case "get-state":
-                state = self.device_manager.state_for_device(components[1])
-                return True, json.dumps(state)
-            case "get-states":
-                states = self.device_manager.all_device_states
-                states_json = json.dumps(states)
-                return True, bytearray('0,' + states_json, "utf-8")
-            case _:
-                print("Unknown command: ", command)
-                return False, "Command not recognized"
-
-    def execute_shell_command(self, command: str, atRoot=False) -> (bool, str):
-        base_dir = os.getcwd()
+        """
+        Text form of execute, for callers that still speak the BLE command syntax.
+        """
+        try:
+            return self.execute(Commands.parse(command))
+        except CommandError as e:
+            return False, str(e)
+
+    def execute(self, command: Command) -> (bool, bytearray):
+        handler = self.handlers.get(command.name)
+        if handler is None:
+            print("Unknown command: ", command)
+            return False, "Command not recognized"
+        return handler(**command.args)
+
+    def execute_shell_command(self, command: str, atRoot=False, timeout: Optional[float] = None,
+                              on_output: Optional[Callable[[str, str], None]] = None) -> (bool, str):
+        """
+        Runs a shell command in the selected project's directory (or the platform root if atRoot) and blocks
+        until it finishes. Safe to call from several threads at once.
+        """
+        try:
+            cwd = self.__shell_cwd(atRoot)
+            if cwd is None:
+                return False, "No projects installed"
+            return self.__shell_response(self.shell.run(command, cwd=cwd, timeout=timeout, on_output=on_output), timeout)
+        except Exception as e:
+            return False, str(e)
+
+    async def execute_shell_command_async(self, command: str, atRoot=False, timeout: Optional[float] = None) -> (bool, str):
+        """
+        Awaitable form of execute_shell_command for the servers' event loops.
+        """
         try:
-            with open(os.getcwd() + "/manifest.json") as manifest_file:
-                project_id = json.load(manifest_file)["selected_project"]
-            if project_id is None:
+            cwd = self.__shell_cwd(atRoot)
+            if cwd is None:
                 return False, "No projects installed"
-            if not atRoot:
-                os.chdir(os.path.join(os.getcwd(), "projects", project_id))
-
-            process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-            os.chdir(base_dir)
-            if stderr:
-                return False, stderr.decode("utf-8")
-            return True, stdout.decode("utf-8")
+            return self.__shell_response(await self.shell.run_async(command, cwd=cwd, timeout=timeout), timeout)
         except Exception as e:
             return False, str(e)
-        finally:
-            os.chdir(base_dir)
+
+    def __project_id(self) -> Optional[str]:
+        return command_project.get() or self.manifest.selected_project
+
+    def __shell_cwd(self, atRoot: bool) -> Optional[str]:
+        project_id = self.__project_id()
+        if project_id is None:
+            return None
+        if atRoot:
+            return os.getcwd()
+        return os.path.join(os.getcwd(), "projects", project_id)
+
+    @staticmethod
+    def __shell_response(result: ShellResult, timeout: Optional[float]) -> (bool, str):
+        if result.timed_out:
+            return False, f"Command timed out after {timeout} seconds"
+        if result.stderr:
+            return False, result.stderr
+        return True, result.stdout
 
 
     def __get_ip(self) -> (bool, str):
@@ -109,140 +147,143 @@ class CommandCenter:
         if not project_exists:
             return False, "No projects installed"
 
-        with open(os.getcwd() + "/manifest.json") as f:
-            manifest = json.load(f)
-
-        for project in manifest["projects"]:
-            if project["id"] == project_id:
-                manifest["selected_project"] = project_id
-                with open(os.getcwd() + "/manifest.json", "w") as f:
-                    json.dump(manifest, f, indent=4)
+        if self.manifest.project(project_id) is None:
+            return False, "Project not found"
 
-                _, directory = self.__get_project_directory()
-                self.device_manager.listen_to_robot(directory + "/robot.py")
-                return True, ""
-        return False, "Project not found"
+        self.manifest.set_selected_project(project_id)
+        directory = os.path.join(os.getcwd(), "projects", project_id)
+        self.device_manager.listen_to_robot(directory + "/robot.py")
+        # Have an interpreter ready before the first execute-target
+        p = self.manifest.project(project_id)
+        if p.get("warm_start"):
+            self.execution_manager.prewarm(os.getcwd() + "/pyenvs/" + project_id, p.get("warm_imports"))
+        return True, ""
 
     def __list_projects(self) -> (bool, str):
-        with open(os.getcwd() + "/manifest.json") as f:
-            manifest = json.load(f)
-        return True, ",".join(p['id'] for p in manifest["projects"])
+        return True, ",".join(self.manifest.project_ids())
 
     def __get_project(self) -> (bool, str):
-        with open(os.getcwd() + "/manifest.json") as f:
-            manifest = json.load(f)
-        project = manifest["selected_project"]
+        project = self.__project_id()
         if project is None:
             return False, "No projects installed"
         return True, project
 
-    def __get_branch(self) -> (bool, str):
-        result, data = self.execute_shell_command("git branch")
-        if not result:
-            return False, data
-        branches = data.split("\n")
+    def __repository(self) -> GitRepository:
+        project_id = self.__project_id()
+        if project_id is None:
+            raise ValueError("No projects installed")
+        repository = self.repositories.get(project_id)
+        if repository is None:
+            repository = GitRepository(os.path.join(os.getcwd(), "projects", project_id))
+            self.repositories[project_id] = repository
+        return repository
 
-        for branch in branches:
-            if branch.startswith("*"):
-                return True, branch[2:]
-
-        return False, "Unexpected error occurred"
+    def __get_branch(self) -> (bool, str):
+        try:
+            repository = self.__repository()
+            branch = repository.current_branch()
+            if branch is None:
+                # Matches what `git branch` shows for a detached HEAD
+                return True, f"(HEAD detached at {(repository.head_commit() or '')[:7]})"
+            return True, branch
+        except (OSError, ValueError) as e:
+            return False, str(e)
 
     def __get_branches(self) -> (bool, str):
-        result, data = self.execute_shell_command("git branch -a")
-        if not result:
-            return False, data
-        branches = set()
-        for item in data.split("\n"):
-            if item.startswith("*"):
-                branches.add(item[2:].strip())
-            elif "/" in item:
-                branches.add(item[item.rindex("/") + 1:].strip())
-            else:
-                branches.add(item.strip())
-        if '' in branches:
-            branches.remove('')
+        try:
+            repository = self.__repository()
+            names = repository.local_branches() + repository.remote_branches()
+            current = repository.current_branch()
+        except (OSError, ValueError) as e:
+            return False, str(e)
+        # Remote branches are listed by their bare name, the same way local ones are
+        branches = {name[name.rindex("/") + 1:] if "/" in name else name for name in names}
+        if current is not None:
+            branches.add(current)
         alphabetical = sorted(branches, key=lambda x: x.lower())
         return True, ",".join(alphabetical)
 
     def __get_commit_hash(self) -> (bool, str):
-        result, data = self.execute_shell_command("git rev-parse HEAD")
-        if result:
-            return True, data[:7]
-        return False, data
+        try:
+            commit = self.__repository().head_commit()
+        except (OSError, ValueError) as e:
+            return False, str(e)
+        if commit is None:
+            return False, "No commits yet"
+        return True, commit[:7]
 
     def __get_target(self) -> (bool, str):
-        with open(os.getcwd() + "/manifest.json") as f:
-            manifest = json.load(f)
-        current_project = manifest["selected_project"]
-        for project in manifest["projects"]:
-            if project["id"] == current_project:
-                return True, project["target"]
-        return False, "Project not found"
+        project = self.manifest.project(self.__project_id())
+        if project is None:
+            return False, "Project not found"
+        return True, project["target"]
 
 
     def __get_project_directory(self) -> (bool, str):
-        with open(os.getcwd() + "/manifest.json") as f:
-            manifest = json.load(f)
-        current_project = manifest["selected_project"]
+        current_project = self.__project_id()
         return True, os.path.join(os.getcwd(), "projects", current_project)
 
-    def __get_targets(self) -> (bool, str):
-        result, data = self.execute_shell_command("find . -type f \\( -name '*.py' -o -name '*.c' -o -name '*.cpp' \\)")
-        if not result:
-            return False, data
-        return True, data.replace("\n", ",").strip(",")
+    def __target_index(self, project_id: Optional[str] = None) -> TargetIndex:
+        project_id = project_id or self.__project_id()
+        if project_id is None:
+            raise ValueError("No projects installed")
+        index = self.target_indexes.get(project_id)
+        if index is None:
+            index = TargetIndex(os.path.join(os.getcwd(), "projects", project_id))
+            self.target_indexes[project_id] = index
+        return index
+
+    def __get_targets(self, prefix: str = "", offset: int = 0, limit: Optional[int] = None) -> (bool, str):
+        try:
+            targets = self.__target_index().query(prefix, offset, limit)
+        except ValueError as e:
+            return False, str(e)
+        return True, ",".join(targets)
 
-    def __switch_branch(self, branch: str) -> (bool, str):
-        result, data = self.execute_shell_command(f"git checkout {branch}")
+    def __switch_branch(self, branch_name: str) -> (bool, str):
+        result, data = self.execute_shell_command(f"git checkout {branch_name}")
+        # Don't rely on mtimes alone or the revalidation interval right after we changed the tree ourselves
+        self.__repository().invalidate()
+        self.__target_index().refresh()
 
         if not result or data.startswith("error"):
             return False, data
 
-        with open(os.getcwd() + "/manifest.json") as f:
-            manifest = json.load(f)
-        self.__install_requirements(manifest["selected_project"])
+        project_id = self.__project_id()
+        requirements_status, requirements_response = self.__install_requirements(project_id)
 
         # Check if target file still exists. If not, switch to random .py/.c/.cpp file
-        for i in range(len(manifest["projects"])):
-            if manifest["projects"][i]["id"] == manifest["selected_project"]:
-                target = manifest["projects"][i]["target"]
-                if not os.path.exists(target):
-                    result, data = self.execute_shell_command("find . -type f \\( -name '*.py' -o -name '*.c' -o -name '*.cpp' \\)")
-                    if not result:
-                        return False, data
-                    files = data.split("\n")
-                    manifest["projects"][i]["target"] = files[0]
-                    with open(os.getcwd() + "/manifest.json", "w") as f:
-                        json.dump(manifest, f, indent=4)
+        project = self.manifest.project(project_id)
+        _, directory = self.__get_project_directory()
+        if project is not None and not os.path.exists(os.path.join(directory, project["target"])):
+            files = self.__target_index().query()
+            if not files:
+                return False, "No targets found"
+            self.manifest.set_project_field(project_id, "target", files[0])
+        if not requirements_status:
+            return False, f"Failed to install requirements: {requirements_response}"
         return True, ""
 
-    def __change_target(self, target: str) -> (bool, str):
-        with open(os.getcwd() + "/manifest.json") as f:
-            manifest = json.load(f)
-        current_project = manifest["selected_project"]
-        for project in manifest["projects"]:
-            if project["id"] == current_project:
-                project["target"] = target
-                with open(os.getcwd() + "/manifest.json", "w") as f:
-                    json.dump(manifest, f, indent=4)
-                return True, ""
+    def __change_target(self, target_name: str) -> (bool, str):
+        if self.manifest.set_project_field(self.__project_id(), "target", target_name):
+            return True, ""
         return False, "Project not found"
 
     def __pull_changes(self) -> (bool, str):
         result, data = self.execute_shell_command("git pull")
-        self.__install_requirements(json.load(open(os.getcwd() + "/manifest.json"))["selected_project"])
+        self.__repository().invalidate()
+        self.__target_index().refresh()
+        requirements_status, requirements_response = self.__install_requirements(self.__project_id())
         if not result:
             return False, data
+        if not requirements_status:
+            return False, f"Failed to install requirements: {requirements_response}"
 
         return True, ""
 
-    def __install_project(self, id, url, token=None) -> (bool, str):
-        with open(os.getcwd() + "/manifest.json") as f:
-            manifest = json.load(f)
-        for project in manifest["projects"]:
-            if project["id"] == id:
-                return False, "Project already installed"
+    def __install_project(self, project_id, url, token=None) -> (bool, str):
+        if self.manifest.project(project_id) is not None:
+            return False, "Project already installed"
 
         if token is not None:
             key_path = os.path.expanduser("~/.ssh/github_deploy_key")
@@ -251,58 +292,84 @@ class CommandCenter:
                 key_file.write(token)
             os.chmod(key_path, 0o600)
 
-        current_project = manifest["selected_project"]
-        _, response = self.execute_shell_command(f"git clone --progress {url} projects/{id}", atRoot=True)
+        _, response = self.execute_shell_command(f"git clone --progress {url} projects/{project_id}", atRoot=True)
 
         # Git writes everything to stderr, so we need to manually check if the folder exists. This is stupid.
         # https://stackoverflow.com/questions/32685568/git-clone-writes-to-sderr-fine-but-why-cant-i-redirect-to-stdout
-        if not os.path.exists(f"projects/{id}"):
+        if not os.path.exists(f"projects/{project_id}"):
             return False, "Failed to clone project"
 
-        _, response = self.execute_shell_command(f"python3 -m venv pyenvs/{id}", atRoot=True)
-        self.__install_requirements(id)
-
-        manifest["projects"].append({
-            "id": id,
-            "target": ""
-        })
-        with open(os.getcwd() + "/manifest.json", "w") as f:
-            json.dump(manifest, f, indent=4)
-
-        switch_project_status, _ = self.__switch_project(id)
-        list_targets_status, targets = self.__get_targets()
-        if switch_project_status and list_targets_status:
-            set_target_status, _ = self.__change_target(targets.split(",")[0])
-            if set_target_status:
-                return True, ""
-        for project in manifest["projects"]:
-            if project["id"] == id:
-                manifest["projects"].remove(project)
-                manifest["selected_project"] = current_project
-                with open(os.getcwd() + "/manifest.json", "w") as f:
-                    json.dump(manifest, f, indent=4)
-        os.removedirs(f"projects/{id}")
+        success, response = self.environments.create(project_id, self.manifest.get("base_packages"))
+        if not success:
+            shutil.rmtree(f"projects/{project_id}", ignore_errors=True)
+            return False, response
+        requirements_status, requirements_response = self.__install_requirements(project_id)
+        if not requirements_status:
+            self.environments.release(project_id)
+            shutil.rmtree(f"projects/{project_id}", ignore_errors=True)
+            return False, f"Failed to install requirements: {requirements_response}"
+
+        with self.selection_lock:
+            current_project = self.manifest.selected_project
+            self.manifest.add_project({
+                "id": project_id,
+                "target": ""
+            })
+
+            switch_project_status, _ = self.__switch_project(project_id)
+            list_targets_status, targets = self.__get_targets()
+            if switch_project_status and list_targets_status:
+                set_target_status, _ = self.__change_target(targets.split(",")[0])
+                if set_target_status:
+                    return True, ""
+            self.manifest.remove_project(project_id)
+            self.manifest.set_selected_project(current_project)
+        self.environments.release(project_id)
+        shutil.rmtree(f"projects/{project_id}", ignore_errors=True)
         return False, "Failed to find targets"
 
+    def __remove_project(self, project_id: str) -> (bool, str):
+        if self.manifest.project(project_id) is None:
+            return False, "Project not found"
+        if project_id == self.manifest.selected_project:
+            # Its robot and any running program live in the directory we'd delete
+            return False, "Switch to another project before removing the selected one"
+
+        self.manifest.remove_project(project_id)
+        self.repositories.pop(project_id, None)
+        self.target_indexes.pop(project_id, None)
+        environment = os.path.join(os.getcwd(), "pyenvs", project_id)
+        self.execution_manager.interpreter_pool.invalidate(environment)
+        # Drops its base layer reference too, deleting the layer if no other project uses it
+        self.environments.release(project_id)
+        shutil.rmtree(os.path.join(os.getcwd(), "projects", project_id), ignore_errors=True)
+        return True, ""
+
     def __execute_target(self) -> (bool, str):
-        with open(os.getcwd() + "/manifest.json") as f:
-            manifest = json.load(f)
-        project = manifest["selected_project"]
+        project = self.__project_id()
         if project is None:
             return False, "No projects installed"
 
         target = ""
         env = os.getcwd() + "/pyenvs/" + project
-        for p in manifest["projects"]:
-            if p["id"] == project:
-                target = os.getcwd() +  "/projects/" + project + "/" + p["target"]
-                break
+        p = self.manifest.project(project)
+        if p is not None:
+            target = os.getcwd() +  "/projects/" + project + "/" + p["target"]
 
         if target == "":
             return False, "No target set"
 
         if target.endswith(".py"):
-            return self.execution_manager.run_python_program(env, target), ""
+            # Projects can tune how quickly they are stopped when the driver station goes away
+            return self.execution_manager.run_python_program(
+                env,
+                target,
+                heartbeat_timeout=p.get("heartbeat_timeout"),
+                sigint_grace=p.get("sigint_grace"),
+                sigterm_grace=p.get("sigterm_grace"),
+                warm_start=p.get("warm_start", False),
+                warm_imports=p.get("warm_imports")
+            ), ""
         else:
             filetype = target.split(".")[-1]
             return False, f"{filetype} files are not yet supported"
@@ -317,42 +384,95 @@ class CommandCenter:
         self.execution_manager.kill_program()
         return True, ""
 
-    def __install_requirements(self, project_id):
-        envPath = os.getcwd() + "/pyenvs/" + project_id
-        requirements_path = None
-        # Check all files recursively within projects/project_id for requirements.txt
-        for root, dirs, files in os.walk(os.getcwd() + "/projects/" + project_id):
-            for file in files:
-                if file == "requirements.txt":
-                    requirements_path = os.path.join(root, file)
-                    break
-            if requirements_path:
-                break
-        if requirements_path:
-            print("Installing...")
-            self.execute_shell_command(f"{envPath}/bin/pip install -r {requirements_path}")
-        else:
-            print("Exiting without install")
+    def __install_requirements(self, project_id, force: bool = False) -> (bool, str):
+        index = self.__target_index(project_id)
+        # The shallowest requirements.txt in the project
+        found = index.find("requirements.txt")
+        requirements_path = os.path.join(index.root, found[0][2:]) if found else None
+        success, response = self.dependencies.install(os.getcwd() + "/pyenvs/" + project_id, requirements_path, force)
+        if not success:
+            print(f"Failed to install requirements for {project_id}: {response}")
+        return success, response
+
+    def __install_requirements_command(self, force: bool = False) -> (bool, str):
+        project_id = self.__project_id()
+        if project_id is None:
+            return False, "No projects installed"
+        return self.__install_requirements(project_id, force)
 
     def __list_devices(self) -> (bool, str):
         devices = [d for d in self.device_manager.get_devices()]
         return True, ",".join(devices)
 
 
-    def __get_state(self, uuid: str) -> (bool, str):
-        state = self.device_manager.state_for_device(uuid)
-        state_json = json.dumps(state)
-        return True, bytearray('0,' + state_json, "utf-8")
+    def __get_logs(self, after: int = 0, limit: Optional[int] = None) -> (bool, str):
+        return True, StructuredResponse(self.execution_manager.logs_since(after, limit))
+
+    def __get_log_stats(self) -> (bool, str):
+        return True, StructuredResponse(self.execution_manager.log_stats())
+
+    @staticmethod
+    def __get_metrics() -> (bool, str):
+        return True, Metrics.render()
+
+    def __get_run_stats(self) -> (bool, str):
+        return True, StructuredResponse({
+            'last_run': self.execution_manager.run_stats,
+            'warm_interpreters': self.execution_manager.interpreter_pool.stats()
+        })
+
+    def __get_environments(self) -> (bool, str):
+        return True, StructuredResponse(self.environments.stats())
+
+    def __get_snapshot(self, device_id: Optional[str] = None) -> (bool, str):
+        try:
+            if device_id:
+                return True, StructuredResponse(self.device_manager.snapshot(device_id))
+            return True, StructuredResponse({device: self.device_manager.snapshot(device) for device in self.device_manager.get_devices()})
+        except ValueError as e:
+            return False, str(e)
+
+    def __get_state(self, device_id: str) -> (bool, str):
+        state = self.device_manager.state_for_device(device_id)
+        return True, StructuredResponse(state)
+
+    def __get_states(self, device_ids: Optional[list] = None, fields: Optional[list] = None) -> (bool, str):
+        try:
+            states = self.device_manager.states(device_ids, fields)
+        except ValueError as e:
+            return False, str(e)
+        # Text clients have always received this one with a leading '0,'
+        return True, StructuredResponse(states, prefix="0,")
+
+    def __set_states(self, updates) -> (bool, str):
+        """
+        :param updates: A list of {'uuid', 'state'} updates, or {'updates': [...], 'atomic': bool}.
+        """
+        atomic = False
+        if isinstance(updates, dict):
+            atomic = bool(updates.get("atomic", False))
+            updates = updates.get("updates")
+        if not isinstance(updates, list):
+            return False, "Invalid usage. Usage: set-states <[{uuid, state}, ...] | {updates, atomic}>"
+        for update in updates:
+            if isinstance(update, dict) and isinstance(update.get("state"), str):
+                try:
+                    update["state"] = Serialization.loads(update["state"])
+                except ValueError:
+                    pass
+        try:
+            results = self.device_manager.update_device_states(updates, atomic)
+        except ValueError as e:
+            return False, str(e)
+        success = all(result['success'] for result in results)
+        return success, StructuredResponse({'atomic': atomic, 'results': results})
 
-    def __set_state(self, state: str) -> (bool, str):
-        print(type(state))
-        print(state)
+    def __set_state(self, state: dict) -> (bool, str):
         try:
-            state = json.loads(state)
             if isinstance(state["state"], str):
-                state["state"] = json.loads(state["state"])
+                state["state"] = Serialization.loads(state["state"])
             self.device_manager.update_device_state(state)
             return True, bytearray("0,", "utf-8")
-        except(ValueError, json.JSONDecodeError) as e:
+        except ValueError as e:
             print(e)
             return False, "Failed to parse state"
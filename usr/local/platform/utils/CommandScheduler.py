@@ -0,0 +1,245 @@
+import asyncio
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+
+from utils import Commands, Metrics
+from utils.CommandCenter import CommandCenter, command_project
+from utils.Commands import Command, CommandError, StructuredResponse
+from utils.EventBus import EventBus
+from utils.ShellEngine import output_listener
+
+COMMAND_DURATION = Metrics.histogram("platform_command_duration_seconds", "Time spent running a command", ("command",))
+COMMAND_WAIT = Metrics.histogram("platform_command_wait_seconds", "Time a command waited for its executor", ("command",))
+COMMANDS_TOTAL = Metrics.counter("platform_commands_total", "Commands run, by outcome", ("command", "success"))
+# Labelled "read" or "project" rather than per project, so installs under new ids don't add series forever
+EXECUTOR_QUEUE_DEPTH = Metrics.gauge("platform_executor_queue_depth", "Commands waiting for an executor thread", ("executor",))
+
+
+class CommandClass:
+    # Runs immediately and in parallel with everything else
+    READ = "read"
+    # Serialized with the other writes and jobs of the same project
+    WRITE = "write"
+    # Serialized like WRITE, but the caller gets a job id right away and follows progress through job events
+    JOB = "job"
+
+
+class Job:
+    def __init__(self, job_id: str, command: Command):
+        self.id = job_id
+        self.command = command
+        self.status = "queued"
+        self.success = None
+        self.response = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self) -> dict:
+        return {
+            'job': self.id,
+            'command': str(self.command),
+            'status': self.status,
+            'success': self.success,
+            'response': self.response,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+
+class CommandStats:
+    def __init__(self):
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+
+    def record(self, wait: float, run: float):
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.total_run += run
+        self.max_run = max(self.max_run, run)
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'avg_wait_ms': self.total_wait / self.count * 1000 if self.count else 0.0,
+            'max_wait_ms': self.max_wait * 1000,
+            'avg_run_ms': self.total_run / self.count * 1000 if self.count else 0.0,
+            'max_run_ms': self.max_run * 1000
+        }
+
+
+class CommandScheduler:
+    """
+    Sits in front of CommandCenter.execute and decides how each command runs.
+
+    Reads run in parallel on a shared pool so queries like get-ip never wait behind an install. Writes to a
+    project are serialized on that project's own worker. Long jobs are serialized the same way, but return
+    a job id immediately and publish "job" events on the event bus as they are queued, run, print output and
+    finish. Queue wait and run time are recorded per command.
+
+    Device control (set-state, stop-execution) is scheduled as a read: it doesn't touch project files, and
+    stopping a robot must never queue behind a pull. DeviceManager's own lock keeps it from seeing a robot
+    that tinker or switch-project is swapping.
+
+    Writes and jobs run against the project that was selected when they were submitted (see
+    CommandCenter.command_project), so a job keeps working on its project even if another one is selected
+    while it runs. Writes also hold CommandCenter.selection_lock, so nothing that changes the selection
+    interleaves with one. Jobs, which can take minutes, don't hold it. install-project and remove-project run on
+    the executor of the project they name: installing doesn't wait for the current project, and removing waits
+    for the removed project's queued jobs. install-project takes the lock itself, only to select the new project.
+    """
+
+    CLASSES = {
+        "switch-project": CommandClass.WRITE,
+        "change-target": CommandClass.WRITE,
+        "execute-target": CommandClass.WRITE,
+        "tinker": CommandClass.WRITE,
+        "install-project": CommandClass.JOB,
+        "remove-project": CommandClass.WRITE,
+        "pull-changes": CommandClass.JOB,
+        "switch-branch": CommandClass.JOB,
+        "install-requirements": CommandClass.JOB,
+    }
+
+    def __init__(self, command_center: CommandCenter, events: EventBus, read_workers: int = 4, max_jobs: int = 50):
+        self.command_center = command_center
+        self.events = events
+        self.max_jobs = max_jobs
+        self.read_executor = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="read")
+        self.project_executors = {}
+        self.jobs = OrderedDict()
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count(1)
+
+    @staticmethod
+    def classify(command: Command) -> str:
+        return CommandScheduler.CLASSES.get(command.name, CommandClass.READ)
+
+    async def submit(self, command: Union[Command, str]) -> (bool, str):
+        """
+        Schedules a command and returns its result, or a job id for long-running jobs.
+
+        :param command: A parsed command, or the text syntax which is parsed here.
+        """
+        if isinstance(command, str):
+            try:
+                command = Commands.parse(command)
+            except CommandError as e:
+                return False, str(e)
+
+        match command.name:
+            case "get-job":
+                return self.__get_job(command.args["job_id"])
+            case "list-jobs":
+                with self._lock:
+                    jobs = [job.to_dict() for job in self.jobs.values()]
+                return True, StructuredResponse(jobs)
+            case "get-command-stats":
+                return True, StructuredResponse(self.command_stats())
+
+        command_class = self.classify(command)
+        loop = asyncio.get_running_loop()
+        submitted = time.monotonic()
+        if command_class == CommandClass.READ:
+            EXECUTOR_QUEUE_DEPTH.inc(executor="read")
+            return await loop.run_in_executor(self.read_executor, self.__timed, submitted, command, "read", None)
+
+        project_key = self.__project_key(command)
+        executor = self.__project_executor(project_key)
+        executor_name = "project"
+        EXECUTOR_QUEUE_DEPTH.inc(executor=executor_name)
+        if command_class == CommandClass.WRITE:
+            return await loop.run_in_executor(executor, self.__timed, submitted, command, executor_name, project_key)
+
+        job = self.__create_job(command)
+        executor.submit(self.__run_job, job, submitted, executor_name, project_key)
+        return True, job.id
+
+    def command_stats(self) -> dict:
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in self.stats.items()}
+
+    def __timed(self, submitted: float, command: Command, executor_name: str, project_key: Optional[str]) -> (bool, str):
+        started = time.monotonic()
+        EXECUTOR_QUEUE_DEPTH.dec(executor=executor_name)
+        success = False
+        token = command_project.set(project_key or None)
+        try:
+            success, response = self.__execute(command)
+            return success, response
+        except Exception as e:
+            return False, str(e)
+        finally:
+            command_project.reset(token)
+            finished = time.monotonic()
+            with self._lock:
+                self.stats.setdefault(command.name, CommandStats()).record(started - submitted, finished - started)
+            COMMAND_WAIT.observe(started - submitted, command=command.name)
+            COMMAND_DURATION.observe(finished - started, command=command.name)
+            COMMANDS_TOTAL.inc(command=command.name, success=str(bool(success)).lower())
+
+    def __execute(self, command: Command) -> (bool, str):
+        if self.classify(command) != CommandClass.WRITE:
+            return self.command_center.execute(command)
+        with self.command_center.selection_lock:
+            return self.command_center.execute(command)
+
+    def __run_job(self, job: Job, submitted: float, executor_name: str, project_key: str):
+        job.status = "running"
+        job.started = time.time()
+        self.events.publish("job", job.to_dict())
+
+        def progress(stream: str, text: str):
+            self.events.publish("job", {'job': job.id, 'command': str(job.command), 'status': 'running', 'stream': stream, 'output': text})
+
+        token = output_listener.set(progress)
+        try:
+            success, response = self.__timed(submitted, job.command, executor_name, project_key)
+        finally:
+            output_listener.reset(token)
+        job.success = success
+        job.response = response.decode("utf-8") if isinstance(response, (bytes, bytearray)) else str(response)
+        job.status = "succeeded" if success else "failed"
+        job.finished = time.time()
+        self.events.publish("job", job.to_dict())
+
+    def __create_job(self, command: Command) -> Job:
+        with self._lock:
+            job = Job(str(next(self._job_ids)), command)
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self.events.publish("job", job.to_dict())
+        return job
+
+    def __get_job(self, job_id: str) -> (bool, str):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False, "Job not found"
+            return True, StructuredResponse(job.to_dict())
+
+    def __project_key(self, command: Command) -> str:
+        # Installing or removing a project doesn't touch the current one; install-project's step that selects
+        # the new project takes the selection lock itself
+        if command.name in ("install-project", "remove-project"):
+            return command.args["project_id"]
+        return self.command_center.manifest.selected_project or ""
+
+    def __project_executor(self, project_id: str) -> ThreadPoolExecutor:
+        with self._lock:
+            executor = self.project_executors.get(project_id)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"project-{project_id}")
+                self.project_executors[project_id] = executor
+            return executor
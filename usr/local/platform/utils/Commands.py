@@ -0,0 +1,242 @@
+from typing import Any, Callable, Optional
+
+from utils import Serialization
+
+
+class CommandError(ValueError):
+    """
+    A command that couldn't be parsed: unknown name, missing or malformed arguments. The message is what
+    the client should see.
+    """
+
+
+class Argument:
+    def __init__(self, name: str, type: Callable[[str], Any] = str, required: bool = True, default: Any = None,
+                 rest: bool = False, aliases: tuple = (), secret: bool = False):
+        """
+        :param name: Keyword the handler receives and the key structured requests use.
+        :param type: Converts the text form of the argument (int, Serialization.loads, ...).
+        :param rest: Takes the rest of the text command, spaces included. Only valid as the last argument.
+        :param aliases: Other keys accepted from structured requests.
+        :param secret: Masked when the command is shown, e.g. in job events.
+        """
+        self.name = name
+        self.type = type
+        self.required = required
+        self.default = default
+        self.rest = rest
+        self.aliases = aliases
+        self.secret = secret
+
+    @property
+    def usage(self) -> str:
+        return f"<{self.name}>" if self.required else f"[{self.name}]"
+
+
+class CommandSpec:
+    def __init__(self, name: str, *arguments: Argument):
+        self.name = name
+        self.arguments = arguments
+
+    @property
+    def usage(self) -> str:
+        return " ".join([self.name] + [argument.usage for argument in self.arguments])
+
+    def error(self) -> CommandError:
+        return CommandError(f"Invalid usage. Usage: {self.usage}")
+
+
+class Command:
+    """
+    A parsed command: its name and keyword arguments already converted to their declared types.
+    """
+
+    def __init__(self, name: str, args: Optional[dict] = None):
+        self.name = name
+        self.args = args or {}
+
+    def __str__(self) -> str:
+        # Text form, used to show the command in jobs and logs
+        parts = [self.name]
+        spec = COMMANDS.get(self.name)
+        for argument in spec.arguments if spec else ():
+            value = self.args.get(argument.name)
+            if value is None:
+                continue
+            if argument.secret:
+                parts.append("***")
+            else:
+                parts.append(Serialization.dumps_str(value) if isinstance(value, (dict, list)) else str(value))
+        return " ".join(parts)
+
+
+class StructuredResponse:
+    """
+    A command result that is data rather than a message. Text transports send its JSON form (str), the binary
+    BLE protocol encodes value as it is.
+    """
+
+    def __init__(self, value: Any, prefix: str = ""):
+        """
+        :param prefix: Put before the JSON in the text form, for responses whose text format predates this.
+        """
+        self.value = value
+        self.prefix = prefix
+
+    def __str__(self) -> str:
+        return self.prefix + Serialization.dumps_str(self.value)
+
+
+def _list(value: str) -> list:
+    # Text form of a list argument: comma separated
+    return [item for item in value.split(",") if item]
+
+
+def _flag(value: str) -> bool:
+    if value.lower() in ("true", "1", "yes"):
+        return True
+    if value.lower() in ("false", "0", "no"):
+        return False
+    raise ValueError(value)
+
+
+def _project_argument(name: str) -> Argument:
+    # Structured clients have historically sent any of these keys for switch-project/branch/change-target.
+    # Takes the rest of the text command, since target paths can contain spaces
+    return Argument(name, rest=True, aliases=("project_id", "branch_name", "target_name"))
+
+
+# What a structured request may send for each argument type instead of text, and how errors describe it
+_TYPED_VALUES = {
+    str: (str, "a string"),
+    int: (int, "an integer"),
+    _flag: (bool, "true or false"),
+    _list: (list, "a list of strings"),
+}
+
+
+COMMANDS = {spec.name: spec for spec in [
+    CommandSpec("get-ip"),
+    CommandSpec("switch-project", _project_argument("project_id")),
+    CommandSpec("list-projects"),
+    CommandSpec("get-project"),
+    CommandSpec("get-branch"),
+    CommandSpec("get-branches"),
+    CommandSpec("get-commit-hash"),
+    CommandSpec("get-target"),
+    CommandSpec(
+        "get-targets",
+        Argument("prefix", required=False, default=""),
+        Argument("offset", int, required=False, default=0),
+        Argument("limit", int, required=False)
+    ),
+    CommandSpec("get-project-directory"),
+    CommandSpec("switch-branch", _project_argument("branch_name")),
+    CommandSpec("change-target", _project_argument("target_name")),
+    CommandSpec("pull-changes"),
+    CommandSpec("install-project", Argument("project_id"), Argument("url"), Argument("token", required=False, rest=True, secret=True)),
+    CommandSpec("remove-project", Argument("project_id")),
+    CommandSpec("install-requirements", Argument("force", _flag, required=False, default=False)),
+    CommandSpec("execute-target"),
+    CommandSpec("tinker"),
+    CommandSpec("stop-execution"),
+    CommandSpec("list-devices"),
+    CommandSpec("set-state", Argument("state", Serialization.loads, rest=True)),
+    CommandSpec("get-state", Argument("device_id")),
+    CommandSpec("set-states", Argument("updates", Serialization.loads, rest=True)),
+    CommandSpec("get-states", Argument("device_ids", _list, required=False), Argument("fields", _list, required=False)),
+    CommandSpec("get-snapshot", Argument("device_id", required=False)),
+    CommandSpec(
+        "get-logs",
+        Argument("after", int, required=False, default=0),
+        Argument("limit", int, required=False)
+    ),
+    CommandSpec("get-log-stats"),
+    CommandSpec("get-job", Argument("job_id")),
+    CommandSpec("list-jobs"),
+    CommandSpec("get-command-stats"),
+    CommandSpec("get-metrics"),
+    CommandSpec("get-run-stats"),
+    CommandSpec("get-environments"),
+]}
+
+
+def parse(text: str) -> Command:
+    """
+    Parses the space separated text syntax used over BLE.
+
+    :raises CommandError: If the command is unknown or its arguments don't match.
+    """
+    name, _, remainder = text.strip().partition(" ")
+    spec = _spec(name)
+    args = {}
+    for argument in spec.arguments:
+        if argument.rest:
+            value, remainder = remainder, ""
+        else:
+            value, _, remainder = remainder.partition(" ")
+        args[argument.name] = _convert(spec, argument, value if value != "" else None)
+    if remainder.strip():
+        # More words than the command takes
+        raise spec.error()
+    return Command(name, args)
+
+
+def from_request(endpoint: str, payload: Optional[dict]) -> Command:
+    """
+    Builds a command from a structured (WebSocket) request, where arguments arrive as already typed values.
+
+    :raises CommandError: If the command is unknown or its arguments don't match.
+    """
+    spec = _spec(endpoint)
+    payload = payload or {}
+    args = {}
+    for argument in spec.arguments:
+        value = None
+        for key in (argument.name,) + argument.aliases:
+            if payload.get(key) not in (None, ""):
+                value = payload[key]
+                break
+        if isinstance(value, str) or value is None:
+            value = _convert(spec, argument, value)
+        else:
+            value = _check(spec, argument, value)
+        args[argument.name] = value
+    return Command(endpoint, args)
+
+
+def _spec(name: str) -> CommandSpec:
+    spec = COMMANDS.get(name)
+    if spec is None:
+        raise CommandError("Command not recognized")
+    return spec
+
+
+def _check(spec: CommandSpec, argument: Argument, value: Any) -> Any:
+    """
+    Validates a value that arrived already typed rather than as text.
+    """
+    if argument.type not in _TYPED_VALUES:
+        # Parsed from JSON (Serialization.loads): any JSON value is what the handler expects
+        return value
+    expected, description = _TYPED_VALUES[argument.type]
+    if expected is str and isinstance(value, (int, float)) and not isinstance(value, bool):
+        # Numeric ids
+        return str(value)
+    valid = isinstance(value, expected) and not (expected is int and isinstance(value, bool))
+    if valid and expected is list:
+        valid = all(isinstance(item, str) for item in value)
+    if not valid:
+        raise CommandError(f"Invalid {argument.name}: must be {description}. Usage: {spec.usage}")
+    return value
+
+
+def _convert(spec: CommandSpec, argument: Argument, value: Optional[str]) -> Any:
+    if value is None:
+        if argument.required:
+            raise spec.error()
+        return argument.default
+    try:
+        return argument.type(value)
+    except ValueError:
+        raise spec.error()
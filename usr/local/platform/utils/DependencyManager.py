@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import re
+import shlex
+import threading
+from typing import Dict, Optional
+
+from utils import Metrics
+from utils.ShellEngine import ShellEngine, output_listener
+
+DEPENDENCY_INSTALLS = Metrics.counter(
+    "platform_dependency_installs_total", "requirements.txt installs, by what had to be done", ("result",)
+)
+
+
+class Requirements:
+    """
+    A requirements file with -r includes expanded, comments and blank lines dropped.
+
+    Pins are keyed by normalized project name so a changed version is seen as a change of that one pin.
+    Anything that isn't a plain requirement (-e, --index-url, -c, ...) is kept as an option, and a file with
+    options is always installed as a whole since pip has to see them together.
+    """
+
+    NAME = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pins: Dict[str, str] = {}
+        self.options: [str] = []
+        self.__read(path, set())
+
+    @property
+    def digest(self) -> str:
+        content = json.dumps({
+            'pins': sorted(self.pins.items()),
+            'options': self.options
+        })
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def __read(self, path: str, seen: set):
+        path = os.path.abspath(path)
+        if path in seen:
+            return
+        seen.add(path)
+        with open(path, "r") as f:
+            lines = f.read().replace("\\\n", "").splitlines()
+        for line in lines:
+            line = re.sub(r"(^|\s)#.*$", "", line).strip()
+            if not line:
+                continue
+            include = re.match(r"^(-r|--requirement)[\s=]+(.+)$", line)
+            if include:
+                self.__read(os.path.join(os.path.dirname(path), include.group(2).strip()), seen)
+            elif line.startswith("-"):
+                self.options.append(line)
+            else:
+                self.pins[self.__key(line)] = line
+
+    def __key(self, line: str) -> str:
+        match = self.NAME.match(line)
+        if match is None or "/" in line.split(";")[0].split("@")[0]:
+            # A path or URL without a name
+            return line
+        return re.sub(r"[-_.]+", "-", match.group(1)).lower()
+
+
+class DependencyManager:
+    """
+    Installs a project's requirements.txt into its venv, doing as little as possible.
+
+    After a successful install the requirements' hash and pins are saved in the venv. The next install (every
+    switch-branch and pull-changes) is skipped when the hash is unchanged, and otherwise only the added or
+    changed pins are passed to pip. Removed pins are left installed, since something else may depend on them.
+    All venvs share one pip cache, so a wheel built for one project (slow on a Pi) is reused by the others.
+
+    Installs run through the shell engine, so inside a scheduler job pip's output is streamed as job events.
+    """
+
+    STATE_FILE = ".requirements-state.json"
+
+    def __init__(self, shell: ShellEngine, cache_directory: str):
+        self.shell = shell
+        self.cache_directory = cache_directory
+        self._lock = threading.Lock()
+        # venv -> lock, so two projects can install at once but one venv is never installed into twice
+        self._venv_locks: Dict[str, threading.Lock] = {}
+
+    def install(self, environment: str, requirements_path: Optional[str], force: bool = False) -> (bool, str):
+        """
+        :param environment: Path to the venv.
+        :param requirements_path: The project's requirements.txt, or None if it has none.
+        :param force: Reinstall the whole file even if nothing changed.
+        :return: Success and a short description of what was done (or pip's error output).
+        """
+        if requirements_path is None:
+            return True, "No requirements.txt"
+        try:
+            requirements = Requirements(requirements_path)
+        except OSError as e:
+            return False, str(e)
+
+        with self.__venv_lock(environment):
+            state = self.__load_state(environment)
+            digest = requirements.digest
+            if not force and state.get('digest') == digest:
+                DEPENDENCY_INSTALLS.inc(result="skipped")
+                return True, "Requirements unchanged"
+
+            installed = state.get('pins', {})
+            changed = [line for key, line in requirements.pins.items() if installed.get(key) != line]
+            if force or requirements.options or not state:
+                result, arguments = "full", ["-r", requirements_path]
+            elif changed:
+                result, arguments = "incremental", changed
+            else:
+                # Only removals (or reordering); nothing to install
+                result, arguments = "skipped", []
+
+            if arguments:
+                self.__progress(f"Installing {'requirements.txt' if result == 'full' else ', '.join(changed)}\n")
+                success, output = self.__pip_install(environment, arguments, os.path.dirname(os.path.abspath(requirements_path)))
+                if not success:
+                    DEPENDENCY_INSTALLS.inc(result="failed")
+                    return False, output
+
+            self.__save_state(environment, {'digest': digest, 'pins': requirements.pins})
+            DEPENDENCY_INSTALLS.inc(result=result)
+            if result == "incremental":
+                return True, f"Installed {len(changed)} changed requirement(s)"
+            return True, "Installed requirements" if result == "full" else "Requirements unchanged"
+
+    def invalidate(self, environment: str):
+        """
+        Forgets what was installed, so the next install runs pip on the whole file.
+        """
+        try:
+            os.remove(os.path.join(environment, self.STATE_FILE))
+        except FileNotFoundError:
+            pass
+
+    def __pip_install(self, environment: str, arguments: [str], cwd: str) -> (bool, str):
+        """
+        :param cwd: The directory holding requirements.txt, which relative paths in it (./libs/foo) are relative to.
+        """
+        pip = os.path.join(environment, "bin", "pip")
+        command = " ".join(
+            [shlex.quote(pip), "install", "--cache-dir", shlex.quote(self.cache_directory)]
+            + [shlex.quote(argument) for argument in arguments]
+        )
+        result = self.shell.run(command, cwd=cwd)
+        # pip prints warnings to stderr on success, so only the exit code counts
+        if result.returncode != 0:
+            return False, result.stderr or result.stdout
+        return True, result.stdout
+
+    def __venv_lock(self, environment: str) -> threading.Lock:
+        with self._lock:
+            return self._venv_locks.setdefault(os.path.abspath(environment), threading.Lock())
+
+    def __load_state(self, environment: str) -> dict:
+        try:
+            with open(os.path.join(environment, self.STATE_FILE), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def __save_state(self, environment: str, state: dict):
+        path = os.path.join(environment, self.STATE_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f, indent=4)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def __progress(text: str):
+        listener = output_listener.get()
+        if listener is not None:
+            listener("stdout", text)
@@ -1,105 +1,262 @@
-import gc
-from typing import Callable
+import threading
+from typing import Callable, Optional
 from uuid import uuid4
 
 from cyberonics_py import Robot, Device
-import importlib.util
-import os
+
+from utils import Metrics, StatePatch
+from utils.RobotLoader import RobotLoader
+
+# Series are removed when their robot is detached, so only the attached robot's devices are ever labelled
+DEVICE_UPDATES = Metrics.counter("platform_device_updates_total", "Device state changes seen", ("device",))
 
 class DeviceManager:
-    def __init__(self, device_updated: Callable[[uuid4], None]):
+    def __init__(self, device_updated: Callable[[str, Optional[dict], int], None], full_snapshot_interval: int = 100,
+                 loader: RobotLoader = None):
+        """
+        :param device_updated: Called with (uuid, patch, version) when a device's state changes. patch holds only
+            the changed keys (see StatePatch). It is None when clients should resync from the full state instead:
+            on reloads and every full_snapshot_interval versions.
+        """
         self.robot = None
         self.robot_path = None
         self.device_updated = device_updated
+        self.full_snapshot_interval = full_snapshot_interval
         # Keep a cache of current states for each device so we don't get into a loop
         self.state_cache = {}
-
+        # Incremented on every change so clients applying patches can spot a gap and ask for a snapshot
+        self.versions = {}
+        # uuid string -> device, so lookups don't scan and stringify every device's uuid
+        self.devices_by_uuid = {}
+        self.loader = loader or RobotLoader()
+        # uuid string -> the listener registered on that device, so it can be removed on detach
+        self.listeners = {}
+        # Bumped on every detach. Listeners of devices without remove_listener check it and go quiet, so a
+        # detached robot can't publish updates even while it's still referenced
+        self.generation = 0
+        # Held while the robot is swapped (attach/deload/reload) and while devices are looked up and driven, so
+        # device commands never see a half-swapped robot. Reentrant since listen_to_robot detaches and attaches
+        self._lock = threading.RLock()
+        # Guards state_cache and versions, which device listeners update from their own threads. Held while
+        # publishing so a device's versions go out in order
+        self._state_lock = threading.Lock()
 
     @property
     def all_device_states(self):
-        if self.robot is None:
-            raise ValueError("No robot loaded")
-        return {str(device.uuid): device.get_state() for device in self.robot.devices}
-
-    def listen_to_robot(self, robot_path):
-        if not os.path.isfile(robot_path):
-            raise FileNotFoundError(f"No such file: {robot_path}")
+        with self._lock:
+            if self.robot is None:
+                raise ValueError("No robot loaded")
+            return {uuid: device.get_state() for uuid, device in self.devices_by_uuid.items()}
 
-        # Unload existing robot
-        self.deload_robot()
+    def states(self, device_ids: Optional[list] = None, fields: Optional[list] = None) -> dict:
+        """
+        Returns {uuid: state} for the given devices (all when None), keeping only the given state keys
+        (all when None).
+        """
+        with self._lock:
+            if self.robot is None:
+                raise ValueError("No robot loaded")
+            devices = self.devices_by_uuid if device_ids is None else {str(uuid): self.__device(uuid) for uuid in device_ids}
+            states = {}
+            for uuid, device in devices.items():
+                state = device.get_state()
+                states[uuid] = state if fields is None else {field: state[field] for field in fields if field in state}
+            return states
 
-        # Load the module from the file path
-        module_name = os.path.splitext(os.path.basename(robot_path))[0]
-        spec = importlib.util.spec_from_file_location(module_name, robot_path)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
+    def listen_to_robot(self, robot_path, reuse: bool = True):
+        """
+        Attaches the robot defined in robot_path. If that robot is already attached and neither robot.py nor a
+        project module it imports changed, it is kept rather than rebuilt.
 
-        for attribute_name in dir(module):
-            attribute = getattr(module, attribute_name)
-            if isinstance(attribute, type) and issubclass(attribute, Robot) and attribute is not Robot:
-                self.robot = attribute()
+        :param reuse: Set to False to always build a new Robot, e.g. to drop state a program left behind.
+        """
+        with self._lock:
+            if reuse and self.robot is not None and self.loader.current(robot_path) is self.robot:
                 self.robot_path = robot_path
-                for device in self.robot.devices:
-                    self.state_cache[str(device.uuid)] = device.get_state()
+                # Still attached; just pick up anything that changed without a listener firing
+                for device in self.devices_by_uuid.values():
+                    self.__device_updated(device)
+                return
+
+            # Unload existing robot first, so its devices release their hardware before the new ones open it
+            self.deload_robot()
+            self.attach_robot(self.loader.load(robot_path), robot_path)
+
+    def attach_robot(self, robot: Robot, robot_path: str = None):
+        """
+        Starts tracking an already constructed robot: indexes its devices and listens for state changes.
+        """
+        with self._lock:
+            self.robot = robot
+            self.robot_path = robot_path
+            self.devices_by_uuid = {str(device.uuid): device for device in robot.devices}
+            generation = self.generation
+
+            def listener(device: Device):
+                if generation == self.generation:
                     self.__device_updated(device)
-                    device.add_listener(self.__device_updated)
-                break
-        else:
-            raise TypeError("No subclass of Robot found in the specified file.")
+
+            for uuid, device in self.devices_by_uuid.items():
+                state = device.get_state()
+                with self._state_lock:
+                    self.state_cache[uuid] = state
+                self.__device_updated(device)
+                # Attaching the robot that is already attached mustn't register a second listener
+                if uuid not in self.listeners:
+                    device.add_listener(listener)
+                    self.listeners[uuid] = listener
 
 
     def reload_robot(self):
-        if self.robot_path is None:
-            raise ValueError("No robot loaded")
-        self.listen_to_robot(self.robot_path)
-        for device in self.get_devices():
-            self.device_updated(device)
+        with self._lock:
+            if self.robot_path is None:
+                raise ValueError("No robot loaded")
+            # A fresh Robot, so devices don't keep whatever state the program that just stopped left them in
+            self.listen_to_robot(self.robot_path, reuse=False)
+            with self._state_lock:
+                for device in self.get_devices():
+                    self.device_updated(device, None, self.versions.get(device, 0))
 
     def get_devices(self) -> [str]:
-        if self.robot is None:
-            return []
-        devices = [str(device.uuid) for device in self.robot.devices]
-        return devices
+        with self._lock:
+            if self.robot is None:
+                return []
+            return list(self.devices_by_uuid)
 
     def state_for_device(self, device_uuid: uuid4) -> dict:
-        if self.robot is None:
-            raise ValueError("No robot loaded")
-        for device in self.robot.devices:
-            if str(device.uuid) == str(device_uuid):
-                return device.get_state()
-        raise ValueError(f"No device with UUID {str(device_uuid)}. Found devices {[str(device.uuid) for device in self.robot.devices]}")
+        with self._lock:
+            return self.__device(device_uuid).get_state()
+
+    def snapshot(self, device_uuid: uuid4) -> dict:
+        """
+        Returns the last published state of a device with its version, for clients resyncing their patches.
+        """
+        with self._lock:
+            device_uuid = str(self.__device(device_uuid).uuid)
+        with self._state_lock:
+            return {'state': self.state_cache.get(device_uuid), 'version': self.versions.get(device_uuid, 0)}
 
     def deload_robot(self):
-        self.robot_path = None
-        if self.robot is not None:
+        """
+        Detaches the current robot's listeners and has the loader release it.
+        """
+        with self._lock:
+            self.generation += 1
+            self.__remove_listeners()
+            self.listeners = {}
+            self.robot_path = None
+            self.devices_by_uuid = {}
             self.robot = None
-            gc.collect()
+            self.loader.release()
+
+    def __remove_listeners(self):
+        # Separate from deload_robot so nothing there still references a device when the loader releases it
+        for uuid, device in self.devices_by_uuid.items():
+            DEVICE_UPDATES.remove(device=uuid)
+            listener = self.listeners.get(uuid)
+            remove_listener = getattr(device, "remove_listener", None)
+            if listener is not None and remove_listener is not None:
+                try:
+                    remove_listener(listener)
+                except ValueError:
+                    pass
 
 
     def update_device_state(self, device_data: dict[str, any]):
         device_state = device_data.get("state")
         device_uuid = device_data.get("uuid")
-        if self.robot is None:
-            raise ValueError("No robot loaded")
         if device_state is None or device_uuid is None:
             raise ValueError("device_data must contain 'state' and 'uuid' keys")
-        for device in self.robot.devices:
-            if str(device.uuid) == str(device_uuid):
-                device.set_state(device_state)
-                return
-        raise ValueError(f"No device with UUID {str(device_uuid)}. Found devices {[str(device.uuid) for device in self.robot.devices]}")
+        with self._lock:
+            self.__device(device_uuid).set_state(device_state)
+
+    def update_device_states(self, updates: list, atomic: bool = False) -> list:
+        """
+        Applies several {'uuid', 'state'} updates in one call.
+
+        :param atomic: Apply all of them or none. Every update is validated before any is applied, and if
+            applying one fails the devices already updated are set back to their previous state.
+        :return: One {'uuid', 'success'[, 'error']} result per update, in order.
+        """
+        with self._lock:
+            if self.robot is None:
+                raise ValueError("No robot loaded")
+
+            results = []
+            devices = []
+            for update in updates:
+                device_uuid = update.get("uuid") if isinstance(update, dict) else None
+                try:
+                    if device_uuid is None or update.get("state") is None:
+                        raise ValueError("Each update must contain 'state' and 'uuid' keys")
+                    devices.append(self.__device(device_uuid))
+                    results.append({'uuid': device_uuid, 'success': True})
+                except ValueError as e:
+                    devices.append(None)
+                    results.append({'uuid': device_uuid, 'success': False, 'error': str(e)})
+
+            if atomic and not all(result['success'] for result in results):
+                for result in results:
+                    if result['success']:
+                        result.update(success=False, error="Not applied: another update in the batch was invalid")
+                return results
+
+            applied = []
+            for update, device, result in zip(updates, devices, results):
+                if device is None:
+                    continue
+                previous = device.get_state() if atomic else None
+                try:
+                    device.set_state(update["state"])
+                    applied.append((device, previous, result))
+                except Exception as e:
+                    result.update(success=False, error=str(e))
+                    if atomic:
+                        self.__roll_back(applied)
+                        for other in results:
+                            if other['success']:
+                                other.update(success=False, error="Rolled back: another update in the batch failed")
+                        break
+            return results
+
+    @staticmethod
+    def __roll_back(applied: list):
+        for device, previous, _ in reversed(applied):
+            try:
+                device.set_state(previous)
+            except Exception as e:
+                print(f"Failed to roll back {device.uuid}: {e}")
+
+    def __device(self, device_uuid: uuid4) -> Device:
+        if self.robot is None:
+            raise ValueError("No robot loaded")
+        device = self.devices_by_uuid.get(str(device_uuid))
+        if device is None:
+            raise ValueError(f"No device with UUID {str(device_uuid)}. Found devices {list(self.devices_by_uuid)}")
+        return device
 
     # Checks to see if the state is actually different than the last one we sent before we send it
     def __device_updated(self, device: Device):
         device_uuid = str(device.uuid)
-        if self.state_cache.get(device_uuid) == device.get_state():
-            return
-        self.state_cache[device_uuid] = device.get_state()
-        self.device_updated(device_uuid)
+        # Take a single snapshot; get_state may build a fresh dict on every call. Outside the lock, since the
+        # device may hold its own lock while calling listeners
+        state = device.get_state()
+        with self._state_lock:
+            previous = self.state_cache.get(device_uuid)
+            if previous == state:
+                return
+            self.state_cache[device_uuid] = state
+            DEVICE_UPDATES.inc(device=device_uuid)
+            version = self.versions.get(device_uuid, 0) + 1
+            self.versions[device_uuid] = version
+            if previous is None or version % self.full_snapshot_interval == 0:
+                self.device_updated(device_uuid, None, version)
+            else:
+                self.device_updated(device_uuid, StatePatch.diff(previous, state), version)
 
 
 if __name__ == "__main__":
-    dm = DeviceManager(lambda x: print(f"Device {x} updated"))
+    dm = DeviceManager(lambda uuid, patch, version: print(f"Device {uuid} updated to version {version}: {patch}"))
     dm.listen_to_robot("projects/pytester/robot.py")
     devices = dm.get_devices()
     dev = devices[0]
@@ -0,0 +1,83 @@
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from utils import StatePatch
+
+
+class DeviceChange:
+    """
+    Everything that happened to one device since the last flush.
+
+    patch takes the device from base_version to version. It is None when the transport should send the
+    full state instead (a resync point was reached somewhere in the window).
+    """
+
+    def __init__(self, uuid: str, base_version: int, version: int, patch: Optional[dict]):
+        self.uuid = uuid
+        self.base_version = base_version
+        self.version = version
+        self.patch = patch
+
+
+class DeviceUpdateCoalescer:
+    """
+    Rate-limits device updates for one transport.
+
+    Each device has a single latest-value slot; updates that arrive between flushes are merged into it, so
+    a device changing at 200 Hz costs one entry per flush rather than 200 notifications. A flush thread
+    publishes all dirty devices together as one batch, at most max_rate times per second. The thread sleeps
+    until something changes, so quiet robots cost nothing.
+    """
+
+    def __init__(self, publish: Callable[[Dict[str, DeviceChange]], None], max_rate: float):
+        """
+        :param max_rate: Flushes per second.
+        :raises ValueError: If max_rate isn't positive.
+        """
+        if max_rate <= 0:
+            raise ValueError(f"max_rate must be positive, got {max_rate}")
+        self.publish = publish
+        self.min_interval = 1.0 / max_rate
+        self._condition = threading.Condition()
+        self._slots: Dict[str, DeviceChange] = {}
+        self._last_flush = 0.0
+        self.updates = 0
+        self.flushes = 0
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def submit(self, uuid: str, patch: Optional[dict], version: int):
+        """
+        Records a device change. Matches the DeviceManager device_updated signature.
+        """
+        with self._condition:
+            self.updates += 1
+            slot = self._slots.get(uuid)
+            if slot is None:
+                self._slots[uuid] = DeviceChange(uuid, version - 1, version, patch)
+                self._condition.notify()
+                return
+            slot.version = version
+            if slot.patch is None or patch is None:
+                slot.patch = None
+            else:
+                slot.patch = StatePatch.compose(slot.patch, patch)
+
+    def __run(self):
+        while True:
+            with self._condition:
+                while not self._slots:
+                    self._condition.wait()
+            # Let updates keep collecting until this transport may publish again
+            delay = self._last_flush + self.min_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self._condition:
+                batch, self._slots = self._slots, {}
+                self._last_flush = time.monotonic()
+                self.flushes += 1
+            try:
+                self.publish(batch)
+            except Exception as e:
+                print(f"Failed to publish device updates: {e}")
@@ -0,0 +1,199 @@
+import ast
+import glob
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import threading
+from typing import Dict, Optional
+
+from utils.ShellEngine import ShellEngine
+
+
+class EnvironmentManager:
+    """
+    Creates project venvs on top of a shared base layer instead of installing the whole robotics stack into
+    every one of them.
+
+    A layer is a venv under pyenvs/.layers/<hash of its packages> with the common packages installed once. A
+    project venv is a normal, empty venv whose site-packages has a .pth file adding the layer's site-packages
+    after its own. The project still installs into its own site-packages, so a project that pins a different
+    version of a base package gets its own copy, which shadows the layer's, and the layer is never written to.
+
+    Layers are reference counted by the projects using them (pyenvs/.layers/refs.json). A layer nobody
+    uses is deleted, e.g. once the last project built on an old base_packages list is gone.
+    """
+
+    # The manifest's base_packages overrides this
+    DEFAULT_BASE_PACKAGES = ("git+https://github.com/Skylerwiernik/cyberonics-py.git@master#egg=cyberonics-py",)
+    PTH_FILE = "_platform_base_layer.pth"
+    LAYER_FILE = "layer.json"
+
+    def __init__(self, shell: ShellEngine, root: str, cache_directory: str):
+        """
+        :param root: Directory holding the venvs (pyenvs).
+        :param cache_directory: pip cache shared with DependencyManager.
+        """
+        self.shell = shell
+        self.root = root
+        self.layers_directory = os.path.join(root, ".layers")
+        self.cache_directory = cache_directory
+        # Guards refs.json and deleting layers; never held while a layer is built
+        self._lock = threading.Lock()
+        # digest -> lock, so a layer is built once even if two projects need it at the same time
+        self._build_locks: Dict[str, threading.Lock] = {}
+
+    def create(self, project_id: str, base_packages: Optional[list] = None) -> (bool, str):
+        """
+        Creates the venv for project_id on the base layer for base_packages, building the layer first if no
+        project uses it yet. Falls back to a standalone venv if the layer can't be built.
+        """
+        packages = sorted(base_packages if base_packages is not None else self.DEFAULT_BASE_PACKAGES)
+        environment = os.path.join(self.root, project_id)
+        success, response = self.__venv(environment)
+        if not success:
+            return False, response
+
+        digest = hashlib.sha256("\n".join(packages).encode("utf-8")).hexdigest()[:16]
+        with self.__build_lock(digest):
+            # Referenced before it is built, so a collection running meanwhile doesn't delete it mid-build
+            with self._lock:
+                refs = self.__load_refs()
+                self.__forget(refs, project_id)
+                refs.setdefault(digest, []).append(project_id)
+                self.__save_refs(refs)
+            layer = self.__layer(digest, packages)
+
+        layer_site = self.__site_packages(layer) if layer is not None else None
+        project_site = self.__site_packages(environment)
+        if layer_site is None or project_site is None:
+            self.release(project_id, remove_environment=False)
+            return True, "Created venv without a base layer"
+        with open(os.path.join(project_site, self.PTH_FILE), "w") as f:
+            # addsitedir rather than a bare path, so .pth files in the layer (editable installs, namespace
+            # packages) are processed too
+            f.write(f"import site; site.addsitedir({layer_site!r})\n")
+        with self._lock:
+            # Collects the layer project_id was on before, if nothing else uses it
+            self.__collect(self.__load_refs())
+        return True, ""
+
+    def release(self, project_id: str, remove_environment: bool = True):
+        """
+        Drops project_id's reference to its layer, deleting the layer if it was the last one.
+        """
+        with self._lock:
+            refs = self.__load_refs()
+            self.__forget(refs, project_id)
+            self.__collect(refs)
+        if remove_environment:
+            shutil.rmtree(os.path.join(self.root, project_id), ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            refs = self.__load_refs()
+        layers = {}
+        for path in sorted(glob.glob(os.path.join(self.layers_directory, "*", self.LAYER_FILE))):
+            digest = os.path.basename(os.path.dirname(path))
+            try:
+                with open(path, "r") as f:
+                    packages = json.load(f).get('packages', [])
+            except (OSError, ValueError):
+                packages = []
+            layers[digest] = {'packages': packages, 'projects': refs.get(digest, [])}
+        return layers
+
+    def __layer(self, digest: str, packages: [str]) -> Optional[str]:
+        """
+        Builds the layer for packages unless it is already complete. Called holding the digest's build lock.
+        """
+        layer = os.path.join(self.layers_directory, digest)
+        if os.path.isfile(os.path.join(layer, self.LAYER_FILE)):
+            return layer
+
+        # Not there, or a build that was interrupted
+        shutil.rmtree(layer, ignore_errors=True)
+        os.makedirs(self.layers_directory, exist_ok=True)
+        success, response = self.__venv(layer)
+        if success and packages:
+            pip = os.path.join(layer, "bin", "pip")
+            command = " ".join(
+                [shlex.quote(pip), "install", "--cache-dir", shlex.quote(self.cache_directory)]
+                + [shlex.quote(package) for package in packages]
+            )
+            result = self.shell.run(command, cwd=self.root)
+            success, response = result.returncode == 0, result.stderr
+        if not success:
+            print(f"Failed to build base layer: {response}")
+            shutil.rmtree(layer, ignore_errors=True)
+            return None
+        # Written last: a layer without it is incomplete
+        with open(os.path.join(layer, self.LAYER_FILE), "w") as f:
+            json.dump({'packages': packages}, f, indent=4)
+        return layer
+
+    def __venv(self, path: str) -> (bool, str):
+        result = self.shell.run(f"python3 -m venv {shlex.quote(path)}", cwd=self.root)
+        if result.returncode != 0:
+            return False, result.stderr or "Failed to create venv"
+        return True, ""
+
+    def __build_lock(self, digest: str) -> threading.Lock:
+        with self._lock:
+            return self._build_locks.setdefault(digest, threading.Lock())
+
+    @staticmethod
+    def __forget(refs: Dict[str, list], project_id: str):
+        for users in refs.values():
+            if project_id in users:
+                users.remove(project_id)
+
+    def __collect(self, refs: Dict[str, list]):
+        for path in glob.glob(os.path.join(self.layers_directory, "*", "")):
+            digest = os.path.basename(os.path.dirname(path))
+            if not refs.get(digest):
+                shutil.rmtree(path, ignore_errors=True)
+                refs.pop(digest, None)
+        self.__save_refs(refs)
+
+    def __load_refs(self) -> Dict[str, list]:
+        try:
+            with open(os.path.join(self.layers_directory, "refs.json"), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def __save_refs(self, refs: Dict[str, list]):
+        os.makedirs(self.layers_directory, exist_ok=True)
+        path = os.path.join(self.layers_directory, "refs.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(refs, f, indent=4)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def layer_site_packages(cls, environment: str) -> Optional[str]:
+        """
+        The base layer site-packages that the venv's .pth file adds, or None if the venv has no base layer.
+        """
+        project_site = cls.__site_packages(environment)
+        if project_site is None:
+            return None
+        try:
+            with open(os.path.join(project_site, cls.PTH_FILE)) as f:
+                line = f.readline().strip()
+        except FileNotFoundError:
+            return None
+        prefix = "import site; site.addsitedir("
+        if not line.startswith(prefix):
+            # Venvs created before the .pth used addsitedir hold the bare path
+            return line or None
+        try:
+            return ast.literal_eval(line[len(prefix):].rstrip(")"))
+        except (ValueError, SyntaxError):
+            return None
+
+    @staticmethod
+    def __site_packages(environment: str) -> Optional[str]:
+        paths = sorted(glob.glob(os.path.join(environment, "lib", "python*", "site-packages")))
+        return paths[0] if paths else None
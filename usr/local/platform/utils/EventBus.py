@@ -0,0 +1,31 @@
+import threading
+from typing import Callable, Dict, List
+
+
+class EventBus:
+    """
+    Fans events out from the shared runtime to every attached frontend (BLE, TCP, ...).
+
+    Callbacks run synchronously on the publishing thread, so frontends should hand work off to their own
+    event loop rather than blocking here. A failing subscriber never prevents the others from being notified.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, List[Callable]] = {}
+
+    def subscribe(self, event: str, callback: Callable):
+        with self._lock:
+            # Copy on write so publish can iterate without holding the lock
+            self._subscribers[event] = self._subscribers.get(event, []) + [callback]
+
+    def unsubscribe(self, event: str, callback: Callable):
+        with self._lock:
+            self._subscribers[event] = [c for c in self._subscribers.get(event, []) if c is not callback]
+
+    def publish(self, event: str, *args):
+        for callback in self._subscribers.get(event, []):
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Error in {event} subscriber: {e}")
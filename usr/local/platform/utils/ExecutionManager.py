@@ -1,71 +1,123 @@
 import os
+import signal
 import subprocess
 import threading
 import time
-from time import sleep
+from typing import Callable, Optional, Sequence
+
+from utils import Metrics
+from utils.InterpreterPool import InterpreterPool
+from utils.LogBuffer import LogRingBuffer
+from utils.LogPipeline import LogBatch, LogPipeline, LogStreamStats
+from utils.Watchdog import Watchdog
+
+TIME_TO_FIRST_OUTPUT = Metrics.histogram(
+    "platform_time_to_first_output_seconds", "From execute-target to the program's first output", ("mode",)
+)
 
 
 class ExecutionManager:
-    def __init__(self, stdout, stderr):
+    DEFAULT_HEARTBEAT_TIMEOUT = 2.5
+    DEFAULT_SIGINT_GRACE = 0.5
+    DEFAULT_SIGTERM_GRACE = 0.5
+    # Imported in warm interpreters when the project doesn't list its own
+    DEFAULT_WARM_IMPORTS = ("cyberonics_py",)
+
+    def __init__(self, stdout: Callable[[LogBatch], None], stderr: Callable[[LogBatch], None]):
         self.is_running = False
         self.pid = None
         self.stdout = stdout
         self.stderr = stderr
-        self.heartbeat_timestamp = time.time()
-        self.heartbeat_thread = threading.Thread(target=self._monitor_heartbeat, daemon=True)
-        self.heartbeat_thread.start()
+        # Recent output is kept so reconnecting clients can catch up with logs_since
+        self.log_buffer = LogRingBuffer()
+        self.stream_stats = {'stdout': LogStreamStats(), 'stderr': LogStreamStats()}
+        self.sigint_grace = self.DEFAULT_SIGINT_GRACE
+        self.sigterm_grace = self.DEFAULT_SIGTERM_GRACE
+        self.process_lock = threading.Lock()
+        # Armed only while a program runs; kills it if the driver station stops sending heartbeats
+        self.watchdog = Watchdog(on_expire=self.__heartbeat_lost)
+        self.interpreter_pool = InterpreterPool()
+        # Startup of the current (or last) program: how it was started and how long until it printed anything
+        self.run_stats = {}
+        # (python, environment, imports) to park a fresh warm interpreter for once the current program exits
+        self._rewarm = None
 
     def beat(self):
-        self.heartbeat_timestamp = time.time()
+        self.watchdog.feed()
 
-    def _monitor_heartbeat(self):
-        while True:
-            if time.time() - self.heartbeat_timestamp > 2.5:
-                self.kill_program()
-            sleep(1)
+    def __heartbeat_lost(self):
+        print("Heartbeat lost, stopping program")
+        self.kill_program()
 
     def run_python_program(
             self,
             environment: str,
-            script_path: str
+            script_path: str,
+            heartbeat_timeout: Optional[float] = None,
+            sigint_grace: Optional[float] = None,
+            sigterm_grace: Optional[float] = None,
+            warm_start: bool = False,
+            warm_imports: Optional[Sequence[str]] = None
     ) -> bool:
         """
         Executes a Python script using the Python interpreter from the specified virtual environment.
-        Sends stdout and stderr data as it comes in to self.stdout(data) and self.stderr(data).
+        Sends stdout and stderr as batches of lines to self.stdout(batch) and self.stderr(batch).
 
         :param environment: Path to the virtual environment directory.
         :param script_path: Absolute path to the Python script to execute.
+        :param heartbeat_timeout: Seconds without a heartbeat before the program is stopped.
+        :param sigint_grace: Seconds to wait after SIGINT before escalating to SIGTERM when stopping.
+        :param sigterm_grace: Seconds to wait after SIGTERM before escalating to SIGKILL when stopping.
+        :param warm_start: Run in an interpreter parked with warm_imports already imported, if one is ready,
+            and park a new one once this program exits.
+        :param warm_imports: Modules the warm interpreter imports ahead of time.
         :return: True if the process starts successfully, False otherwise.
         """
+        self.sigint_grace = self.DEFAULT_SIGINT_GRACE if sigint_grace is None else sigint_grace
+        self.sigterm_grace = self.DEFAULT_SIGTERM_GRACE if sigterm_grace is None else sigterm_grace
 
         try:
-            # Determine the path to the Python executable inside the virtual environment
-            if os.name == 'nt':  # For Windows
-                python_executable = os.path.join(environment, 'Scripts', 'python.exe')
-            else:  # For Unix/Linux/MacOS
-                python_executable = os.path.join(environment, 'bin', 'python')
+            python_executable = self.python_executable(environment)
 
             # Check if the Python executable exists
             if not os.path.isfile(python_executable):
                 print(f"Python executable not found at: {python_executable}")
                 return False
 
-            # Start the subprocess without using the shell
+            started = time.monotonic()
+            process = None
+            warm_imports = tuple(self.DEFAULT_WARM_IMPORTS if warm_imports is None else warm_imports)
+            if warm_start and self.interpreter_pool.supported():
+                process = self.interpreter_pool.acquire(environment, warm_imports, script_path)
+                # Parked after this run rather than now, so the new interpreter's imports don't compete with
+                # the program's own startup
+                self._rewarm = (python_executable, environment, warm_imports)
+            else:
+                self._rewarm = None
+            self.run_stats = {'mode': 'warm' if process is not None else 'cold', 'started': time.time(), 'time_to_first_output_ms': None}
+
+            for stats in self.stream_stats.values():
+                stats.reset()
+
+            # Start the subprocess without using the shell, in its own process group so that stopping it also
+            # stops anything it spawned
             self.is_running = True
-            self.pid = subprocess.Popen(
-                [python_executable, '-u', script_path],  # '-u' for unbuffered output
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,  # For Python 3.7+, ensures output is in string format
-                bufsize=1,  # Line-buffered
-                universal_newlines=True
-            )
+            if process is None:
+                process = subprocess.Popen(
+                    [python_executable, '-u', script_path],  # '-u' for unbuffered output
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    bufsize=0,  # Raw bytes; LogPipeline does its own line splitting and batching
+                    start_new_session=os.name != 'nt'
+                )
+            self.pid = process
+            self.watchdog.arm(self.DEFAULT_HEARTBEAT_TIMEOUT if heartbeat_timeout is None else heartbeat_timeout)
 
-            # Start threads to read stdout and stderr and send data to self.stdout and self.stderr
+            # Start threads to read stdout and stderr and send batches to self.stdout and self.stderr
             if self.pid.stdout:
                 stdout_thread = threading.Thread(
                     target=self.__read_stream,
-                    args=(self.pid.stdout, self.stdout),
+                    args=('stdout', self.pid.stdout, self.__first_output(self.stdout, started, self.run_stats)),
                     daemon=True
                 )
                 stdout_thread.start()
@@ -73,7 +125,7 @@ class ExecutionManager:
             if self.pid.stderr:
                 stderr_thread = threading.Thread(
                     target=self.__read_stream,
-                    args=(self.pid.stderr, self.stderr),
+                    args=('stderr', self.pid.stderr, self.__first_output(self.stderr, started, self.run_stats)),
                     daemon=True
                 )
                 stderr_thread.start()
@@ -101,31 +153,101 @@ class ExecutionManager:
             return False
 
 
+    @staticmethod
+    def python_executable(environment: str) -> str:
+        # Determine the path to the Python executable inside the virtual environment
+        if os.name == 'nt':  # For Windows
+            return os.path.join(environment, 'Scripts', 'python.exe')
+        return os.path.join(environment, 'bin', 'python')  # For Unix/Linux/MacOS
+
+    def prewarm(self, environment: str, warm_imports: Optional[Sequence[str]] = None):
+        """
+        Parks a warm interpreter for environment ahead of the first warm run.
+        """
+        warm_imports = tuple(self.DEFAULT_WARM_IMPORTS if warm_imports is None else warm_imports)
+        self.interpreter_pool.prepare(self.python_executable(environment), environment, warm_imports)
+
+    def __first_output(self, output_func: Callable[[LogBatch], None], started: float, run_stats: dict) -> Callable[[LogBatch], None]:
+        def output(batch: LogBatch):
+            # Both streams' readers race here; only the first batch of the run counts
+            with self.process_lock:
+                first = run_stats.get('time_to_first_output_ms') is None
+                if first:
+                    elapsed = time.monotonic() - started
+                    run_stats['time_to_first_output_ms'] = elapsed * 1000
+            if first:
+                TIME_TO_FIRST_OUTPUT.observe(elapsed, mode=run_stats['mode'])
+            output_func(batch)
+        return output
+
     def kill_program(self):
-        if self.is_running:
-            self.pid.kill()
+        """
+        Stops the running program, escalating SIGINT -> SIGTERM -> SIGKILL over its process group.
+        SIGINT gives the program a chance to run its KeyboardInterrupt handlers (e.g. to park servos).
+        """
+        with self.process_lock:
+            if not self.is_running:
+                return
             self.is_running = False
+            process = self.pid
+        self.watchdog.disarm()
+
+        for sig, grace in ((signal.SIGINT, self.sigint_grace), (signal.SIGTERM, self.sigterm_grace)):
+            self.__signal_process_group(process, sig)
+            try:
+                process.wait(grace)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+        self.__signal_process_group(process, signal.SIGKILL if os.name != 'nt' else signal.SIGTERM)
+
+    @staticmethod
+    def __signal_process_group(process: subprocess.Popen, sig: int):
+        try:
+            if os.name == 'nt':
+                process.kill()
+            else:
+                os.killpg(process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            # Already exited
+            pass
+
+
+    def logs_since(self, after_seq: int = 0, limit: int = None) -> dict:
+        """
+        Returns buffered output records with a sequence id greater than after_seq. See LogRingBuffer.since.
+        """
+        return self.log_buffer.since(after_seq, limit)
 
+    def log_stats(self) -> dict:
+        """
+        Returns throughput and batching lag counters for each output stream.
+        """
+        return {name: stats.to_dict() for name, stats in self.stream_stats.items()}
 
-    def __read_stream(self, stream, output_func):
+    def __read_stream(self, stream_name, stream, output_func):
         """
-        Reads the stream line by line and sends the data to the given output function.
+        Reads the stream and sends batches of lines to the given output function.
 
+        :param stream_name: 'stdout' or 'stderr'.
         :param stream: The stream to read from (stdout or stderr).
-        :param output_func: The function to call with the stream data.
+        :param output_func: The function to call with each LogBatch.
         """
-        try:
-            for line in iter(stream.readline, ''):
-                output_func(line)
-        except Exception as e:
-            print(f"Error reading stream: {e}")
-        finally:
-            stream.close()
+        LogPipeline(stream_name, stream, output_func, self.log_buffer.record, self.stream_stats[stream_name]).run()
 
     def __wait_for_process(self):
         """
         Waits for the subprocess to finish and updates the is_running flag.
         """
-        if self.pid:
-            self.pid.wait()
-            self.is_running = False
\ No newline at end of file
+        process = self.pid
+        if process:
+            process.wait()
+            with self.process_lock:
+                if self.pid is process:
+                    self.is_running = False
+                    self.watchdog.disarm()
+                    rewarm, self._rewarm = self._rewarm, None
+                else:
+                    rewarm = None
+            if rewarm is not None:
+                self.interpreter_pool.prepare(*rewarm)
@@ -0,0 +1,151 @@
+import os
+import threading
+from typing import Optional
+
+
+class GitRepository:
+    """
+    Reads branch and commit metadata straight from a repository's .git directory instead of forking git.
+
+    HEAD, loose refs and packed-refs are parsed once and cached. Each query stats those files and only
+    re-reads them when their mtimes change, so after a checkout or pull the next query sees the new state
+    while repeated polling costs a handful of stat calls. Anything that changes the repository (checkout,
+    pull, clone) should still go through git itself.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.git_dir = self.__find_git_dir(path)
+        self.common_dir = self.__find_common_dir(self.git_dir)
+        self._lock = threading.Lock()
+        self._signature = None
+        self._head = None
+        self._refs = {}
+
+    @property
+    def exists(self) -> bool:
+        return self.git_dir is not None
+
+    def current_branch(self) -> Optional[str]:
+        """
+        Returns the checked out branch, or None when HEAD is detached.
+        """
+        head, _ = self.__state()
+        if head.startswith("ref: refs/heads/"):
+            return head[len("ref: refs/heads/"):]
+        return None
+
+    def head_commit(self) -> Optional[str]:
+        head, refs = self.__state()
+        if head.startswith("ref: "):
+            return self.__resolve(head[len("ref: "):], refs)
+        return head or None
+
+    def local_branches(self) -> [str]:
+        _, refs = self.__state()
+        return [name[len("refs/heads/"):] for name in refs if name.startswith("refs/heads/")]
+
+    def remote_branches(self) -> [str]:
+        """
+        Returns remote branches as '<remote>/<branch>', skipping the symbolic <remote>/HEAD.
+        """
+        _, refs = self.__state()
+        return [
+            name[len("refs/remotes/"):] for name in refs
+            if name.startswith("refs/remotes/") and not name.endswith("/HEAD")
+        ]
+
+    def invalidate(self):
+        with self._lock:
+            self._signature = None
+
+    def __state(self) -> (str, dict):
+        if self.git_dir is None:
+            self.git_dir = self.__find_git_dir(self.path)
+            if self.git_dir is None:
+                raise FileNotFoundError(f"Not a git repository: {self.path}")
+            self.common_dir = self.__find_common_dir(self.git_dir)
+        with self._lock:
+            signature = self.__current_signature()
+            if signature != self._signature:
+                self._head = self.__read_head()
+                self._refs = self.__read_refs()
+                self._signature = signature
+            return self._head, self._refs
+
+    def __current_signature(self):
+        # Git updates HEAD, packed-refs and loose refs by writing a .lock file and renaming it into place, so a
+        # change to any ref shows up in the mtime of HEAD, packed-refs or the directory containing the ref
+        signature = []
+        for path in (os.path.join(self.git_dir, "HEAD"), os.path.join(self.common_dir, "packed-refs")):
+            try:
+                signature.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                signature.append(None)
+        refs_dir = os.path.join(self.common_dir, "refs")
+        for root, dirs, _ in os.walk(refs_dir):
+            if root == refs_dir and "tags" in dirs:
+                dirs.remove("tags")
+            signature.append((root, os.stat(root).st_mtime_ns))
+        return tuple(signature)
+
+    def __read_head(self) -> str:
+        with open(os.path.join(self.git_dir, "HEAD")) as f:
+            return f.read().strip()
+
+    def __read_refs(self) -> dict:
+        refs = {}
+        packed_refs = os.path.join(self.common_dir, "packed-refs")
+        if os.path.isfile(packed_refs):
+            with open(packed_refs) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#") or line.startswith("^"):
+                        continue
+                    sha, _, name = line.partition(" ")
+                    refs[name] = sha
+
+        # Loose refs take precedence over packed ones
+        refs_dir = os.path.join(self.common_dir, "refs")
+        for root, dirs, files in os.walk(refs_dir):
+            if root == refs_dir and "tags" in dirs:
+                dirs.remove("tags")
+            for file in files:
+                if file.endswith(".lock"):
+                    continue
+                path = os.path.join(root, file)
+                name = os.path.relpath(path, self.common_dir).replace(os.sep, "/")
+                with open(path) as f:
+                    refs[name] = f.read().strip()
+        return refs
+
+    @staticmethod
+    def __resolve(name: str, refs: dict, depth: int = 0) -> Optional[str]:
+        value = refs.get(name)
+        if value is not None and value.startswith("ref: ") and depth < 5:
+            return GitRepository.__resolve(value[len("ref: "):], refs, depth + 1)
+        return value
+
+    @staticmethod
+    def __find_common_dir(git_dir: Optional[str]) -> Optional[str]:
+        # Linked worktrees keep their own HEAD but share refs with the main repository
+        if git_dir is None:
+            return None
+        common_file = os.path.join(git_dir, "commondir")
+        if os.path.isfile(common_file):
+            with open(common_file) as f:
+                return os.path.normpath(os.path.join(git_dir, f.read().strip()))
+        return git_dir
+
+    @staticmethod
+    def __find_git_dir(path: str) -> Optional[str]:
+        git_path = os.path.join(path, ".git")
+        if os.path.isdir(git_path):
+            return git_path
+        if os.path.isfile(git_path):
+            # Worktrees and submodules point at the real git dir
+            with open(git_path) as f:
+                content = f.read().strip()
+            if content.startswith("gitdir: "):
+                return os.path.normpath(os.path.join(path, content[len("gitdir: "):]))
+        return None
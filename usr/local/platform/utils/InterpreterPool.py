@@ -0,0 +1,211 @@
+import atexit
+import glob
+import os
+import signal
+import subprocess
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from utils import Metrics
+from utils.EnvironmentManager import EnvironmentManager
+
+WARM_POOL = Metrics.counter("platform_warm_pool_total", "Warm interpreter requests and evictions", ("result",))
+
+
+# Runs in the parked interpreter. Imports the modules named on the command line, then blocks until the agent
+# writes the path of the script to run on stdin, and runs it the way `python -u script` would.
+BOOTSTRAP = r"""
+import importlib, os, runpy, sys
+# Nothing reads the pipes while the interpreter is parked, so anything the imports print (from Python or C)
+# would pile up there, and later be read as the program's first output
+saved = os.dup(1), os.dup(2)
+devnull = os.open(os.devnull, os.O_RDWR)
+os.dup2(devnull, 1)
+os.dup2(devnull, 2)
+try:
+    for name in sys.argv[1:]:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+finally:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(saved[0], 1)
+    os.dup2(saved[1], 2)
+    os.close(saved[0])
+    os.close(saved[1])
+script = sys.stdin.readline().rstrip("\n")
+if not script:
+    sys.exit(0)
+os.dup2(devnull, 0)
+os.close(devnull)
+sys.stdin = open(0, closefd=False)
+sys.argv = [script]
+sys.path[0] = os.path.dirname(script)
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+class WarmInterpreter:
+    def __init__(self, process: subprocess.Popen, preload: Tuple[str, ...], signature: tuple):
+        self.process = process
+        self.preload = preload
+        self.signature = signature
+        self.parked_at = time.monotonic()
+
+
+class InterpreterPool:
+    """
+    Keeps one started interpreter per project venv parked with its heavy imports (cyberonics_py, numpy, ...)
+    already done, so execute-target only pays for the user's script.
+
+    A parked interpreter is used once: taking it hands it a script and the caller owns the process from then
+    on. It is discarded instead if the venv changed since it started (a pip install touches site-packages),
+    if it asked for different preloads, or if it died. Interpreters idle for longer than idle_timeout are
+    stopped. POSIX only, since it relies on process groups like the cold path.
+    """
+
+    def __init__(self, idle_timeout: float = 600.0):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._parked: Dict[str, WarmInterpreter] = {}
+        self._timers: Dict[str, threading.Timer] = {}
+        atexit.register(self.shutdown)
+
+    @staticmethod
+    def supported() -> bool:
+        return os.name != 'nt'
+
+    def prepare(self, python_executable: str, environment: str, preload: Tuple[str, ...]):
+        """
+        Parks an interpreter for environment unless a usable one is already waiting.
+        """
+        if not self.supported() or not os.path.isfile(python_executable):
+            return
+        preload = tuple(preload)
+        with self._lock:
+            current = self._parked.get(environment)
+            if current is not None and self.__usable(current, environment, preload):
+                return
+            self.__discard(environment)
+            try:
+                process = subprocess.Popen(
+                    [python_executable, '-u', '-c', BOOTSTRAP, *preload],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    bufsize=0,
+                    start_new_session=True
+                )
+            except OSError as e:
+                print(f"Failed to start warm interpreter: {e}")
+                return
+            self._parked[environment] = WarmInterpreter(process, preload, self.__signature(environment))
+            timer = threading.Timer(self.idle_timeout, self.__evict, args=(environment, process))
+            timer.daemon = True
+            timer.start()
+            self._timers[environment] = timer
+
+    def acquire(self, environment: str, preload: Tuple[str, ...], script_path: str) -> Optional[subprocess.Popen]:
+        """
+        Starts script_path in the parked interpreter for environment.
+
+        :return: The running process, or None if no usable interpreter was parked and the caller should cold start.
+        """
+        with self._lock:
+            interpreter = self._parked.get(environment)
+            if interpreter is None:
+                WARM_POOL.inc(result="miss")
+                return None
+            if not self.__usable(interpreter, environment, tuple(preload)):
+                WARM_POOL.inc(result="invalidated")
+                self.__discard(environment)
+                return None
+            self._parked.pop(environment)
+            timer = self._timers.pop(environment, None)
+            if timer is not None:
+                timer.cancel()
+
+        try:
+            interpreter.process.stdin.write(script_path.encode("utf-8") + b"\n")
+            interpreter.process.stdin.close()
+        except OSError:
+            WARM_POOL.inc(result="invalidated")
+            self.__stop(interpreter.process)
+            return None
+        WARM_POOL.inc(result="hit")
+        return interpreter.process
+
+    def invalidate(self, environment: str):
+        with self._lock:
+            self.__discard(environment)
+
+    def shutdown(self):
+        with self._lock:
+            for environment in list(self._parked):
+                self.__discard(environment)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                environment: {'pid': interpreter.process.pid, 'idle_s': now - interpreter.parked_at, 'preload': list(interpreter.preload)}
+                for environment, interpreter in self._parked.items()
+            }
+
+    def __usable(self, interpreter: WarmInterpreter, environment: str, preload: Tuple[str, ...]) -> bool:
+        return (
+            interpreter.process.poll() is None
+            and interpreter.preload == preload
+            and interpreter.signature == self.__signature(environment)
+        )
+
+    def __evict(self, environment: str, process: subprocess.Popen):
+        with self._lock:
+            interpreter = self._parked.get(environment)
+            if interpreter is None or interpreter.process is not process:
+                return
+            WARM_POOL.inc(result="evicted")
+            self.__discard(environment)
+
+    def __discard(self, environment: str):
+        interpreter = self._parked.pop(environment, None)
+        timer = self._timers.pop(environment, None)
+        if timer is not None:
+            timer.cancel()
+        if interpreter is not None:
+            self.__stop(interpreter.process)
+
+    @staticmethod
+    def __stop(process: subprocess.Popen):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        for stream in (process.stdin, process.stdout, process.stderr):
+            if stream is not None:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        # Reap it off the caller's thread
+        threading.Thread(target=process.wait, daemon=True).start()
+
+    @staticmethod
+    def __signature(environment: str) -> tuple:
+        # pip adds and removes dist-info directories, which changes site-packages' mtime. The base layer's
+        # site-packages is on the interpreter's path too, so a layer that is rebuilt also counts as a change
+        paths = [os.path.join(environment, "pyvenv.cfg")]
+        paths += sorted(glob.glob(os.path.join(environment, "lib", "python*", "site-packages")))
+        layer_site = EnvironmentManager.layer_site_packages(environment)
+        if layer_site is not None:
+            paths.append(layer_site)
+        signature = []
+        for path in paths:
+            try:
+                signature.append((path, os.stat(path).st_mtime_ns))
+            except FileNotFoundError:
+                signature.append((path, None))
+        return tuple(signature)
@@ -0,0 +1,55 @@
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from utils.LogPipeline import LogBatch
+
+
+class LogRingBuffer:
+    """
+    Fixed-memory history of recent program output so clients that (re)connect can catch up on what they missed.
+
+    Every batch is given the next sequence id as it is recorded, under the same lock, so records are always
+    stored in sequence order. The oldest records are evicted once either max_records or max_bytes is exceeded.
+    """
+
+    def __init__(self, max_records: int = 4096, max_bytes: int = 256 * 1024):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._records = deque()
+        self._bytes = 0
+        self._last_seq = 0
+
+    def record(self, stream: str, text: str, lines: int) -> LogBatch:
+        with self._lock:
+            self._last_seq += 1
+            batch = LogBatch(stream, self._last_seq, text, lines, time.time())
+            self._records.append(batch)
+            self._bytes += len(text)
+            while self._records and (len(self._records) > self.max_records or self._bytes > self.max_bytes):
+                self._bytes -= len(self._records.popleft().text)
+            return batch
+
+    def since(self, after_seq: int = 0, limit: Optional[int] = None) -> dict:
+        """
+        Returns the records with a sequence id greater than after_seq, oldest first.
+
+        :param after_seq: The last sequence id the client has seen.
+        :param limit: Maximum number of records to return; the client can ask again from the last one it got.
+        :return: {'first_seq', 'last_seq', 'records'}. If after_seq + 1 < first_seq, output was evicted.
+        """
+        with self._lock:
+            first_seq = self._records[0].seq if self._records else self._last_seq + 1
+            # Records are contiguous, so the start index can be computed instead of searched for
+            start = max(0, after_seq + 1 - first_seq)
+            end = len(self._records) if limit is None else min(len(self._records), start + limit)
+            # Indexing a deque walks it from the nearer end, so slice it in one pass instead
+            records = [record.to_dict() for record in itertools.islice(self._records, start, end)]
+            return {
+                'first_seq': first_seq,
+                'last_seq': self._last_seq,
+                'records': records
+            }
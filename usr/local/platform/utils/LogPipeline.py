@@ -0,0 +1,173 @@
+import codecs
+import os
+import select
+import time
+from typing import Callable
+
+from utils import Metrics
+
+LOG_LINES = Metrics.counter("platform_log_lines_total", "Program output lines streamed", ("stream",))
+LOG_BYTES = Metrics.counter("platform_log_bytes_total", "Program output bytes read", ("stream",))
+
+
+class LogBatch:
+    """
+    A run of complete output lines from one stream, flushed together.
+
+    seq is assigned by the ExecutionManager's LogRingBuffer. It is shared by every stream and increases by one
+    per batch, so a client that sees a jump knows it missed output.
+    """
+
+    def __init__(self, stream: str, seq: int, text: str, lines: int, timestamp: float):
+        self.stream = stream
+        self.seq = seq
+        self.text = text
+        self.lines = lines
+        self.timestamp = timestamp
+
+    def to_dict(self) -> dict:
+        return {
+            'stream': self.stream,
+            'seq': self.seq,
+            'text': self.text,
+            'lines': self.lines,
+            'timestamp': self.timestamp
+        }
+
+
+class LogStreamStats:
+    """
+    Counters for one output stream of the current (or last) program. Reset when a program starts, so
+    bytes_per_second is the rate over that run rather than over the agent's lifetime.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        # Set at EOF so the rate of a finished run doesn't keep decaying
+        self.finished = None
+        self.bytes = 0
+        self.lines = 0
+        self.batches = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def to_dict(self) -> dict:
+        end = self.finished if self.finished is not None else time.monotonic()
+        elapsed = max(end - self.started, 1e-9)
+        return {
+            'bytes': self.bytes,
+            'lines': self.lines,
+            'batches': self.batches,
+            'bytes_per_second': self.bytes / elapsed,
+            'last_lag_ms': self.last_lag * 1000,
+            'max_lag_ms': self.max_lag * 1000
+        }
+
+
+class LogPipeline:
+    """
+    Reads raw bytes from a child process pipe, splits them into lines incrementally and hands them to
+    output_func in batches. A batch is flushed once it holds max_batch_bytes or once flush_interval has passed
+    since its first line arrived, whichever comes first, so chatty programs produce a few large messages
+    instead of one notification per line.
+    """
+
+    def __init__(
+            self,
+            stream_name: str,
+            stream,
+            output_func: Callable[[LogBatch], None],
+            record: Callable[[str, str, int], LogBatch],
+            stats: LogStreamStats,
+            flush_interval: float = 0.02,
+            max_batch_bytes: int = 4096
+    ):
+        self.stream_name = stream_name
+        self.stream = stream
+        self.output_func = output_func
+        self.record = record
+        self.stats = stats
+        self.flush_interval = flush_interval
+        self.max_batch_bytes = max_batch_bytes
+        # Pipes can't be select()ed on Windows, so there we flush after every read instead
+        self.can_select = os.name != 'nt'
+
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._partial = ""
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_started = None
+
+    def run(self):
+        """
+        Reads until EOF. Blocks, so run it on its own thread.
+        """
+        fd = self.stream.fileno()
+        try:
+            while True:
+                if self.can_select:
+                    timeout = None
+                    if self._batch_started is not None:
+                        timeout = max(0.0, self._batch_started + self.flush_interval - time.monotonic())
+                    readable, _, _ = select.select([fd], [], [], timeout)
+                    if not readable:
+                        self.__flush()
+                        continue
+
+                chunk = os.read(fd, self.max_batch_bytes)
+                if not chunk:
+                    break
+                self.__feed(chunk)
+                if self._batch_bytes >= self.max_batch_bytes or not self.can_select:
+                    self.__flush()
+
+            self._partial += self._decoder.decode(b"", final=True)
+            if self._partial:
+                self.__add(self._partial, len(self._partial.encode("utf-8")))
+                self._partial = ""
+            self.__flush()
+        except Exception as e:
+            print(f"Error reading stream: {e}")
+        finally:
+            self.stats.finished = time.monotonic()
+            self.stream.close()
+
+    def __feed(self, chunk: bytes):
+        self.stats.bytes += len(chunk)
+        LOG_BYTES.inc(len(chunk), stream=self.stream_name)
+        self._partial += self._decoder.decode(chunk)
+        newline = self._partial.rfind("\n")
+        if newline != -1:
+            complete = self._partial[:newline + 1]
+            self._partial = self._partial[newline + 1:]
+            self.__add(complete, len(complete.encode("utf-8")))
+        elif len(self._partial) >= self.max_batch_bytes:
+            # A single enormous line; don't hold it back forever
+            self.__add(self._partial, len(self._partial.encode("utf-8")))
+            self._partial = ""
+
+    def __add(self, text: str, size: int):
+        if self._batch_started is None:
+            self._batch_started = time.monotonic()
+        self._batch.append(text)
+        self._batch_bytes += size
+
+    def __flush(self):
+        if not self._batch:
+            return
+        text = "".join(self._batch)
+        lines = text.count("\n")
+        lag = time.monotonic() - self._batch_started
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_started = None
+
+        self.stats.lines += lines
+        LOG_LINES.inc(lines, stream=self.stream_name)
+        self.stats.batches += 1
+        self.stats.last_lag = lag
+        self.stats.max_lag = max(self.stats.max_lag, lag)
+        self.output_func(self.record(self.stream_name, text, lines))
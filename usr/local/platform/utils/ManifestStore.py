@@ -0,0 +1,187 @@
+import atexit
+import copy
+import json
+import os
+import tempfile
+import threading
+from typing import Callable, Optional
+
+
+class ManifestStore:
+    """
+    Keeps the parsed manifest.json in memory so command handlers don't reopen and re-parse it on every request.
+
+    Reads are served from memory behind a lock. The file is only re-read when its mtime/inode/size change
+    underneath us (e.g. someone edited it by hand). Writes are applied in memory immediately and persisted
+    with a coalesced write-behind: several changes in quick succession produce a single atomic
+    temp-file + rename write.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path: str, write_delay: float = 0.25):
+        self.path = path
+        self.write_delay = write_delay
+        self._lock = threading.RLock()
+        self._manifest = {}
+        self._projects = {}
+        self._file_signature = None
+        self._dirty = False
+        self._write_timer: Optional[threading.Timer] = None
+        self.__load()
+        atexit.register(self.flush)
+
+    @classmethod
+    def shared(cls) -> "ManifestStore":
+        """
+        Returns the process-wide store for manifest.json in the platform's working directory.
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(os.path.join(os.getcwd(), "manifest.json"))
+            return cls._shared
+
+    # Reads
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            self.__reload_if_changed()
+            return copy.deepcopy(self._manifest.get(key, default))
+
+    @property
+    def selected_project(self) -> Optional[str]:
+        return self.get("selected_project")
+
+    def project_ids(self) -> [str]:
+        with self._lock:
+            self.__reload_if_changed()
+            return [p["id"] for p in self._manifest.get("projects", [])]
+
+    def project(self, project_id: str) -> Optional[dict]:
+        with self._lock:
+            self.__reload_if_changed()
+            project = self._projects.get(project_id)
+            return copy.deepcopy(project) if project is not None else None
+
+    def selected(self) -> Optional[dict]:
+        """
+        Returns the entry of the currently selected project, or None if it isn't in the manifest.
+        """
+        with self._lock:
+            self.__reload_if_changed()
+            project = self._projects.get(self._manifest.get("selected_project"))
+            return copy.deepcopy(project) if project is not None else None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self.__reload_if_changed()
+            return copy.deepcopy(self._manifest)
+
+    # Writes
+
+    def update(self, mutator: Callable[[dict], None]):
+        """
+        Applies mutator to the in-memory manifest under the lock and schedules a write-behind.
+
+        :param mutator: Function that edits the manifest dict in place.
+        """
+        with self._lock:
+            self.__reload_if_changed()
+            mutator(self._manifest)
+            self.__reindex()
+            self.__schedule_write()
+
+    def set_selected_project(self, project_id: str):
+        self.update(lambda manifest: manifest.__setitem__("selected_project", project_id))
+
+    def set_project_field(self, project_id: str, key: str, value) -> bool:
+        with self._lock:
+            self.__reload_if_changed()
+            project = self._projects.get(project_id)
+            if project is None:
+                return False
+            project[key] = value
+            self.__schedule_write()
+            return True
+
+    def add_project(self, project: dict):
+        self.update(lambda manifest: manifest.setdefault("projects", []).append(project))
+
+    def remove_project(self, project_id: str):
+        def remove(manifest):
+            manifest["projects"] = [p for p in manifest.get("projects", []) if p["id"] != project_id]
+        self.update(remove)
+
+    def flush(self):
+        """
+        Writes any pending changes to disk immediately.
+        """
+        with self._lock:
+            if self._write_timer is not None:
+                self._write_timer.cancel()
+                self._write_timer = None
+            if self._dirty:
+                self.__write()
+
+    # Internals
+
+    def __signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def __load(self):
+        signature = self.__signature()
+        if signature is None:
+            self._manifest = {}
+        else:
+            with open(self.path) as f:
+                self._manifest = json.load(f)
+        self._file_signature = signature
+        self.__reindex()
+
+    def __reload_if_changed(self):
+        # Pending in-memory changes win over the file until they are flushed
+        if self._dirty:
+            return
+        if self.__signature() != self._file_signature:
+            try:
+                self.__load()
+            except (OSError, json.JSONDecodeError) as e:
+                # Likely caught mid-write by another editor; keep serving the last good copy
+                print(f"Failed to reload manifest: {e}")
+
+    def __reindex(self):
+        self._projects = {p["id"]: p for p in self._manifest.get("projects", [])}
+
+    def __schedule_write(self):
+        self._dirty = True
+        if self._write_timer is not None:
+            return
+        self._write_timer = threading.Timer(self.write_delay, self.flush)
+        self._write_timer.daemon = True
+        self._write_timer.start()
+
+    def __write(self):
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp_path = tempfile.mkstemp(prefix=".manifest.", suffix=".tmp", dir=directory)
+        try:
+            if os.path.exists(self.path):
+                os.chmod(tmp_path, os.stat(self.path).st_mode & 0o777)
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._manifest, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"Failed to write manifest: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._dirty = False
+        self._file_signature = self.__signature()
@@ -0,0 +1,235 @@
+import bisect
+import math
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Optional, Tuple
+
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric(ABC):
+    TYPE = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def remove(self, **labels):
+        """
+        Forgets one label combination, e.g. a client that disconnected.
+        """
+        with self._lock:
+            self._series().pop(self._key(labels), None)
+
+    @abstractmethod
+    def samples(self) -> [Tuple[str, dict, float]]:
+        pass
+
+    @abstractmethod
+    def _series(self) -> dict:
+        pass
+
+    def _key(self, labels: dict) -> LabelValues:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _label_dict(self, key: LabelValues) -> dict:
+        return dict(zip(self.labels, key))
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._label_dict(key), value) for key, value in self._values.items()]
+
+    def _series(self) -> dict:
+        return self._values
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """
+        Reads the value from function at scrape time, for things like queue lengths that are cheaper to look
+        at than to track.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def remove(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+            self._functions.pop(key, None)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                continue
+        return [(self.name, self._label_dict(key), value) for key, value in values.items()]
+
+    def _series(self) -> dict:
+        return self._values
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    # Seconds; covers everything from a cached query to a slow pip install
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = None):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        # Label values -> [per-bucket counts (+Inf last), sum, count]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                labels = self._label_dict(key)
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += bucket_count
+                    samples.append((self.name + "_bucket", {**labels, 'le': _format_value(bound)}, cumulative))
+                samples.append((self.name + "_sum", labels, total))
+                samples.append((self.name + "_count", labels, count))
+        return samples
+
+    def _series(self) -> dict:
+        return self._values
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms for the agent's hot paths, rendered in the Prometheus text format for
+    /metrics and get-metrics.
+
+    Recording is a dict update under a per-metric lock, cheap enough for per-notification and per-update
+    call sites. Modules create their metrics once at import time through the module-level helpers below.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    @classmethod
+    def shared(cls) -> "MetricsRegistry":
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # Modules can be imported twice (e.g. as __main__); keep the first instance
+                if type(existing) is not type(metric) or existing.labels != metric.labels:
+                    raise ValueError(f"Metric {metric.name} already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def counter(name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+    return MetricsRegistry.shared().register(Counter(name, documentation, labels))
+
+
+def gauge(name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Gauge:
+    return MetricsRegistry.shared().register(Gauge(name, documentation, labels))
+
+
+def histogram(name: str, documentation: str, labels: Tuple[str, ...] = (), buckets: Optional[Tuple[float, ...]] = None) -> Histogram:
+    return MetricsRegistry.shared().register(Histogram(name, documentation, labels, buckets))
+
+
+def render() -> str:
+    return MetricsRegistry.shared().render()
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{name}="' + str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') + '"'
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,170 @@
+import gc
+import hashlib
+import importlib.util
+import os
+import sys
+import threading
+from collections import OrderedDict
+from types import CodeType
+from typing import Dict, Optional, Tuple
+
+from cyberonics_py import Robot
+
+
+class SourceFile:
+    """
+    A file a loaded robot depends on. Changes are detected with a stat; the content hash is only recomputed
+    when the stat changed, so touching a file (or a checkout that rewrites it unchanged) doesn't reload.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.stat = self.__stat()
+        self.digest = self.__hash()
+
+    def changed(self) -> bool:
+        stat = self.__stat()
+        if stat == self.stat:
+            return False
+        digest = self.__hash()
+        self.stat = stat
+        if digest == self.digest:
+            return False
+        self.digest = digest
+        return True
+
+    def __stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except FileNotFoundError:
+            return None
+
+    def __hash(self) -> Optional[str]:
+        try:
+            with open(self.path, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+
+class LoadedRobot:
+    def __init__(self, path: str, robot: Robot, sources: Dict[str, SourceFile], modules: [str]):
+        self.path = path
+        self.robot = robot
+        # Module file path -> SourceFile, for robot.py and the project modules it imported
+        self.sources = sources
+        # Names of the project's modules in sys.modules when it was loaded
+        self.modules = modules
+
+    def changed(self) -> bool:
+        # Check every file so each one's stat is refreshed
+        return any([source.changed() for source in self.sources.values()])
+
+
+class RobotLoader:
+    """
+    Loads robot.py files. The attached robot is kept, so reattaching it (tinker, switch-project to the
+    selected project) doesn't re-execute the module and rebuild every device, until robot.py or one of the
+    project's modules changes content.
+
+    Only the attached robot is kept: a Robot holds its devices' hardware handles, so a detached one is released
+    (see release) rather than cached. What is cached for other robots is their compiled code, keyed by content
+    hash, so switching back to a project re-executes robot.py without reading and compiling it again.
+
+    A project module is any module in sys.modules whose file is under robot.py's directory, whether robot.py
+    imported it during this load or it was already imported before. They are dropped from sys.modules when their
+    robot is released so the next load picks up their current code, and so two projects with a module of the
+    same name don't share it.
+    """
+
+    def __init__(self, max_code: int = 4):
+        """
+        :param max_code: Number of robot.py files whose compiled code is kept.
+        """
+        self.max_code = max_code
+        self._lock = threading.Lock()
+        self._loaded: Optional[LoadedRobot] = None
+        # path -> (sha256, code object), least recently loaded first
+        self._code: "OrderedDict[str, Tuple[str, CodeType]]" = OrderedDict()
+
+    def current(self, robot_path: str) -> Optional[Robot]:
+        """
+        :return: The loaded robot if it was loaded from robot_path and its sources are unchanged, else None.
+        """
+        robot_path = os.path.abspath(robot_path)
+        with self._lock:
+            loaded = self._loaded
+            if loaded is None or loaded.path != robot_path or loaded.changed():
+                return None
+            return loaded.robot
+
+    def load(self, robot_path: str) -> Robot:
+        """
+        Builds a new Robot from robot_path, releasing the one loaded before.
+        """
+        robot_path = os.path.abspath(robot_path)
+        if not os.path.isfile(robot_path):
+            raise FileNotFoundError(f"No such file: {robot_path}")
+
+        with self._lock:
+            self.__release()
+            self._loaded = self.__load(robot_path)
+            return self._loaded.robot
+
+    def release(self):
+        """
+        Drops the loaded robot so its devices, and the hardware handles they hold, can be freed. Call once it is
+        detached.
+        """
+        with self._lock:
+            self.__release()
+
+    def __release(self):
+        loaded, self._loaded = self._loaded, None
+        if loaded is None:
+            return
+        for name in loaded.modules:
+            sys.modules.pop(name, None)
+        del loaded
+        # Devices close their handles when collected; robots and their devices often reference each other
+        gc.collect()
+
+    def __load(self, robot_path: str) -> LoadedRobot:
+        project_directory = os.path.dirname(robot_path) + os.sep
+
+        module_name = os.path.splitext(os.path.basename(robot_path))[0]
+        spec = importlib.util.spec_from_file_location(module_name, robot_path)
+        module = importlib.util.module_from_spec(spec)
+        source = SourceFile(robot_path)
+        exec(self.__compile(robot_path, source.digest), module.__dict__)
+
+        # Project modules, found by file rather than by what this load added to sys.modules, since one imported
+        # earlier is a dependency too. Library imports are left cached in sys.modules
+        modules = []
+        sources = {robot_path: source}
+        for name, imported in list(sys.modules.items()):
+            path = getattr(imported, "__file__", None)
+            if path and os.path.abspath(path).startswith(project_directory):
+                modules.append(name)
+                sources[os.path.abspath(path)] = SourceFile(path)
+
+        for attribute_name in dir(module):
+            attribute = getattr(module, attribute_name)
+            if isinstance(attribute, type) and issubclass(attribute, Robot) and attribute is not Robot:
+                return LoadedRobot(robot_path, attribute(), sources, modules)
+        raise TypeError("No subclass of Robot found in the specified file.")
+
+    def __compile(self, robot_path: str, digest: str) -> CodeType:
+        cached = self._code.get(robot_path)
+        if cached is not None and cached[0] == digest:
+            code = cached[1]
+        else:
+            with open(robot_path, "rb") as f:
+                code = compile(f.read(), robot_path, "exec")
+        # Only the current version of each file is worth keeping
+        self._code[robot_path] = (digest, code)
+        self._code.move_to_end(robot_path)
+        while len(self._code) > self.max_code:
+            self._code.popitem(last=False)
+        return code
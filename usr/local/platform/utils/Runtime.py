@@ -0,0 +1,42 @@
+from utils.CommandCenter import CommandCenter
+from utils.CommandScheduler import CommandScheduler
+from utils.DeviceManager import DeviceManager
+from utils.EventBus import EventBus
+from utils.ExecutionManager import ExecutionManager
+from utils.ManifestStore import ManifestStore
+from utils.ShellEngine import ShellEngine
+
+
+class Runtime:
+    """
+    The process-wide core shared by every transport: one execution manager, one device manager and one
+    command center. Servers attach to it as frontends and receive program output and device updates through
+    the event bus, so a program started over BLE still streams its logs to WebSocket clients and vice versa.
+
+    Events:
+        stdout(batch)           A LogBatch of the running program's stdout
+        stderr(batch)           A LogBatch of the running program's stderr
+        device_updated(uuid, patch, version)
+                                A device's state changed. patch is None when clients should resync from the
+                                full state
+        job(event)              A background job was queued, started, printed output or finished
+    """
+
+    def __init__(self):
+        self.events = EventBus()
+        self.manifest = ManifestStore.shared()
+        self.shell = ShellEngine()
+        self.execution_manager = ExecutionManager(
+            stdout=lambda batch: self.events.publish("stdout", batch),
+            stderr=lambda batch: self.events.publish("stderr", batch)
+        )
+        self.device_manager = DeviceManager(
+            device_updated=lambda uuid, patch, version: self.events.publish("device_updated", uuid, patch, version)
+        )
+        self.command_center = CommandCenter(
+            execution_manager=self.execution_manager,
+            device_manager=self.device_manager,
+            manifest=self.manifest,
+            shell=self.shell
+        )
+        self.scheduler = CommandScheduler(self.command_center, self.events)
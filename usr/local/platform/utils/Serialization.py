@@ -0,0 +1,52 @@
+"""
+JSON encoding for everything the agent sends or receives.
+
+Uses orjson when it's installed and falls back to the standard library otherwise. For valid JSON values both
+produce the same compact UTF-8 output. They differ for NaN and infinities, which orjson writes as null and
+the json module as NaN/Infinity (which most JSON parsers reject). dumps returns bytes, which is what the BLE
+characteristics and WebSocket frames end up carrying anyway.
+
+The manifest keeps using the json module directly since it's written indented for people to edit.
+"""
+
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+# Raised by loads for malformed input, whichever backend is in use
+DecodeError = orjson.JSONDecodeError if orjson is not None else json.JSONDecodeError
+
+
+if orjson is not None:
+    def dumps(value: Any) -> bytes:
+        # Device states from user code may be keyed by ints
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps_str(value: Any) -> str:
+        """
+        For text destinations: command responses and WebSocket text frames.
+        """
+        return dumps(value).decode("utf-8")
+
+    def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        return orjson.loads(data)
+else:
+    _encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+    def dumps(value: Any) -> bytes:
+        return _encoder.encode(value).encode("utf-8")
+
+    def dumps_str(value: Any) -> str:
+        return _encoder.encode(value)
+
+    def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
@@ -0,0 +1,129 @@
+import asyncio
+import codecs
+import os
+import signal
+import threading
+from concurrent.futures import Future
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+# Receives the output of every command started from the current context that wasn't given its own on_output.
+# Lets a caller (e.g. a background job) stream the progress of shell commands run deep inside a handler.
+output_listener: ContextVar[Optional[Callable[[str, str], None]]] = ContextVar("output_listener", default=None)
+
+
+class ShellResult:
+    def __init__(self, returncode: Optional[int], stdout: str, stderr: str, timed_out: bool = False):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+
+
+class ShellEngine:
+    """
+    Runs shell commands as asyncio subprocesses on a private event loop thread.
+
+    Each command gets its own working directory through cwd= instead of changing the process-wide working
+    directory, so any number of commands can run at once from any thread. Commands can be given a timeout,
+    cancelled through the Future returned by submit, and stream their output as it arrives through on_output.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def submit(
+            self,
+            command: str,
+            cwd: Optional[str] = None,
+            timeout: Optional[float] = None,
+            on_output: Optional[Callable[[str, str], None]] = None,
+            env: Optional[dict] = None
+    ) -> Future:
+        """
+        Starts a command and returns immediately.
+
+        :param command: Shell command line.
+        :param cwd: Directory to run the command in.
+        :param timeout: Seconds before the command is killed. None waits forever.
+        :param on_output: Called from the engine thread with ('stdout' | 'stderr', text) for each chunk of output.
+            Defaults to the current output_listener.
+        :param env: Environment for the command. Defaults to the agent's environment.
+        :return: A Future resolving to a ShellResult. Cancelling it kills the command.
+        """
+        if on_output is None:
+            on_output = output_listener.get()
+        return asyncio.run_coroutine_threadsafe(self.__run(command, cwd, timeout, on_output, env), self.loop)
+
+    def run(self, command: str, cwd: Optional[str] = None, timeout: Optional[float] = None,
+            on_output: Optional[Callable[[str, str], None]] = None, env: Optional[dict] = None) -> ShellResult:
+        """
+        Runs a command and blocks the calling thread until it finishes. Must not be called from the engine thread.
+        """
+        return self.submit(command, cwd, timeout, on_output, env).result()
+
+    async def run_async(self, command: str, cwd: Optional[str] = None, timeout: Optional[float] = None,
+                        on_output: Optional[Callable[[str, str], None]] = None, env: Optional[dict] = None) -> ShellResult:
+        """
+        Awaitable form of run for callers on another event loop. Cancelling the awaiting task kills the command.
+        """
+        return await asyncio.wrap_future(self.submit(command, cwd, timeout, on_output, env))
+
+    async def __run(self, command, cwd, timeout, on_output, env) -> ShellResult:
+        process = await asyncio.create_subprocess_shell(
+            command,
+            cwd=cwd,
+            env=env,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # Own process group so a timeout or cancel also stops whatever the shell started
+            start_new_session=os.name != 'nt'
+        )
+        stdout, stderr = [], []
+        readers = asyncio.gather(
+            self.__read(process.stdout, 'stdout', stdout, on_output),
+            self.__read(process.stderr, 'stderr', stderr, on_output),
+            process.wait()
+        )
+        timed_out = cancelled = False
+        try:
+            await asyncio.wait_for(readers, timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+        except asyncio.CancelledError:
+            cancelled = True
+
+        if timed_out or cancelled:
+            self.__kill(process)
+            await process.wait()
+        if cancelled:
+            raise asyncio.CancelledError()
+        return ShellResult(process.returncode, "".join(stdout), "".join(stderr), timed_out)
+
+    @staticmethod
+    async def __read(stream: asyncio.StreamReader, name: str, chunks: list, on_output):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        while True:
+            data = await stream.read(4096)
+            text = decoder.decode(data, final=not data)
+            if text:
+                chunks.append(text)
+                if on_output is not None:
+                    try:
+                        on_output(name, text)
+                    except Exception as e:
+                        print(f"Error in shell output callback: {e}")
+            if not data:
+                return
+
+    @staticmethod
+    def __kill(process: asyncio.subprocess.Process):
+        try:
+            if os.name == 'nt':
+                process.kill()
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
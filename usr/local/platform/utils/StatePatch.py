@@ -0,0 +1,99 @@
+"""
+Patches between device states.
+
+A patch is {'set': {...}, 'delete': [[key, ...], ...]}. 'set' is a merge patch (RFC 7396) holding only the
+keys whose values changed, with nested dicts diffed recursively. Unlike RFC 7396, None in 'set' is an
+ordinary value; removed keys are listed separately in 'delete' as key paths. Applying a patch removes the
+'delete' paths first and then merges 'set', so apply_patch(old, diff(old, new)) == new.
+"""
+
+
+def diff(old: dict, new: dict) -> dict:
+    patch = {'set': {}, 'delete': []}
+    _diff(old, new, [], patch)
+    return patch
+
+
+def _diff(old: dict, new: dict, path: list, patch: dict):
+    changed = {}
+    for key, value in new.items():
+        if key not in old:
+            changed[key] = value
+        elif old[key] != value:
+            if isinstance(value, dict) and isinstance(old[key], dict):
+                nested = {'set': {}, 'delete': patch['delete']}
+                _diff(old[key], value, path + [key], nested)
+                if nested['set']:
+                    changed[key] = nested['set']
+            else:
+                changed[key] = value
+    for key in old:
+        if key not in new:
+            patch['delete'].append(path + [key])
+    patch['set'].update(changed)
+
+
+def apply_patch(state: dict, patch: dict) -> dict:
+    result = dict(state)
+    for path in patch.get('delete', ()):
+        result = _delete(result, path)
+    return _merge(result, patch.get('set', {}))
+
+
+def compose(first: dict, second: dict) -> dict:
+    """
+    Combines two consecutive patches into one that has the same effect as applying first and then second.
+    """
+    # Removing second's paths from what first set gives the same result as removing them afterwards
+    first_set = first.get('set', {})
+    for path in second.get('delete', ()):
+        first_set = _delete(first_set, path)
+    delete = list(first.get('delete', [])) + list(second.get('delete', []))
+    composed = _compose_set(first_set, second.get('set', {}), [], delete)
+    return {'set': composed, 'delete': _prune(delete)}
+
+
+def _compose_set(first: dict, second: dict, path: list, delete: list) -> dict:
+    result = dict(first)
+    for key, value in second.items():
+        if isinstance(value, dict) and key in result and isinstance(result[key], dict):
+            result[key] = _compose_set(result[key], value, path + [key], delete)
+        else:
+            if isinstance(value, dict) and key in result:
+                # first replaced the key with something that isn't a dict, so second's dict replaces it too
+                # rather than merging into whatever the client held before first
+                delete.append(path + [key])
+            result[key] = value
+    return result
+
+
+def _prune(paths: list) -> list:
+    # Drops duplicates and paths under another deleted path, so composed patches don't grow without bound
+    kept = []
+    for path in sorted(paths, key=len):
+        if not any(path[:len(other)] == other for other in kept):
+            kept.append(path)
+    return kept
+
+
+def _merge(target: dict, patch: dict) -> dict:
+    result = dict(target)
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = _merge(result[key], value)
+        else:
+            result[key] = value
+    return result
+
+
+def _delete(target: dict, path: list) -> dict:
+    # Copies only the dicts along the path; a path through something that isn't a dict removes nothing
+    key = path[0]
+    if key not in target:
+        return target
+    result = dict(target)
+    if len(path) == 1:
+        del result[key]
+    elif isinstance(result[key], dict):
+        result[key] = _delete(result[key], path[1:])
+    return result
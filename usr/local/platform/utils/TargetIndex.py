@@ -0,0 +1,300 @@
+import bisect
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+
+class GitIgnore:
+    """
+    The subset of .gitignore semantics needed to prune a project tree: per-directory .gitignore files plus
+    .git/info/exclude, negation, directory-only patterns, anchored patterns and '**'.
+    """
+
+    def __init__(self):
+        # Directory (relative to the project root, '' for the root) -> [(regex, negate, dir_only)]
+        self.rules = {}
+        # .git/info/exclude, applied before the root .gitignore
+        self.exclude = []
+
+    def load_exclude(self, path: str):
+        self.exclude = self.__read(path)
+
+    def load(self, directory: str, path: str) -> bool:
+        """
+        (Re)loads the rules in the ignore file at path for the given directory.
+
+        :return: True if the rules for the directory changed.
+        """
+        rules = self.__read(path)
+        changed = [r[0].pattern for r in rules] != [r[0].pattern for r in self.rules.get(directory, [])]
+        if rules:
+            self.rules[directory] = rules
+        else:
+            self.rules.pop(directory, None)
+        return changed
+
+    def forget(self, directory: str):
+        prefix = directory + "/"
+        for key in [k for k in self.rules if k == directory or k.startswith(prefix)]:
+            del self.rules[key]
+
+    def ignored(self, path: str, is_dir: bool) -> bool:
+        """
+        :param path: Path relative to the project root, '/' separated.
+        """
+        ignored = False
+        parts = path.split("/")
+        for depth in range(len(parts)):
+            directory = "/".join(parts[:depth])
+            rules = self.rules.get(directory, [])
+            if depth == 0:
+                rules = self.exclude + rules
+            if not rules:
+                continue
+            relative = "/".join(parts[depth:])
+            for regex, negate, dir_only in rules:
+                if dir_only and not is_dir:
+                    continue
+                if regex.match(relative):
+                    ignored = not negate
+        return ignored
+
+    @staticmethod
+    def __read(path: str) -> list:
+        rules = []
+        try:
+            with open(path) as f:
+                for line in f:
+                    rule = GitIgnore.__parse(line.rstrip("\n"))
+                    if rule is not None:
+                        rules.append(rule)
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return rules
+
+    @staticmethod
+    def __parse(line: str):
+        if not line.strip() or line.startswith("#"):
+            return None
+        line = line.rstrip()
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        # A slash anywhere but the end anchors the pattern to the .gitignore's directory
+        anchored = "/" in line
+        line = line.lstrip("/")
+        if not line:
+            return None
+
+        regex = ""
+        i = 0
+        while i < len(line):
+            if line.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+            elif line.startswith("/**", i) and i + 3 == len(line):
+                regex += "/.*"
+                i += 3
+            elif line.startswith("**", i):
+                regex += ".*"
+                i += 2
+            elif line[i] == "*":
+                regex += "[^/]*"
+                i += 1
+            elif line[i] == "?":
+                regex += "[^/]"
+                i += 1
+            elif line[i] == "[":
+                end = line.find("]", i + 1)
+                if end == -1:
+                    regex += re.escape(line[i])
+                    i += 1
+                else:
+                    regex += "[" + line[i + 1:end].replace("!", "^", 1) + "]"
+                    i = end + 1
+            else:
+                regex += re.escape(line[i])
+                i += 1
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+        return re.compile(regex + "$"), negate, dir_only
+
+
+class IndexedDirectory:
+    def __init__(self, mtime_ns: int, files: [str], subdirectories: [str]):
+        self.mtime_ns = mtime_ns
+        self.files = files
+        self.subdirectories = subdirectories
+
+
+class TargetIndex:
+    """
+    Index of a project's source files, replacing a `find` over the whole tree on every get-targets.
+
+    The tree is walked once, skipping .git and anything matched by .gitignore. After that, refresh() only
+    stats the indexed directories and rescans the ones whose mtime changed, since creating, deleting or
+    renaming a file (including a git checkout or pull) always updates its directory's mtime. Queries are
+    served from a sorted list, so prefix filters and pages are binary searches.
+    """
+
+    TARGET_EXTENSIONS = ('.py', '.c', '.cpp')
+
+    def __init__(self, root: str, revalidate_interval: float = 2.0):
+        self.root = root
+        self.revalidate_interval = revalidate_interval
+        self.ignore = GitIgnore()
+        self._lock = threading.RLock()
+        self._directories = {}
+        self._targets: Optional[list] = None
+        self._built = False
+        self._last_refresh = 0.0
+
+    def query(self, prefix: str = "", offset: int = 0, limit: Optional[int] = None) -> [str]:
+        """
+        Returns target files ('./' prefixed, sorted) whose path starts with prefix.
+
+        :raises ValueError: If offset or limit is negative.
+        """
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("offset and limit must not be negative")
+        with self._lock:
+            self.__ensure_fresh()
+            targets = self.__targets()
+            prefix = self.__normalize(prefix)
+            start = bisect.bisect_left(targets, prefix)
+            end = bisect.bisect_left(targets, prefix + "\U0010ffff") if prefix != "./" else len(targets)
+            start += offset
+            if limit is not None:
+                end = min(end, start + limit)
+            return targets[start:end]
+
+    def find(self, name: str) -> [str]:
+        """
+        Returns the './' prefixed paths of every indexed file (of any type) with the given file name, shallowest first.
+        """
+        with self._lock:
+            self.__ensure_fresh()
+            matches = [
+                self.__display(directory, name)
+                for directory, entry in self._directories.items() if name in entry.files
+            ]
+            return sorted(matches, key=lambda path: (path.count("/"), path))
+
+    def refresh(self):
+        """
+        Rescans the directories that changed since they were last indexed.
+        """
+        with self._lock:
+            self._last_refresh = time.monotonic()
+            if not self._built:
+                self.__scan("")
+                # Stays unbuilt while the project directory doesn't exist, so it's scanned once it does
+                self._built = "" in self._directories
+                return
+            for directory in list(self._directories):
+                entry = self._directories.get(directory)
+                if entry is None:
+                    # Dropped along with a removed parent earlier in this pass
+                    continue
+                try:
+                    mtime_ns = os.stat(self.__path(directory)).st_mtime_ns
+                except (FileNotFoundError, NotADirectoryError):
+                    self.__drop(directory)
+                    continue
+                if mtime_ns != entry.mtime_ns:
+                    self.__rescan(directory, entry)
+
+    def __ensure_fresh(self):
+        if not self._built or time.monotonic() - self._last_refresh > self.revalidate_interval:
+            self.refresh()
+
+    def __targets(self) -> list:
+        if self._targets is None:
+            self._targets = sorted(
+                self.__display(directory, file)
+                for directory, entry in self._directories.items()
+                for file in entry.files if file.endswith(self.TARGET_EXTENSIONS)
+            )
+        return self._targets
+
+    def __rescan(self, directory: str, old: IndexedDirectory):
+        if self.ignore.load(directory, os.path.join(self.__path(directory), ".gitignore")):
+            # Different rules can change what's ignored anywhere below, so rebuild the whole subtree
+            self.__drop(directory)
+            self.__scan(directory)
+            return
+        entry = self.__list(directory)
+        if entry is None:
+            self.__drop(directory)
+            return
+        self._directories[directory] = entry
+        self._targets = None
+        for removed in set(old.subdirectories) - set(entry.subdirectories):
+            self.__drop(self.__join(directory, removed))
+        for added in set(entry.subdirectories) - set(old.subdirectories):
+            self.__scan(self.__join(directory, added))
+
+    def __scan(self, directory: str):
+        if directory == "":
+            self.ignore.load_exclude(os.path.join(self.root, ".git", "info", "exclude"))
+        self.ignore.load(directory, os.path.join(self.__path(directory), ".gitignore"))
+        entry = self.__list(directory)
+        if entry is None:
+            return
+        self._directories[directory] = entry
+        self._targets = None
+        for subdirectory in entry.subdirectories:
+            self.__scan(self.__join(directory, subdirectory))
+
+    def __list(self, directory: str) -> Optional[IndexedDirectory]:
+        path = self.__path(directory)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return None
+        files, subdirectories = [], []
+        for item in entries:
+            relative = self.__join(directory, item.name)
+            if item.is_dir(follow_symlinks=False):
+                if item.name == ".git" or self.ignore.ignored(relative, True):
+                    continue
+                subdirectories.append(item.name)
+            elif not self.ignore.ignored(relative, False):
+                files.append(item.name)
+        return IndexedDirectory(mtime_ns, files, subdirectories)
+
+    def __drop(self, directory: str):
+        prefix = directory + "/"
+        for key in [k for k in self._directories if k == directory or (directory and k.startswith(prefix))]:
+            del self._directories[key]
+        if directory:
+            self.ignore.forget(directory)
+        else:
+            # The project directory itself is gone; start over if it comes back (e.g. cloned again)
+            self.ignore = GitIgnore()
+            self._built = False
+        self._targets = None
+
+    def __path(self, directory: str) -> str:
+        return os.path.join(self.root, directory) if directory else self.root
+
+    @staticmethod
+    def __join(directory: str, name: str) -> str:
+        return f"{directory}/{name}" if directory else name
+
+    @staticmethod
+    def __display(directory: str, name: str) -> str:
+        # Same shape `find .` produced, which is what targets in existing manifests look like
+        return f"./{directory}/{name}" if directory else f"./{name}"
+
+    @staticmethod
+    def __normalize(prefix: str) -> str:
+        prefix = prefix.strip()
+        if prefix.startswith("./"):
+            return prefix
+        return "./" + prefix.lstrip("/")
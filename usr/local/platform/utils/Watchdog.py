@@ -0,0 +1,59 @@
+import threading
+import time
+from typing import Callable, Optional
+
+
+class Watchdog:
+    """
+    A single deadline timer that calls on_expire if it isn't fed within timeout seconds.
+
+    The watchdog is only armed while there is something to protect (a running program). While disarmed its
+    thread sleeps on a condition with no timeout, so an idle agent has no periodic wakeups. feed() only moves
+    the deadline forward and never wakes the thread; the thread notices the later deadline when its current
+    wait ends.
+    """
+
+    def __init__(self, on_expire: Callable[[], None]):
+        self.on_expire = on_expire
+        self._condition = threading.Condition()
+        self._timeout = 0.0
+        self._deadline: Optional[float] = None
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    @property
+    def armed(self) -> bool:
+        return self._deadline is not None
+
+    def arm(self, timeout: float):
+        with self._condition:
+            self._timeout = timeout
+            self._deadline = time.monotonic() + timeout
+            self._condition.notify()
+
+    def disarm(self):
+        with self._condition:
+            self._deadline = None
+            self._condition.notify()
+
+    def feed(self):
+        with self._condition:
+            if self._deadline is not None:
+                self._deadline = time.monotonic() + self._timeout
+
+    def __run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._deadline is None:
+                        self._condition.wait()
+                        continue
+                    remaining = self._deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._deadline = None
+                        break
+                    self._condition.wait(remaining)
+            try:
+                self.on_expire()
+            except Exception as e:
+                print(f"Watchdog handler failed: {e}")
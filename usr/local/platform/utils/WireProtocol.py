@@ -0,0 +1,88 @@
+"""
+Binary framing for the BLE characteristics, negotiated per connection with `set-protocol binary`.
+
+Every frame is an 8 byte little-endian header followed by a MessagePack payload:
+
+    length  uint32  payload length in bytes
+    type    uint8   MessageType
+    status  uint8   Status
+    seq     uint16  request sequence number, echoed in the response; 0 for pushed messages
+
+Text mode ("0,<response>") stays the default so existing clients keep working.
+"""
+
+import struct
+from typing import Any
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+TEXT = "text"
+BINARY = "binary"
+
+
+class MessageType:
+    # Client -> server: payload is the command string
+    COMMAND = 1
+    # Server -> client: reply to the COMMAND with the same seq, payload is the response
+    RESPONSE = 2
+    # Program output, payload is [log seq, text]
+    STDOUT = 3
+    STDERR = 4
+    # Job event dict
+    JOB = 5
+    # {uuid: state} for 'full' device mode
+    DEVICE_STATE = 6
+    # {'devices': {uuid: {...}}} for 'patch' device mode
+    DEVICE_PATCH = 7
+
+
+class Status:
+    OK = 0
+    ERROR = 1
+
+
+class Frame:
+    def __init__(self, message_type: int, status: int, seq: int, payload: Any):
+        self.type = message_type
+        self.status = status
+        self.seq = seq
+        self.payload = payload
+
+
+HEADER = struct.Struct("<IBBH")
+
+
+def available() -> bool:
+    return msgpack is not None
+
+
+def encode(message_type: int, payload: Any, status: int = Status.OK, seq: int = 0) -> bytearray:
+    body = msgpack.packb(payload, use_bin_type=True)
+    frame = bytearray(HEADER.size + len(body))
+    HEADER.pack_into(frame, 0, len(body), message_type, status, seq & 0xFFFF)
+    frame[HEADER.size:] = body
+    return frame
+
+
+def frame_length(data) -> int:
+    """
+    Returns the total length of the frame starting at data, which must hold at least the header.
+    """
+    return HEADER.size + HEADER.unpack_from(data, 0)[0]
+
+
+def decode(data) -> Frame:
+    """
+    :raises ValueError: If data isn't exactly one complete frame.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError(f"Frame too short: {len(data)} bytes")
+    length, message_type, status, seq = HEADER.unpack_from(data, 0)
+    if len(data) != HEADER.size + length:
+        raise ValueError(f"Frame length mismatch: header says {length}, got {len(data) - HEADER.size}")
+    payload = msgpack.unpackb(memoryview(data)[HEADER.size:], raw=False)
+    return Frame(message_type, status, seq, payload)